@@ -0,0 +1,593 @@
+#
+# $Id$
+#
+# NAME:         aio.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   asyncio counterparts of class:Interface, class:Route and class:RoutingTable.  'ip' is run with
+# asyncio.create_subprocess_exec, so thousands of operations can be in flight from one thread; an class:AsyncRunner
+# caps how many 'ip' processes run at once and how long each may take.  Requires Python 3.6 or later (the rest of the
+# package does not).
+#
+#   The async classes subclass the blocking ones, so rendering, parsing and error checks are shared; only the methods
+# which talk to the system become coroutines.
+#
+
+import asyncio
+import shlex
+import weakref
+
+from . import backend
+from . import instrument
+from . import ippool
+from . import ipprefix
+from . import routestore
+from .interface import Interface, InterfaceError
+from .route import Route, RouteError
+from .routingtable import RoutingTable, RoutingTableError, InvalidRouteError, BatchError, _byVersion, _joinLine
+
+# Default for arguments where ``None`` is a meaningful value
+_UNSET = object()
+
+
+# Exceptions
+class AsyncError(Exception):
+    pass
+class AsyncTimeoutError(AsyncError):
+    pass
+
+
+# -------- AsyncRunner --------
+
+class AsyncRunner(object):
+    """
+    Runs 'ip' commands as asyncio subprocesses.  Results are dictionaries in the same format as the blocking backends
+    (see class:backend.Backend).
+    """
+    limit = 64          # Maximum number of 'ip' processes running at once
+    timeout = 30.0      # Seconds each command may take, ``None`` for no limit
+
+
+    def __init__(self, limit = None, timeout = _UNSET):
+        """
+        Constructor
+
+        :param limit: Maximum number of concurrent 'ip' processes.  Defaults to self.limit.
+        :param timeout: Seconds each command may take, ``None`` for no limit.  Defaults to self.timeout.
+        """
+        if limit is not None:
+            self.limit = limit
+        if timeout is not _UNSET:
+            self.timeout = timeout
+        if self.limit < 1:
+            raise AsyncError("Concurrency limit must be at least 1.")
+
+        self._semaphores = weakref.WeakKeyDictionary()
+    #---
+
+
+    def _semaphore(self):
+        """
+        Returns the semaphore for the running event loop (asyncio primitives can't be shared between loops).
+
+        """
+        loop = asyncio.get_event_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.limit)
+        return semaphore
+    #---
+
+
+    async def _run(self, arguments, stdin = None):
+        """
+        Runs 'ip' and collects its output.  The process is killed if the timeout runs out or the caller is cancelled.
+
+        :param arguments: List of arguments to pass to 'ip'.
+        :param stdin: Text to write to the process' standard input.
+        :return: Tuple of (return value, stdout, stderr).
+        """
+        async with self._semaphore():
+            # Time spent waiting for the semaphore isn't counted
+            timed = instrument.enabled
+            if timed:
+                started = instrument.timer()
+            process = await asyncio.create_subprocess_exec(
+                'ip', *arguments, stdin = asyncio.subprocess.PIPE if stdin is not None else asyncio.subprocess.DEVNULL,
+                stdout = asyncio.subprocess.PIPE, stderr = asyncio.subprocess.PIPE)
+            try:
+                stdout, stderr = await asyncio.wait_for(
+                    process.communicate(stdin.encode() if stdin is not None else None), self.timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as error:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                if isinstance(error, asyncio.TimeoutError):
+                    raise AsyncTimeoutError("'ip %s' timed out after %s seconds" %(' '.join(arguments), self.timeout))
+                raise
+
+        if timed:
+            instrument.record(instrument.COMMAND, instrument.commandKind(arguments), instrument.timer() - started,
+                              len(stdout), process.returncode)
+        return process.returncode, stdout.decode(), stderr.decode()
+    #---
+
+
+    async def ip(self, arguments):
+        """
+        Runs the 'ip' command with the provided arguments.
+
+        :param arguments: Argument string to pass to the 'ip' command.
+        :return: Result dictionary.
+        """
+        return_value, stdout, stderr = await self._run(shlex.split(arguments))
+        return backend.result(return_value, stdout, stderr)
+    #---
+
+
+    async def batch(self, commands, family = None):
+        """
+        asyncio version of meth:backend.ProcessBackend.batch.
+
+        """
+        errors = {}
+        stderr = ''
+        start = 0
+        options = ['-%d' %family] if family else []
+
+        while start < len(commands):
+            return_value, _, chunk_stderr = await self._run(options + ['-force', '-batch', '-'],
+                                                            ''.join("%s\n" %command for command in commands[start:]))
+            stderr += chunk_stderr
+
+            chunk_errors, aborted_text = backend.parseBatchErrors(chunk_stderr)
+            for line, text in chunk_errors.items():
+                errors[start + line - 1] = text
+            if aborted_text is None and return_value in (0, 1):
+                break
+
+            last_failure = max(chunk_errors) if chunk_errors else 0
+            aborted_at = backend.findAbortedCommand(commands, start + last_failure, aborted_text or '')
+            if aborted_at is None:
+                for index in range(start + last_failure, len(commands)):
+                    errors[index] = "Not applied, batch aborted: %s" %(aborted_text or return_value)
+                break
+            errors[aborted_at] = aborted_text
+            start = aborted_at + 1
+
+        return backend.result(backend.RET_ERROR if errors else backend.RET_OK, stderr = stderr, errors = errors)
+    #---
+
+
+    async def stream(self, arguments):
+        """
+        Yields the output of an 'ip' command one line at a time, as it's produced.  The timeout applies to each line.
+
+        :param arguments: Argument string to pass to the 'ip' command.
+        :raise backend.BackendError: If 'ip' fails.
+        """
+        size = 0
+        async with self._semaphore():
+            timed = instrument.enabled
+            if timed:
+                started = instrument.timer()
+            process = await asyncio.create_subprocess_exec(
+                'ip', *shlex.split(arguments), stdin = asyncio.subprocess.DEVNULL, stdout = asyncio.subprocess.PIPE,
+                stderr = asyncio.subprocess.PIPE)
+            try:
+                while True:
+                    line = await asyncio.wait_for(process.stdout.readline(), self.timeout)
+                    if not line:
+                        break
+                    size += len(line)
+                    yield line.decode()
+                stderr = await process.stderr.read()
+                await process.wait()
+            except asyncio.TimeoutError:
+                raise AsyncTimeoutError("'ip %s' timed out after %s seconds" %(arguments, self.timeout))
+            finally:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+
+        if timed:
+            instrument.record(instrument.COMMAND, instrument.commandKind(arguments), instrument.timer() - started,
+                              size, process.returncode)
+        if process.returncode:
+            raise backend.BackendError("'ip %s' failed (%d): %s" %(arguments, process.returncode,
+                                                                   stderr.decode().strip()))
+    #---
+
+
+    async def showLink(self, name):
+        ip_link = await self.ip("link show \"%s\"" %name)
+
+        state = None
+        if not ip_link['return_value']:
+            state = backend.parseLinkState(ip_link['stdout'])
+
+        return backend.result(ip_link['return_value'], ip_link['stdout'], ip_link['stderr'], state = state)
+    #---
+
+
+    async def setLinkState(self, name, up):
+        return await self.ip("link set \"%s\" %s" %(name, 'up' if up else 'down'))
+    #---
+
+
+    async def getAddresses(self, name):
+        ip_address = await self.ip("address show dev \"%s\"" %name)
+
+        return backend.result(ip_address['return_value'], ip_address['stdout'], ip_address['stderr'],
+                              addresses = backend.parseAddresses(ip_address['stdout']))
+    #---
+
+
+    async def addAddress(self, name, address):
+        return await self.ip("address add \"%s\" dev \"%s\"" %(address, name))
+    #---
+
+
+    async def delAddress(self, name, address):
+        return await self.ip("address del \"%s\" dev \"%s\"" %(address, name))
+    #---
+
+
+    async def addressBatch(self, operations):
+        """
+        asyncio version of meth:backend.Backend.addressBatch.
+
+        """
+        ip_batch = await self.batch(["address %s \"%s\" dev \"%s\"" %(action, address, name)
+                                     for action, name, address in operations])
+
+        errors = dict((index, (ippool.returnValue(text), text)) for index, text in ip_batch['errors'].items())
+        return backend.result(ip_batch['return_value'], stderr = ip_batch['stderr'], errors = errors)
+    #---
+#---
+
+
+_runner = None
+
+
+def setRunner(runner):
+    """
+    Replaces the runner used by async objects created without one.
+
+    :param runner: Instance of class:AsyncRunner.
+    """
+    global _runner
+    _runner = runner
+#---
+
+
+def getRunner():
+    """
+    Returns the shared runner, creating it on first use.
+
+    :return: Instance of class:AsyncRunner.
+    """
+    global _runner
+    if _runner is None:
+        _runner = AsyncRunner()
+    return _runner
+#---
+
+
+# -------- AsyncInterface --------
+
+class AsyncInterface(Interface):
+    """
+    asyncio version of class:Interface.  The constructor can't wait for the system, so it does not check the name; use
+    meth:open (or await meth:setName) for that.  For the same reason self.addresses never reads the system: it is
+    ``None`` until meth:getAddresses has been awaited (or after the cache is invalidated).
+    """
+    runner = None
+    addresses = property(Interface._cachedAddresses, Interface._storeAddresses)
+
+
+    def __init__(self, name, config = None, runner = None):
+        """
+        Constructor
+
+        :param name: Operating system's name for the interface.
+        :param config: Dictionary of configuration parameters.
+        :param runner: Instance of class:AsyncRunner.  Defaults to meth:getRunner.
+        """
+        super(AsyncInterface, self).__init__(name, config, verify = False)
+        self.runner = runner or getRunner()
+    #---
+
+
+    @classmethod
+    async def open(cls, name, config = None, runner = None):
+        """
+        Creates an interface after checking that it exists.
+
+        :return: Instance of class:AsyncInterface.
+        """
+        interface = cls(name, config, runner)
+        await interface.setName(name)
+        return interface
+    #---
+
+
+    async def setName(self, name):
+        ip_link = await self.runner.showLink(name)
+
+        self._checkName(ip_link, name)
+        self.name = name
+    #---
+
+
+    async def getAddresses(self):
+        ip_address = await self.runner.getAddresses(self.name)
+
+        self._storeAddresses(ip_address['addresses'])
+        return ip_address['addresses']
+    #---
+
+
+    async def addAddress(self, address):
+        ip_address = await self.runner.addAddress(self.name, address)
+
+        self._checkAddress(ip_address, "%s already exists on %s" %(address,self.name))
+        self._updateAddresses(address, True)
+    #---
+
+
+    async def delAddress(self, address):
+        ip_address = await self.runner.delAddress(self.name, address)
+
+        self._checkAddress(ip_address, "%s does not exist on %s" %(address,self.name))
+        self._updateAddresses(address, False)
+    #---
+
+
+    async def _addressBatch(self, operations):
+        ip_batch = await self.runner.addressBatch([(action, self.name, address) for action, address in operations])
+
+        self._checkAddressBatch(operations, ip_batch)
+    #---
+
+
+    async def addAddresses(self, addresses):
+        await self._addressBatch([('add', address) for address in addresses])
+    #---
+
+
+    async def delAddresses(self, addresses):
+        await self._addressBatch([('del', address) for address in addresses])
+    #---
+
+
+    async def replaceAddresses(self, desired, keep_link_local = True):
+        adds, deletes = self._addressChanges(desired, await self.getAddresses(), keep_link_local)
+
+        await self._addressBatch([('del', address) for address in deletes] + [('add', address) for address in adds])
+        return adds, deletes
+    #---
+
+
+    async def up(self):
+        self._checkLinkState(await self.runner.setLinkState(self.name, True))
+    #---
+
+
+    async def down(self):
+        self._checkLinkState(await self.runner.setLinkState(self.name, False))
+    #---
+
+
+    async def status(self, simple = False):
+        iproute = await self.runner.showLink(self.name)
+
+        if iproute['return_value']:
+            raise InterfaceError("Unexpected error: %s" %iproute['stderr'])
+
+        if simple:
+            return iproute['state']
+
+        return iproute['stdout']
+    #---
+#---
+
+
+# -------- AsyncRoute --------
+
+class AsyncRoute(Route):
+    """
+    asyncio version of class:Route.
+    """
+    runner = None
+
+
+    def __init__(self, route = None, runner = None):
+        super(AsyncRoute, self).__init__(route)
+        self.runner = runner or getRunner()
+    #---
+
+
+    async def apply(self):
+        route_cfg = str(self)
+        if not route_cfg:
+            raise RouteError('Invalid routing entry (blank).')
+
+        self.validate()
+        iproute = await self.runner.ip("-%d route add %s" %(self.version(), route_cfg))
+
+        if iproute['return_value']:
+            raise RouteError("Unexpected error: %s" %iproute['stderr'])
+    #---
+#---
+
+
+# -------- AsyncRoutingTable --------
+
+class AsyncRoutingTable(RoutingTable):
+    """
+    asyncio version of class:RoutingTable.  Lookups and the prefix index are inherited unchanged.
+    """
+    runner = None
+
+
+    def __init__(self, name, description = None, routes = [], runner = None):
+        super(AsyncRoutingTable, self).__init__(name, description, routes)
+        self.runner = runner or getRunner()
+    #---
+
+
+    async def _batch(self, action, routes):
+        failures = []
+        for version, family_routes in _byVersion(action, routes):
+            for start in range(0, len(family_routes), self.batch_size):
+                chunk = family_routes[start:start + self.batch_size]
+                ip_batch = await self.runner.batch([self._command(action, route) for action, route in chunk], version)
+
+                for index in sorted(ip_batch['errors']):
+                    failures.append((chunk[index][1], ip_batch['errors'][index]))
+
+        return failures
+    #---
+
+
+    async def _liveEntries(self, versions = (ipprefix.IP_V4, ipprefix.IP_V6)):
+        """
+        Asynchronous generator of the live table's route entries (see meth:RoutingTable._liveEntries).
+
+        """
+        for version in versions:
+            family = "-%d " %version if version else ''
+            lines = self.runner.stream("%sroute list table %s" %(family, self.name))
+            entry = None
+            try:
+                async for line in lines:
+                    finished, entry = _joinLine(entry, line)
+                    if finished:
+                        yield version, finished
+                if entry:
+                    yield version, entry
+            except backend.BackendError as error:
+                if 'FIB table does not exist' not in str(error):
+                    raise RoutingTableError("Unexpected parse error: %s" %error)
+            finally:
+                await lines.aclose()
+    #---
+
+
+    async def iterRoutes(self, version = None):
+        """
+        Asynchronous generator of the routes in the live table (see meth:RoutingTable.iterRoutes).
+
+        """
+        entries = self._liveEntries((version,))
+        try:
+            async for version, entry in entries:
+                yield Route(entry, version)
+        except RouteError as error:
+            raise InvalidRouteError(str(error))
+        finally:
+            await entries.aclose()
+    #---
+
+
+    async def diff(self):
+        return self._diff(await self._liveRoutes())
+    #---
+
+
+    async def _liveRoutes(self):
+        """
+        Reads the live routes of both IP versions.
+
+        :return: List of class:Route instances.
+        """
+        return [live_route for version in (4, 6) async for live_route in self.iterRoutes(version)]
+    #---
+
+
+    async def apply(self, reconcile = False, atomic = False, scratch = None):
+        if atomic:
+            await self.swap(scratch)
+            return None
+
+        changes = None
+        if not reconcile:
+            failures = await self._batch('add', self.routes)
+        else:
+            changes = adds, deletes, replaces = await self.diff()
+            failures = await self._batch(None, [('del', route) for route in deletes] +
+                                               [('replace', route) for route in replaces] +
+                                               [('add', route) for route in adds])
+
+        if failures:
+            raise BatchError("%d of %d routes could not be applied to table %s" %(len(failures), len(self.routes),
+                                                                                  self.name), failures)
+        return changes
+    #---
+
+
+    async def swap(self, scratch = None):
+        """
+        asyncio version of meth:RoutingTable.swap.  Only the in-place swap is available: a swap through a scratch
+        table has to read and move the kernel's rules, which isn't done through the runner.
+
+        :raise AsyncError: If a scratch table is given.
+        """
+        if scratch is not None:
+            raise AsyncError("AsyncRoutingTable can't swap through a scratch table, swap table %s in place or use "
+                             "RoutingTable.swap." %self.name)
+
+        live_routes = await self._liveRoutes()
+        commands = self._swapCommands(live_routes)
+
+        failures = await self._batch(None, commands)
+        if failures:
+            undo_failures = await self._batch(None, self._swapUndo(commands, failures, live_routes))
+            raise self._swapError(commands, failures, undo_failures)
+    #---
+
+
+    async def remove(self):
+        failures = await self._batch('del', self.routes)
+
+        if failures:
+            raise BatchError("%d of %d routes could not be removed from table %s" %(len(failures), len(self.routes),
+                                                                                   self.name), failures)
+    #---
+
+
+    async def parse(self, compact = False, incremental = False):
+        if incremental:
+            if compact:
+                raise RoutingTableError("Incremental parsing keeps Route objects, it can't be combined with compact.")
+            return self._parseIncremental([entry async for entry in self._liveEntries()])
+
+        if compact:
+            # Each route goes into the store as it's read, so the Route objects are never all held at once
+            routes = routestore.RouteStore()
+            for version in (ipprefix.IP_V4, ipprefix.IP_V6):
+                async for route in self.iterRoutes(version):
+                    routes.append(route)
+        else:
+            routes = await self._liveRoutes()
+        self.routes = routes
+        self._index = None
+        self._snapshot = None
+    #---
+#---
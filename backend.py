@@ -0,0 +1,1349 @@
+#
+# $Id$
+#
+# NAME:         backend.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Pluggable backends used to talk to the kernel.  ProcessBackend forks the 'ip' command (the original behaviour),
+# PoolBackend reuses a pool of 'ip -batch' coprocesses and NetlinkBackend talks NETLINK_ROUTE directly over one
+# AF_NETLINK socket.  A single backend is selected per process with meth:setBackend and shared by every Interface,
+# Route and RoutingTable instance.
+#
+# Every backend call returns a result dictionary shaped like the one from meth:nixcommon.runProcess
+# ('return_value', 'stdout' and 'stderr'), plus any decoded data.  Return values follow the codes the 'ip' command
+# uses, so callers can keep a single set of error checks no matter which backend is active.
+#
+
+import errno
+import json
+import os
+import re
+import shlex
+import socket
+import struct
+import subprocess
+import threading
+
+from lib import nixcommon
+from . import instrument
+from . import ipjson
+from . import ippool
+
+# Return values (as reported by the 'ip' command)
+RET_OK = 0
+RET_ERROR = 1
+RET_PERMISSION = 2
+RET_EXISTS = 254
+RET_NO_DEVICE = 255
+
+
+# Exceptions
+class BackendError(Exception):
+    pass
+
+
+def result(return_value = RET_OK, stdout = '', stderr = '', **data):
+    """
+    Builds a result dictionary in the same format as meth:nixcommon.runProcess.
+
+    :param return_value: Integer return value ('ip' semantics).
+    :param stdout: Output text.
+    :param stderr: Error text.
+    :param data: Any extra, decoded data to include in the result.
+    :return: Result dictionary.
+    """
+    data.update({'return_value': return_value, 'stdout': stdout, 'stderr': stderr})
+    return data
+#---
+
+
+# -------- Backend --------
+
+class Backend(object):
+    """
+    Base class for the kernel backends.  Defines the calls every backend must answer.
+    """
+    name = None
+
+
+    def ip(self, arguments):
+        """
+        Runs an 'ip' command line.
+
+        :param arguments: Argument string to pass to the 'ip' command.
+        :return: Result dictionary.
+        """
+        raise NotImplementedError
+    #---
+
+
+    def ipStream(self, arguments):
+        """
+        Runs an 'ip' command line and yields its output as it's produced, one line at a time, so that large dumps never
+        have to be held in memory.
+
+        :param arguments: Argument string to pass to the 'ip' command.
+        :return: Generator of output lines.  Raises class:BackendError at the end of the output if the command failed.
+        """
+        raise NotImplementedError
+    #---
+
+
+    def showLink(self, name):
+        """
+        Fetches a link's status.
+
+        :param name: Interface name.
+        :return: Result dictionary, with 'state' holding the operational state of the link.
+        """
+        raise NotImplementedError
+    #---
+
+
+    def setLinkState(self, name, up):
+        """
+        Brings a link up or down.
+
+        :param name: Interface name.
+        :param up: ``True`` to bring the link up, ``False`` to bring it down.
+        :return: Result dictionary.
+        """
+        raise NotImplementedError
+    #---
+
+
+    def getAddresses(self, name):
+        """
+        Fetches the addresses assigned to a link.
+
+        :param name: Interface name.
+        :return: Result dictionary, with 'addresses' holding a dictionary of 'v4' and 'v6' (address, prefix length)
+            tuples.
+        """
+        raise NotImplementedError
+    #---
+
+
+    def addAddress(self, name, address):
+        """
+        Adds an address to a link.
+
+        :param name: Interface name.
+        :param address: String containing IP address and subnet in CIDR notation.
+        :return: Result dictionary.
+        """
+        raise NotImplementedError
+    #---
+
+
+    def delAddress(self, name, address):
+        """
+        Removes an address from a link.
+
+        :param name: Interface name.
+        :param address: String containing IP address and subnet in CIDR notation.
+        :return: Result dictionary.
+        """
+        raise NotImplementedError
+    #---
+
+
+    def getLink(self, name):
+        """
+        Fetches a link as a typed record, with its addresses and counters.
+
+        :param name: Interface name.
+        :return: Result dictionary, with 'link' holding a class:ipjson.LinkRecord (``None`` on errors).
+        """
+        raise NotImplementedError
+    #---
+
+
+    def dumpLinks(self):
+        """
+        Fetches every link on the host, with its addresses, in one go.
+
+        :return: Result dictionary, with 'links' holding a list of dictionaries (index, name, flags, mtu, state and
+            addresses, as in meth:getAddresses).
+        """
+        raise NotImplementedError
+    #---
+
+
+    def addressBatch(self, operations):
+        """
+        Adds and removes many addresses in one batch.  A failing operation never stops the ones after it.
+
+        :param operations: List of (action, interface name, address) tuples, action being 'add' or 'del'.
+        :return: Result dictionary, with 'errors' mapping the index of every failed operation to a (return value, error
+            text) tuple.
+        """
+        raise NotImplementedError
+    #---
+
+
+    def setLinksState(self, names, up):
+        """
+        Brings many links up or down in one batch.
+
+        :param names: List of interface names.
+        :param up: ``True`` to bring the links up, ``False`` to bring them down.
+        :return: Result dictionary, with 'errors' as in meth:addressBatch.
+        """
+        raise NotImplementedError
+    #---
+
+
+    def batch(self, commands, family = None):
+        """
+        Runs a list of 'ip' command lines as one batch.  A failing command never stops the commands after it.
+
+        :param commands: List of argument strings (one 'ip' command each, without the leading 'ip').
+        :param family: IP version (4 or 6) to run the batch with, for commands which don't get it from an address
+            ('ip rule').  Lines of a batch can't carry their own -4/-6.
+        :return: Result dictionary, with 'errors' mapping the index of every failed command to its error text.
+        """
+        raise NotImplementedError
+    #---
+
+
+    def close(self):
+        """
+        Releases any resources held by the backend.
+
+        """
+    #---
+#---
+
+
+# -------- ProcessBackend --------
+
+BATCH_FAILED = re.compile(r'^Command failed (?:-|.*?):(\d+)$')
+BATCH_ARGUMENT = re.compile(r'"([^"]*)"')
+
+
+def parseBatchErrors(stderr):
+    """
+    Splits the stderr of 'ip -batch' into per-command errors.  Every failed command is reported as its error text
+    followed by a 'Command failed -:<line>' marker.
+
+    :param stderr: Error output of the batch.
+    :return: Tuple of (dictionary of 1-based line number to error text, trailing error text which was not followed by a
+        marker or ``None``).  Trailing text means 'ip' exited before it could finish the batch.
+    """
+    errors = {}
+    pending = []
+    for line in stderr.splitlines():
+        failed = BATCH_FAILED.match(line)
+        if failed:
+            errors[int(failed.group(1))] = '\n'.join(pending)
+            pending = []
+        elif line.strip():
+            pending.append(line)
+
+    return errors, '\n'.join(pending) if pending else None
+#---
+
+
+def findAbortedCommand(commands, start, error_text):
+    """
+    Finds the command which made 'ip -batch' exit early, by looking for the argument quoted in its error message.
+
+    :param commands: List of batch commands.
+    :param start: Index of the first command which may have caused the abort.
+    :param error_text: Trailing error text from meth:parseBatchErrors.
+    :return: Index of the command or ``None`` if it can't be identified.
+    """
+    for argument in BATCH_ARGUMENT.findall(error_text):
+        for index in range(start, len(commands)):
+            if argument in [token.strip('"') for token in commands[index].split()]:
+                return index
+    return None
+#---
+
+
+def parseLinkState(stdout):
+    """
+    Picks the operational state out of 'ip link show' output.
+
+    :param stdout: Output of 'ip link show'.
+    :return: State string ('UP', 'DOWN', 'UNKNOWN', ...), or ``None``.
+    """
+    if 'state' not in stdout:
+        return None
+    return stdout.split('state')[1].split()[0]
+#---
+
+
+LINK_LINE = re.compile(r'^(\d+): ([^:@\s]+)(?:@\S+)?: <([^>]*)>(.*)$')
+
+
+def parseLinkLine(text):
+    """
+    Parses the first line of an 'ip link'/'ip address' entry (the same line 'ip monitor' prints for link changes).
+
+    :param text: Line such as '2: eth0: <BROADCAST,UP> mtu 1500 qdisc mq state UP ...'.
+    :return: Dictionary of index, name, flags and whichever of mtu, state, qdisc and master are present, or ``None``.
+    """
+    match = LINK_LINE.match(text)
+    if not match:
+        return None
+
+    link = {'index': int(match.group(1)), 'name': match.group(2), 'flags': match.group(3).split(',')}
+    tokens = match.group(4).split('\\')[0].split()
+    for key, value in zip(tokens[::2], tokens[1::2]):
+        if key in ('mtu', 'state', 'qdisc', 'master'):
+            link[key] = int(value) if key == 'mtu' else value
+    return link
+#---
+
+
+def parseAddressDump(stdout):
+    """
+    Parses 'ip address show' output for every link on the host.
+
+    :param stdout: Output of 'ip address show'.
+    :return: List of link dictionaries (see meth:parseLinkLine), each with 'addresses' added.
+    """
+    links = []
+    bodies = []
+    for line in stdout.splitlines():
+        link = parseLinkLine(line)
+        if link is not None:
+            links.append(link)
+            bodies.append([])
+        elif bodies:
+            bodies[-1].append(line)
+
+    for link, body in zip(links, bodies):
+        link['addresses'] = parseAddresses('\n'.join(body))
+    return links
+#---
+
+
+def parseAddresses(stdout):
+    """
+    Picks the addresses out of 'ip address show' output.
+
+    :param stdout: Output of 'ip address show'.
+    :return: Dictionary of 'v4' and 'v6' lists of (address, prefix length) tuples.
+    """
+    v4 = []
+    v6 = []
+    for info_line in stdout.strip().splitlines():
+        split_line = info_line.strip().split()
+
+        # IPv4 address
+        if split_line[0] == 'inet':
+            v4.append(tuple(split_line[1].split('/')))
+        # IPv6 address
+        elif split_line[0] == 'inet6':
+            v6.append(tuple(split_line[1].split('/')))
+
+    return {'v4': v4, 'v6': v6}
+#---
+
+
+# iproute2 version -> parser ('text' or 'json') meth:ProcessBackend.chooseParser found to be the faster one
+PARSER_CHOICES = {}
+
+
+class ProcessBackend(Backend):
+    """
+    Backend which forks the 'ip' command for every call and reads its output.  Links and addresses are read either
+    from the human readable text or, where 'ip' can print it, from JSON (see meth:parser).
+    """
+    name = 'process'
+    link_parser = None          # 'text' or 'json' to force a parser for link and address reads
+
+
+    def ip(self, arguments):
+        """
+        Runs the 'ip' command with the provided arguments.
+
+        :param arguments: Argument string to pass to the 'ip' command.
+        :return: Dictionary from meth:nixcommon.runProcess
+        """
+        if instrument.enabled:
+            return instrument.timeCommand(arguments, nixcommon.runProcess, "ip %s" %arguments)
+        return nixcommon.runProcess("ip %s" %arguments)
+    #---
+
+
+    def ipStream(self, arguments):
+        if instrument.enabled:
+            return instrument.timeStream(arguments, self._ipStream(arguments))
+        return self._ipStream(arguments)
+    #---
+
+
+    def _ipStream(self, arguments):
+        process = subprocess.Popen(['ip'] + shlex.split(arguments), stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+                                   universal_newlines = True)
+        try:
+            for line in iter(process.stdout.readline, ''):
+                yield line
+        except GeneratorExit:
+            # The caller stopped reading early
+            process.kill()
+            process.wait()
+            raise
+
+        stderr = process.stderr.read()
+        if process.wait():
+            raise BackendError("'ip %s' failed (%d): %s" %(arguments, process.returncode, stderr.strip()))
+    #---
+
+
+    def batch(self, commands, family = None):
+        errors = {}
+        stderr = ''
+        start = 0
+        options = ['-%d' %family] if family else []
+        timed = instrument.enabled
+
+        while start < len(commands):
+            if timed:
+                started = instrument.timer()
+            process = subprocess.Popen(['ip'] + options + ['-force', '-batch', '-'], stdin = subprocess.PIPE,
+                                       stdout = subprocess.PIPE, stderr = subprocess.PIPE, universal_newlines = True)
+            chunk_stdout, chunk_stderr = process.communicate(''.join("%s\n" %command for command in commands[start:]))
+            stderr += chunk_stderr
+            if timed:
+                instrument.record(instrument.COMMAND, 'batch', instrument.timer() - started,
+                                  len(chunk_stdout) + len(chunk_stderr), process.returncode)
+
+            chunk_errors, aborted_text = parseBatchErrors(chunk_stderr)
+            for line, text in chunk_errors.items():
+                errors[start + line - 1] = text
+            if aborted_text is None and process.returncode in (0, 1):
+                break
+
+            # Argument errors make 'ip' exit on the spot, even with -force.  Work out which line did it (it's the first
+            # line after the last reported failure quoting the rejected argument) and carry on after it.
+            last_failure = max(chunk_errors) if chunk_errors else 0
+            aborted_at = findAbortedCommand(commands, start + last_failure, aborted_text or '')
+            if aborted_at is None:
+                for index in range(start + last_failure, len(commands)):
+                    errors[index] = "Not applied, batch aborted: %s" %(aborted_text or process.returncode)
+                break
+            errors[aborted_at] = aborted_text
+            start = aborted_at + 1
+
+        return result(RET_ERROR if errors else RET_OK, stderr = stderr, errors = errors)
+    #---
+
+
+    def parser(self):
+        """
+        Returns the parser link and address reads go through: self.link_parser if it's set, otherwise the one
+        meth:chooseParser picked for the installed iproute2, otherwise text.  meth:showLink always reads text, as its
+        'stdout' is the status string.
+
+        :return: 'text' or 'json'.
+        """
+        if self.link_parser:
+            return self.link_parser
+        return PARSER_CHOICES.get(ipjson.iprouteVersion(), 'text')
+    #---
+
+
+    def chooseParser(self, name = 'lo', rounds = 50):
+        """
+        Times meth:getAddresses through both parsers and remembers the faster one for the installed
+        iproute2 (in PARSER_CHOICES, which every process backend goes by).
+
+        :param name: Interface to read.
+        :param rounds: Reads per parser.
+        :return: Dictionary of parser -> seconds per read, and 'choice'.
+        """
+        timings = {}
+        forced, self.link_parser = self.link_parser, None
+        try:
+            for parser in ('text', 'json') if ipjson.supportsJSON() else ('text',):
+                self.link_parser = parser
+                start = instrument.timer()
+                for round_number in range(rounds):
+                    self.getAddresses(name)
+                timings[parser] = (instrument.timer() - start) / rounds
+        finally:
+            self.link_parser = forced
+
+        timings['choice'] = PARSER_CHOICES[ipjson.iprouteVersion()] = min(timings, key = timings.get)
+        return timings
+    #---
+
+
+    def _ipJSON(self, arguments):
+        """
+        Runs 'ip -j' and decodes its output.
+
+        :return: Tuple of the result dictionary and a list of class:ipjson.LinkRecord instances.
+        """
+        ip_json = self.ip("-j %s" %arguments)
+        links = []
+        if not ip_json['return_value']:
+            try:
+                links = ipjson.parseLinks(ip_json['stdout'])
+            except ipjson.IPJSONError as error:
+                return result(RET_ERROR, ip_json['stdout'], str(error)), []
+        return ip_json, links
+    #---
+
+
+    def ipJSONStream(self, arguments):
+        """
+        Runs 'ip -j' and decodes the JSON array it prints as it's read.
+
+        :param arguments: Argument string (without -j).
+        :return: Generator of decoded array elements.
+        :raise BackendError: If 'ip' fails.
+        """
+        timed = instrument.enabled
+        if timed:
+            started = instrument.timer()
+        process = subprocess.Popen(['ip', '-j'] + shlex.split(arguments), stdout = subprocess.PIPE,
+                                   stderr = subprocess.PIPE, universal_newlines = True)
+        try:
+            for element in ipjson.iterArray(process.stdout):
+                yield element
+        except GeneratorExit:
+            process.kill()
+            process.wait()
+            raise
+        except ipjson.IPJSONError as error:
+            process.kill()
+            process.wait()
+            raise BackendError("'ip -j %s' gave bad JSON: %s" %(arguments, error))
+
+        stderr = process.stderr.read()
+        return_value = process.wait()
+        if timed:
+            # The decoder reads the output in chunks, so its size isn't counted
+            instrument.record(instrument.COMMAND, instrument.commandKind(arguments), instrument.timer() - started, 0,
+                              return_value)
+        if return_value:
+            raise BackendError("'ip -j %s' failed (%d): %s" %(arguments, return_value, stderr.strip()))
+    #---
+
+
+    def _batchResult(self, ip_batch):
+        """
+        Converts the error texts of meth:batch into (return value, text) tuples.
+
+        """
+        errors = dict((index, (ippool.returnValue(text), text)) for index, text in ip_batch['errors'].items())
+        return result(ip_batch['return_value'], stderr = ip_batch['stderr'], errors = errors)
+    #---
+
+
+    def addressBatch(self, operations):
+        return self._batchResult(self.batch(["address %s \"%s\" dev \"%s\"" %(action, address, name)
+                                             for action, name, address in operations]))
+    #---
+
+
+    def setLinksState(self, names, up):
+        return self._batchResult(self.batch(["link set \"%s\" %s" %(name, 'up' if up else 'down') for name in names]))
+    #---
+
+
+    def showLink(self, name):
+        # Always text: callers hand 'stdout' on as the link's status (the typed record is what meth:getLink is for)
+        ip_link = self.ip("link show \"%s\"" %name)
+
+        state = None
+        if not ip_link['return_value']:
+            state = parseLinkState(ip_link['stdout'])
+
+        return result(ip_link['return_value'], ip_link['stdout'], ip_link['stderr'], state = state)
+    #---
+
+
+    def setLinkState(self, name, up):
+        return self.ip("link set \"%s\" %s" %(name, 'up' if up else 'down'))
+    #---
+
+
+    def getAddresses(self, name):
+        if self.parser() == 'json':
+            ip_address, links = self._ipJSON("address show dev \"%s\"" %name)
+            return result(ip_address['return_value'], ip_address['stdout'], ip_address['stderr'],
+                          addresses = links[0].addressDict() if links else {'v4': [], 'v6': []},
+                          records = links[0].addresses if links else [])
+
+        ip_address = self.ip("address show dev \"%s\"" %name)
+
+        return result(ip_address['return_value'], ip_address['stdout'], ip_address['stderr'],
+                      addresses = parseAddresses(ip_address['stdout']))
+    #---
+
+
+    def getLink(self, name):
+        ip_address, links = self._ipJSON("-d -s address show dev \"%s\"" %name)
+        return result(ip_address['return_value'], ip_address['stdout'], ip_address['stderr'],
+                      link = links[0] if links else None)
+    #---
+
+
+    def dumpLinks(self):
+        if self.parser() == 'json':
+            try:
+                links = [ipjson.LinkRecord.fromJSON(entry).linkDict() for entry in self.ipJSONStream("address show")]
+            except BackendError as error:
+                return result(RET_ERROR, stderr = str(error), links = [])
+            return result(links = links)
+
+        ip_address = self.ip("address show")
+
+        return result(ip_address['return_value'], ip_address['stdout'], ip_address['stderr'],
+                      links = parseAddressDump(ip_address['stdout']) if not ip_address['return_value'] else [])
+    #---
+
+
+    def addAddress(self, name, address):
+        return self.ip("address add \"%s\" dev \"%s\"" %(address, name))
+    #---
+
+
+    def delAddress(self, name, address):
+        return self.ip("address del \"%s\" dev \"%s\"" %(address, name))
+    #---
+#---
+
+
+# -------- PoolBackend --------
+
+class PoolBackend(ProcessBackend):
+    """
+    Backend which sends every 'ip' command to a pool of long-lived 'ip -batch' coprocesses (see class:ippool.IPPool)
+    instead of forking a new process per call: single commands, listings, JSON reads and batches.  Only commands with
+    a global option the workers can't be started with (see meth:ippool.splitOptions) still fork.
+    """
+    name = 'pool'
+    pool = None
+    batch_chunk = 256           # Batch lines fed to a worker at once, so neither of its pipes can fill up
+
+
+    def __init__(self, size = None):
+        """
+        Constructor
+
+        :param size: Number of coprocesses in the pool.  Defaults to the IPROUTE2_POOL_SIZE environment variable, or
+            meth:ippool.IPPool.size.
+        """
+        self.pool = ippool.IPPool(size or int(os.environ.get('IPROUTE2_POOL_SIZE', 0)) or None)
+    #---
+
+
+    def ip(self, arguments):
+        if ippool.splitOptions(arguments) is None:
+            return ProcessBackend.ip(self, arguments)
+        if instrument.enabled:
+            return instrument.timeCommand(arguments, self.pool.run, arguments)
+        return self.pool.run(arguments)
+    #---
+
+
+    def _ipStream(self, arguments):
+        # A worker's output ends at its sentinel, so the listing is read whole before it's handed out
+        if ippool.splitOptions(arguments) is None:
+            for line in ProcessBackend._ipStream(self, arguments):
+                yield line
+            return
+
+        ip_list = self.pool.run(arguments)
+        if ip_list['return_value']:
+            raise BackendError("'ip %s' failed (%d): %s" %(arguments, ip_list['return_value'],
+                                                           ip_list['stderr'].strip()))
+        for line in ip_list['stdout'].splitlines(True):
+            yield line
+    #---
+
+
+    def ipJSONStream(self, arguments):
+        if ippool.splitOptions(arguments) is None:
+            for element in ProcessBackend.ipJSONStream(self, arguments):
+                yield element
+            return
+
+        ip_json = self.ip("-j %s" %arguments)
+        if ip_json['return_value']:
+            raise BackendError("'ip -j %s' failed (%d): %s" %(arguments, ip_json['return_value'],
+                                                              ip_json['stderr'].strip()))
+        try:
+            elements = json.loads(ip_json['stdout'] or '[]')
+        except ValueError as error:
+            raise BackendError("'ip -j %s' gave bad JSON: %s" %(arguments, error))
+        for element in elements:
+            yield element
+    #---
+
+
+    def batch(self, commands, family = None):
+        errors = {}
+        output = ''
+        start = 0
+        timed = instrument.enabled
+
+        with self.pool.worker(('-%d' %family,) if family else ()) as worker:
+            while start < len(commands):
+                end = min(start + self.batch_chunk, len(commands))
+                if timed:
+                    started = instrument.timer()
+                try:
+                    chunk_output, first_line, exited = worker.feed(commands[start:end])
+                except ippool.IPPoolError as error:
+                    for index in range(start, len(commands)):
+                        errors[index] = "Not applied, batch aborted: %s" %error
+                    break
+                output += chunk_output
+
+                # Errors and output share the worker's pipe, and its line numbers run on from earlier commands
+                chunk_errors, aborted_text = parseBatchErrors(chunk_output)
+                if timed:
+                    instrument.record(instrument.COMMAND, 'batch', instrument.timer() - started, len(chunk_output),
+                                      exited or (1 if chunk_errors else 0))
+                for line, text in chunk_errors.items():
+                    errors[start + line - first_line] = text
+                if exited is None:
+                    start = end
+                    continue
+
+                # 'ip' exited on an argument error: carry on after the line which did it, as meth:ProcessBackend.batch
+                last_failure = start + max(chunk_errors) - first_line + 1 if chunk_errors else start
+                aborted_at = findAbortedCommand(commands[:end], last_failure, aborted_text or '')
+                if aborted_at is None:
+                    for index in range(last_failure, len(commands)):
+                        errors[index] = "Not applied, batch aborted: %s" %(aborted_text or exited)
+                    break
+                errors[aborted_at] = aborted_text
+                start = aborted_at + 1
+
+        return result(RET_ERROR if errors else RET_OK, stderr = output, errors = errors)
+    #---
+
+
+    def close(self):
+        self.pool.close()
+    #---
+#---
+
+
+# -------- NetlinkBackend --------
+
+# Netlink message types and flags (linux/netlink.h, linux/rtnetlink.h)
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWLINK = 16
+RTM_GETLINK = 18
+RTM_SETLINK = 19
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+
+NLM_F_REQUEST = 0x1
+NLM_F_MULTI = 0x2
+NLM_F_ACK = 0x4
+NLM_F_DUMP = 0x300
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+
+# Attribute types
+IFLA_ADDRESS = 1
+IFLA_BROADCAST = 2
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+IFLA_LINK = 5
+IFLA_QDISC = 6
+IFLA_MASTER = 10
+IFLA_TXQLEN = 13
+IFLA_OPERSTATE = 16
+IFLA_LINKMODE = 17
+IFLA_GROUP = 27
+IFLA_LINK_NETNSID = 37
+IFLA_PROP_LIST = 52
+IFLA_ALT_IFNAME = 53
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+
+IFF_UP = 0x1
+IFF_POINTOPOINT = 0x10
+IFF_RUNNING = 0x40
+# In the order 'ip link show' prints them
+IFF_NAMES = ((0x8, 'LOOPBACK'), (0x2, 'BROADCAST'), (0x10, 'POINTOPOINT'), (0x1000, 'MULTICAST'), (0x80, 'NOARP'),
+             (0x200, 'ALLMULTI'), (0x100, 'PROMISC'), (0x400, 'MASTER'), (0x800, 'SLAVE'), (0x4, 'DEBUG'),
+             (0x8000, 'DYNAMIC'), (0x4000, 'AUTOMEDIA'), (0x2000, 'PORTSEL'), (0x20, 'NOTRAILERS'), (0x1, 'UP'),
+             (0x10000, 'LOWER_UP'), (0x20000, 'DORMANT'), (0x40000, 'ECHO'))
+
+NLMSGHDR = struct.Struct('=IHHII')       # length, type, flags, sequence, port id
+NLMSGERR = struct.Struct('=i')          # negated errno, followed by the offending header
+IFINFOMSG = struct.Struct('=BxHiII')    # family, type, index, flags, change
+IFADDRMSG = struct.Struct('=BBBBI')     # family, prefix length, flags, scope, index
+RTATTR = struct.Struct('=HH')           # length, type
+
+OPERSTATES = ('UNKNOWN', 'NOTPRESENT', 'DOWN', 'LOWERLAYERDOWN', 'TESTING', 'DORMANT', 'UP')
+LINK_MODES = ('DEFAULT', 'DORMANT', 'TESTING')
+# ARPHRD_* -> the name 'ip' gives the link type
+LINK_TYPES = {1: 'ether', 24: 'ieee1394', 32: 'infiniband', 512: 'ppp', 768: 'ipip', 769: 'tunnel6', 772: 'loopback',
+              776: 'sit', 778: 'gre', 801: 'ieee802.11', 823: 'gre6', 65534: 'none'}
+
+# errno -> 'ip' return value
+ERRNO_RETURN_VALUES = {
+    errno.EPERM: RET_PERMISSION,
+    errno.EACCES: RET_PERMISSION,
+    errno.EEXIST: RET_EXISTS,
+    errno.EADDRNOTAVAIL: RET_EXISTS,
+    errno.ENODEV: RET_NO_DEVICE,
+}
+
+
+def _align(length): return (length + 3) & ~3
+
+
+def packAttribute(attr_type, data):
+    """
+    Packs a single rtattr.
+
+    :param attr_type: Attribute type.
+    :param data: Attribute payload (bytes).
+    :return: Packed, padded attribute.
+    """
+    length = RTATTR.size + len(data)
+    return RTATTR.pack(length, attr_type) + data + b'\0' * (_align(length) - length)
+#---
+
+
+def unpackAttributes(data, offset = 0):
+    """
+    Unpacks a run of rtattrs.
+
+    :param data: Message payload.
+    :param offset: Offset of the first attribute.
+    :return: Dictionary of attribute type to payload.
+    """
+    attributes = {}
+    while offset + RTATTR.size <= len(data):
+        length, attr_type = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        attributes[attr_type] = data[offset + RTATTR.size:offset + length]
+        offset += _align(length)
+    return attributes
+#---
+
+
+def _cstring(data): return data.split(b'\0', 1)[0].decode('ascii')
+
+
+def _u32(data): return struct.unpack('=I', data[:4])[0]
+
+
+def _linkAddress(data):
+    """
+    Formats a link layer address the way 'ip' does: tunnels carry IP addresses, everything else is colon separated hex.
+
+    """
+    if len(data) == 4:
+        return socket.inet_ntop(socket.AF_INET, data)
+    if len(data) == 16:
+        return socket.inet_ntop(socket.AF_INET6, data)
+    return ':'.join('%02x' %byte for byte in bytearray(data))
+#---
+
+
+class NetlinkBackend(Backend):
+    """
+    Backend which talks NETLINK_ROUTE directly.  One socket is opened per process and shared by every caller.  Anything
+    which doesn't have a native implementation (route manipulation, for example) falls back to meth:ProcessBackend.
+    """
+    name = 'netlink'
+    fallback = None
+    window = 256        # Requests in flight at once in meth:_pipeline, so the acknowledgements fit the receive buffer
+
+
+    def __init__(self, fallback = None):
+        """
+        Constructor
+
+        :param fallback: Backend used for calls without a netlink implementation.  Defaults to class:ProcessBackend.
+        """
+        if not hasattr(socket, 'AF_NETLINK'):
+            raise BackendError("Netlink sockets are not supported on this platform.")
+
+        self.fallback = fallback or ProcessBackend()
+        self._lock = threading.Lock()
+        self._sock = None
+        self._pid = None
+        self._seq = 0
+    #---
+
+
+    def _socket(self):
+        """
+        Returns the netlink socket, (re)opening it when needed.  A socket inherited over fork() is never reused, as the
+        parent would be reading the same replies.
+
+        """
+        if self._sock is None or self._pid != os.getpid():
+            self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+            self._sock.bind((0, 0))
+            self._pid = os.getpid()
+        return self._sock
+    #---
+
+
+    def _request(self, msg_type, flags, payload):
+        """
+        Sends one request and collects the replies.
+
+        :param msg_type: Netlink message type.
+        :param flags: Netlink flags (NLM_F_REQUEST is always added).
+        :param payload: Packed message body.
+        :return: Tuple of (errno, list of (message type, body) replies).
+        """
+        with self._lock:
+            sock = self._socket()
+            self._seq += 1
+            seq = self._seq
+            sock.send(NLMSGHDR.pack(NLMSGHDR.size + len(payload), msg_type, flags | NLM_F_REQUEST, seq, 0) + payload)
+
+            replies = []
+            while True:
+                data = sock.recv(65536)
+                offset = 0
+                while offset + NLMSGHDR.size <= len(data):
+                    length, reply_type, reply_flags, reply_seq, pid = NLMSGHDR.unpack_from(data, offset)
+                    body = data[offset + NLMSGHDR.size:offset + length]
+                    offset += _align(length)
+
+                    if reply_seq != seq:
+                        continue
+                    if reply_type == NLMSG_DONE:
+                        return 0, replies
+                    if reply_type == NLMSG_ERROR:
+                        return -NLMSGERR.unpack_from(body)[0], replies
+
+                    replies.append((reply_type, body))
+                    if not reply_flags & NLM_F_MULTI:
+                        return 0, replies
+    #---
+
+
+    def _pipeline(self, messages):
+        """
+        Sends many requests back to back, without waiting for each acknowledgement, then collects them all.
+
+        :param messages: List of (message type, flags, payload) tuples.  NLM_F_ACK is always added.
+        :return: List of errnos, in the order of messages.
+        """
+        errors = []
+        with self._lock:
+            sock = self._socket()
+            for start in range(0, len(messages), self.window):
+                pending = {}
+                for msg_type, flags, payload in messages[start:start + self.window]:
+                    self._seq += 1
+                    pending[self._seq] = len(errors) + len(pending)
+                    sock.send(NLMSGHDR.pack(NLMSGHDR.size + len(payload), msg_type,
+                                            flags | NLM_F_REQUEST | NLM_F_ACK, self._seq, 0) + payload)
+                errors.extend([0] * len(pending))
+
+                while pending:
+                    data = sock.recv(65536)
+                    offset = 0
+                    while offset + NLMSGHDR.size <= len(data):
+                        length, reply_type, reply_flags, reply_seq, pid = NLMSGHDR.unpack_from(data, offset)
+                        body = data[offset + NLMSGHDR.size:offset + length]
+                        offset += _align(length)
+
+                        if reply_type == NLMSG_ERROR and reply_seq in pending:
+                            errors[pending.pop(reply_seq)] = -NLMSGERR.unpack_from(body)[0]
+        return errors
+    #---
+
+
+    def _result(self, error, **data):
+        """
+        Converts an errno into a result dictionary, worded the same way as 'ip'.
+
+        """
+        if not error:
+            return result(**data)
+        return result(ERRNO_RETURN_VALUES.get(error, RET_ERROR), stderr = "RTNETLINK answers: %s" %os.strerror(error),
+                      **data)
+    #---
+
+
+    def _getLink(self, name, index = 0):
+        """
+        Looks a link up by name.
+
+        :param name: Interface name.
+        :param index: Interface index to look the link up by instead (param:name is then ``None``).
+        :return: Tuple of (errno, ifinfomsg fields, attributes).
+        """
+        payload = IFINFOMSG.pack(socket.AF_UNSPEC, 0, index, 0, 0)
+        if name is not None:
+            payload += packAttribute(IFLA_IFNAME, name.encode('ascii') + b'\0')
+        error, replies = self._request(RTM_GETLINK, 0, payload)
+        if error or not replies:
+            return error or errno.ENODEV, None, None
+
+        body = replies[0][1]
+        return 0, IFINFOMSG.unpack_from(body), unpackAttributes(body, IFINFOMSG.size)
+    #---
+
+
+    def ip(self, arguments):
+        return self.fallback.ip(arguments)
+    #---
+
+
+    def ipStream(self, arguments):
+        return self.fallback.ipStream(arguments)
+    #---
+
+
+    def batch(self, commands, family = None):
+        return self.fallback.batch(commands, family)
+    #---
+
+
+    def getLink(self, name):
+        return self.fallback.getLink(name)
+    #---
+
+
+    def showLink(self, name):
+        error, info, attributes = self._getLink(name)
+        if error:
+            return self._result(error, state = None)
+
+        family, link_type, index, flags, change = info
+        state = OPERSTATES[ord(attributes.get(IFLA_OPERSTATE, b'\0')[:1])]
+        mtu = _u32(attributes[IFLA_MTU]) if IFLA_MTU in attributes else 0
+
+        return result(stdout = self._linkText(info, attributes), state = state, index = index, flags = flags,
+                      mtu = mtu)
+    #---
+
+
+    def _linkName(self, index):
+        """
+        Looks up the name of a link by index, falling back to 'if<index>' the way 'ip' does.
+
+        """
+        error, info, attributes = self._getLink(None, index)
+        if error or IFLA_IFNAME not in attributes:
+            return "if%d" %index
+        return _cstring(attributes[IFLA_IFNAME])
+    #---
+
+
+    def _linkText(self, info, attributes):
+        """
+        Renders a link the way 'ip link show' prints it, so meth:showLink's 'stdout' doesn't depend on the backend.
+
+        :param info: ifinfomsg fields.
+        :param attributes: Link attributes.
+        :return: String, ending in a newline.
+        """
+        family, link_type, index, flags, change = info
+
+        name = _cstring(attributes.get(IFLA_IFNAME, b''))
+        if IFLA_LINK in attributes:
+            peer = _u32(attributes[IFLA_LINK])
+            if not peer:
+                name += '@NONE'
+            elif IFLA_LINK_NETNSID in attributes:
+                name += '@if%d' %peer
+            else:
+                name += '@' + self._linkName(peer)
+
+        flag_names = ['NO-CARRIER'] if flags & IFF_UP and not flags & IFF_RUNNING else []
+        flag_names += [flag_name for flag, flag_name in IFF_NAMES if flags & flag]
+        text = "%d: %s: <%s>" %(index, name, ','.join(flag_names))
+
+        if IFLA_MTU in attributes:
+            text += " mtu %d" %_u32(attributes[IFLA_MTU])
+        if IFLA_QDISC in attributes:
+            text += " qdisc %s" %_cstring(attributes[IFLA_QDISC])
+        if IFLA_MASTER in attributes:
+            text += " master %s" %self._linkName(_u32(attributes[IFLA_MASTER]))
+        if IFLA_OPERSTATE in attributes:
+            text += " state %s" %OPERSTATES[ord(attributes[IFLA_OPERSTATE][:1])]
+        if IFLA_LINKMODE in attributes:
+            text += " mode %s" %LINK_MODES[ord(attributes[IFLA_LINKMODE][:1])]
+        if IFLA_GROUP in attributes:
+            group = _u32(attributes[IFLA_GROUP])
+            text += " group %s" %(group or 'default')
+        if IFLA_TXQLEN in attributes:
+            text += " qlen %d" %_u32(attributes[IFLA_TXQLEN])
+
+        text += "\n    link/%s " %LINK_TYPES.get(link_type, '[%d]' %link_type)
+        if IFLA_ADDRESS in attributes:
+            text += _linkAddress(attributes[IFLA_ADDRESS])
+        if IFLA_BROADCAST in attributes:
+            text += (" peer " if flags & IFF_POINTOPOINT else " brd ") + _linkAddress(attributes[IFLA_BROADCAST])
+        if IFLA_LINK_NETNSID in attributes:
+            text += " link-netnsid %d" %struct.unpack('=i', attributes[IFLA_LINK_NETNSID][:4])[0]
+
+        # Alternative names are a list of IFLA_ALT_IFNAME attributes, so they can't go through unpackAttributes
+        properties = attributes.get(IFLA_PROP_LIST, b'')
+        offset = 0
+        while offset + RTATTR.size <= len(properties):
+            length, attr_type = RTATTR.unpack_from(properties, offset)
+            if length < RTATTR.size:
+                break
+            if attr_type == IFLA_ALT_IFNAME:
+                text += "\n    altname %s" %_cstring(properties[offset + RTATTR.size:offset + length])
+            offset += _align(length)
+
+        return text + "\n"
+    #---
+
+
+    def setLinkState(self, name, up):
+        payload = IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, IFF_UP if up else 0, IFF_UP) + \
+                  packAttribute(IFLA_IFNAME, name.encode('ascii') + b'\0')
+        error, replies = self._request(RTM_SETLINK, NLM_F_ACK, payload)
+        return self._result(error)
+    #---
+
+
+    def getAddresses(self, name):
+        error, info, attributes = self._getLink(name)
+        if error:
+            return self._result(error, addresses = {'v4': [], 'v6': []})
+        index = info[2]
+
+        error, replies = self._request(RTM_GETADDR, NLM_F_DUMP, IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0))
+        v4 = []
+        v6 = []
+        for reply_type, body in replies:
+            family, prefix_len, flags, scope, addr_index = IFADDRMSG.unpack_from(body)
+            if addr_index != index:
+                continue
+
+            addr_attributes = unpackAttributes(body, IFADDRMSG.size)
+            address = addr_attributes.get(IFA_LOCAL, addr_attributes.get(IFA_ADDRESS))
+            if family == socket.AF_INET:
+                v4.append((socket.inet_ntop(family, address), str(prefix_len)))
+            elif family == socket.AF_INET6:
+                v6.append((socket.inet_ntop(family, address), str(prefix_len)))
+
+        return self._result(error, addresses = {'v4': v4, 'v6': v6})
+    #---
+
+
+    def dumpLinks(self):
+        error, replies = self._request(RTM_GETLINK, NLM_F_DUMP, IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0))
+        if error:
+            return self._result(error, links = [])
+
+        links = []
+        by_index = {}
+        for reply_type, body in replies:
+            family, link_type, index, flags, change = IFINFOMSG.unpack_from(body)
+            attributes = unpackAttributes(body, IFINFOMSG.size)
+            link = {'index': index, 'name': _cstring(attributes.get(IFLA_IFNAME, b'')),
+                    'flags': [flag_name for flag, flag_name in IFF_NAMES if flags & flag],
+                    'state': OPERSTATES[ord(attributes.get(IFLA_OPERSTATE, b'\0')[:1])],
+                    'addresses': {'v4': [], 'v6': []}}
+            if IFLA_MTU in attributes:
+                link['mtu'] = struct.unpack('=I', attributes[IFLA_MTU])[0]
+            links.append(link)
+            by_index[index] = link
+
+        error, replies = self._request(RTM_GETADDR, NLM_F_DUMP, IFADDRMSG.pack(socket.AF_UNSPEC, 0, 0, 0, 0))
+        for reply_type, body in replies:
+            family, prefix_len, flags, scope, index = IFADDRMSG.unpack_from(body)
+            if index not in by_index or family not in (socket.AF_INET, socket.AF_INET6):
+                continue
+
+            attributes = unpackAttributes(body, IFADDRMSG.size)
+            address = socket.inet_ntop(family, attributes.get(IFA_LOCAL, attributes.get(IFA_ADDRESS)))
+            by_index[index]['addresses']['v4' if family == socket.AF_INET else 'v6'].append((address, str(prefix_len)))
+
+        return self._result(error, links = links)
+    #---
+
+
+    def _addressPayload(self, index, address):
+        """
+        Builds the body of an RTM_NEWADDR/RTM_DELADDR request.
+
+        :return: Packed payload, or ``None`` if address isn't valid.
+        """
+        ip, prefix_len = (address.split('/', 1) + [None])[:2]
+        family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+        try:
+            packed = socket.inet_pton(family, ip)
+        except socket.error:
+            return None
+        if prefix_len is None:
+            prefix_len = len(packed) * 8
+
+        return IFADDRMSG.pack(family, int(prefix_len), 0, 0, index) + packAttribute(IFA_LOCAL, packed) + \
+               packAttribute(IFA_ADDRESS, packed)
+    #---
+
+
+    def _address(self, msg_type, flags, name, address):
+        """
+        Builds and sends an RTM_NEWADDR/RTM_DELADDR request.
+
+        """
+        error, info, attributes = self._getLink(name)
+        if error:
+            return self._result(error)
+
+        payload = self._addressPayload(info[2], address)
+        if payload is None:
+            return result(RET_ERROR, stderr = "Error: any valid prefix is expected rather than \"%s\"." %address)
+
+        error, replies = self._request(msg_type, flags | NLM_F_ACK, payload)
+        return self._result(error)
+    #---
+
+
+    def addAddress(self, name, address):
+        return self._address(RTM_NEWADDR, NLM_F_CREATE | NLM_F_EXCL, name, address)
+    #---
+
+
+    def delAddress(self, name, address):
+        return self._address(RTM_DELADDR, 0, name, address)
+    #---
+
+
+    def _pipelineResult(self, messages, errors):
+        """
+        Sends the messages which could be built and merges their errnos with the errors found while building them.
+
+        :param messages: List of (message type, flags, payload) tuples, ``None`` where errors already has an entry.
+        :param errors: Dictionary of index -> (return value, text) for the messages which couldn't be built.
+        :return: Result dictionary, as meth:Backend.addressBatch.
+        """
+        indexes = [index for index, message in enumerate(messages) if message is not None]
+        for index, error in zip(indexes, self._pipeline([messages[index] for index in indexes])):
+            if error:
+                errors[index] = (ERRNO_RETURN_VALUES.get(error, RET_ERROR), "RTNETLINK answers: %s" %os.strerror(error))
+
+        return result(RET_ERROR if errors else RET_OK, errors = errors)
+    #---
+
+
+    def addressBatch(self, operations):
+        links = {}
+        messages = []
+        errors = {}
+        for action, name, address in operations:
+            if name not in links:
+                error, info, attributes = self._getLink(name)
+                links[name] = (error, info[2] if not error else None)
+            error, index = links[name]
+            if error:
+                errors[len(messages)] = (ERRNO_RETURN_VALUES.get(error, RET_ERROR),
+                                         "RTNETLINK answers: %s" %os.strerror(error))
+                messages.append(None)
+                continue
+
+            payload = self._addressPayload(index, address)
+            if payload is None:
+                errors[len(messages)] = (RET_ERROR, "Error: any valid prefix is expected rather than \"%s\"." %address)
+                messages.append(None)
+            elif action == 'add':
+                messages.append((RTM_NEWADDR, NLM_F_CREATE | NLM_F_EXCL, payload))
+            else:
+                messages.append((RTM_DELADDR, 0, payload))
+
+        return self._pipelineResult(messages, errors)
+    #---
+
+
+    def setLinksState(self, names, up):
+        messages = [(RTM_SETLINK, 0, IFINFOMSG.pack(socket.AF_UNSPEC, 0, 0, IFF_UP if up else 0, IFF_UP) +
+                     packAttribute(IFLA_IFNAME, name.encode('ascii') + b'\0')) for name in names]
+        return self._pipelineResult(messages, {})
+    #---
+
+
+    def close(self):
+        with self._lock:
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+        self.fallback.close()
+    #---
+#---
+
+
+# -------- Backend selection --------
+
+BACKENDS = {
+    ProcessBackend.name: ProcessBackend,
+    PoolBackend.name: PoolBackend,
+    NetlinkBackend.name: NetlinkBackend,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def setBackend(new_backend):
+    """
+    Selects the backend used by this process.  The previous backend is closed.
+
+    :param new_backend: Backend name (see BACKENDS) or an instance of class:Backend.
+    :return: The active backend.
+    """
+    global _backend
+
+    if not isinstance(new_backend, Backend):
+        if new_backend not in BACKENDS:
+            raise BackendError("Unknown backend: %s" %new_backend)
+        new_backend = BACKENDS[new_backend]()
+
+    with _backend_lock:
+        old_backend, _backend = _backend, new_backend
+
+    if old_backend is not None and old_backend is not new_backend:
+        old_backend.close()
+
+    return new_backend
+#---
+
+
+def getBackend():
+    """
+    Returns the active backend, creating the default one on first use.  The default can be chosen with the
+    IPROUTE2_BACKEND environment variable, and is otherwise 'process'.
+
+    :return: Instance of class:Backend.
+    """
+    global _backend
+
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = BACKENDS[os.environ.get('IPROUTE2_BACKEND', ProcessBackend.name)]()
+    return _backend
+#---
@@ -0,0 +1,534 @@
+#
+# $Id$
+#
+# NAME:         benchmark.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Benchmarks of the library's hot paths: route grammar throughput, prefix validation, interface reads and routing
+# table applies.  Nothing touches the kernel: 'ip' is replaced by a stub (see class:StubIP) which logs the commands
+# it gets and answers from canned output, so the suite runs anywhere, without root.  Every case runs in a process of
+# its own, so its peak RSS can be reported, and the results are written as JSON to be compared across commits:
+#
+#     python -m lib.iproute2.benchmark --output new.json --compare old.json
+#
+#   Times include the start-up of the stub for every forked 'ip', so they only mean something next to results from
+# the same machine.
+#
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from . import backend
+from . import instrument
+from . import routegrammar
+from . import routingtable
+from .interface import Interface
+from .route import Route
+
+STUB_VERSION = 'ip utility, iproute2-6.1.0'
+STUB_TABLE = '4242'
+CASE_TIMEOUT = 600           # Seconds a case process gets before it's counted as hung
+
+# 'ip' stand-in.  Answers are looked up by the argument list (joined with spaces) in the fixture; anything it doesn't
+# know succeeds silently, like most 'ip' changes do.  Batch lines are looked up the same way.
+STUB_SCRIPT = '''#!%(python)s -SE
+import json, os, sys
+
+with open(os.environ['IPROUTE2_STUB_FIXTURE']) as fixture_file:
+    fixture = json.load(fixture_file)
+
+arguments = sys.argv[1:]
+log = [' '.join(arguments)]
+return_value = 0
+if arguments[-3:] == ['-force', '-batch', '-']:
+    for number, line in enumerate(sys.stdin, 1):
+        line = line.strip()
+        log.append('> ' + line)
+        line_value, stdout, stderr = fixture.get(line, (0, '', ''))
+        sys.stdout.write(stdout)
+        if line_value:
+            sys.stderr.write('%%sCommand failed -:%%d\\n' %%(stderr, number))
+            return_value = 1
+else:
+    return_value, stdout, stderr = fixture.get(log[0], (0, '', ''))
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+
+with open(os.environ['IPROUTE2_STUB_LOG'], 'a') as log_file:
+    log_file.write(''.join('%%s\\n' %%line for line in log))
+sys.exit(return_value)
+'''
+
+
+# Exceptions
+class BenchmarkError(Exception):
+    pass
+
+
+# -------- Stub 'ip' --------
+
+class StubIP(object):
+    """
+    A stub 'ip' executable in a directory of its own, put first on PATH.  Subprocesses started after meth:install
+    (including the benchmark processes) get the stub instead of the real command.
+    """
+    directory = None
+
+
+    def __init__(self):
+        """
+        Constructor
+
+        """
+        self.directory = tempfile.mkdtemp(prefix = 'iproute2-bench-')
+        self.fixture_path = os.path.join(self.directory, 'fixture.json')
+        self.log_path = os.path.join(self.directory, 'commands.log')
+
+        stub_path = os.path.join(self.directory, 'ip')
+        with open(stub_path, 'w') as stub_file:
+            stub_file.write(STUB_SCRIPT %{'python': sys.executable})
+        os.chmod(stub_path, 0o755)
+
+        self.answers = {'-V': (0, STUB_VERSION + '\n', '')}
+        self.save()
+    #---
+
+
+    def install(self):
+        os.environ['PATH'] = self.directory + os.pathsep + os.environ.get('PATH', '')
+        os.environ['IPROUTE2_STUB_FIXTURE'] = self.fixture_path
+        os.environ['IPROUTE2_STUB_LOG'] = self.log_path
+    #---
+
+
+    def answer(self, arguments, stdout = '', stderr = '', return_value = 0):
+        """
+        Sets the canned output for a command line (call meth:save once done).
+
+        :param arguments: Argument string as 'ip' gets it, after shell unquoting ('link show eth0').
+        """
+        self.answers[arguments] = (return_value, stdout, stderr)
+    #---
+
+
+    def save(self):
+        with open(self.fixture_path, 'w') as fixture_file:
+            json.dump(self.answers, fixture_file)
+    #---
+
+
+    def commands(self):
+        """
+        Returns the command lines the stub got so far (batch lines start with '> ').
+
+        """
+        try:
+            with open(self.log_path) as log_file:
+                return log_file.read().splitlines()
+        except IOError:
+            return []
+    #---
+
+
+    def reset(self):
+        """
+        Forgets the canned output and the command log.
+
+        """
+        self.answers = {'-V': (0, STUB_VERSION + '\n', '')}
+        self.save()
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+    #---
+
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors = True)
+    #---
+#---
+
+
+# -------- Synthetic data --------
+
+def routeLines(count, table = None):
+    """
+    Generates 'ip route' output lines for count routes: mostly plain IPv4 routes, with every fifth route an ECMP route
+    (printed over three lines, as 'ip' does) and every seventh an IPv6 route.
+
+    :param table: Table to name in every route ('ip' leaves it out for main).
+    :return: Generator of lines.
+    """
+    table_text = " table %s" %table if table else ''
+    for number in range(count):
+        if number % 7 == 6:
+            yield "2001:db8:%x:%x::/64 via fe80::1 dev eth0%s proto bgp metric 1024 pref medium\n" \
+                  %(number >> 16, number & 0xffff, table_text)
+        elif number % 5 == 4:
+            yield "10.%d.%d.%d%s proto bgp metric 20 \n" %(number >> 16 & 0xff, number >> 8 & 0xff, number & 0xff,
+                                                           table_text)
+            yield "\tnexthop via 192.0.2.1 dev eth0 weight 1 \n"
+            yield "\tnexthop via 192.0.2.2 dev eth1 weight 1 \n"
+        else:
+            yield "%d.%d.%d.0/24 via 192.0.2.1 dev eth0%s proto static metric 100 \n" \
+                  %(11 + (number >> 16) % 200, number >> 8 & 0xff, number & 0xff, table_text)
+#---
+
+
+def prefixes(count):
+    """
+    Builds count distinct prefixes, IPv4 and IPv6, with a 'default' now and then.
+
+    """
+    result = []
+    for number in range(count):
+        if number % 100 == 99:
+            result.append('default')
+        elif number % 3 == 2:
+            result.append("2001:db8:%x:%x::/64" %(number >> 16, number & 0xffff))
+        else:
+            result.append("%d.%d.%d.0/24" %(11 + (number >> 16) % 200, number >> 8 & 0xff, number & 0xff))
+    return result
+#---
+
+
+# -------- Cases --------
+#   Each case takes the stub and a size and does its setup, then returns the function to time.  That function returns
+# the number of items it went through.
+
+def caseRouteGrammar(stub, size):
+    """
+    Runs class:routegrammar.ROUTE over a synthetic dump of size routes.  The dump is generated as it's parsed (so
+    memory is the parser's alone), which adds about a microsecond per route.
+
+    """
+    def run():
+        count = 0
+        for entry in routingtable._joinEntries(routeLines(size)):
+            routegrammar.ROUTE(entry.split())
+            count += 1
+        return count
+    return run
+#---
+
+
+def caseValidatePrefix(stub, size):
+    """
+    Runs meth:routegrammar.NODE_SPEC.validatePrefix over size distinct prefixes.
+
+    """
+    node_spec = routegrammar.NODE_SPEC(['default'])
+    items = prefixes(size)
+
+    def run():
+        for prefix in items:
+            error_txt = node_spec.validatePrefix(prefix)
+            if error_txt:
+                raise BenchmarkError("%s failed validation: %s" %(prefix, error_txt))
+        return len(items)
+    return run
+#---
+
+
+def caseInterfaces(stub, size):
+    """
+    Builds size class:Interface objects and reads their addresses (two 'ip' runs each).
+
+    """
+    names = ["bench%d" %number for number in range(size)]
+    for index, name in enumerate(names, 2):
+        link = "%d: %s: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500 qdisc noqueue state UP mode DEFAULT group default " \
+               "qlen 1000\n    link/ether 02:00:00:00:%02x:%02x brd ff:ff:ff:ff:ff:ff\n" \
+               %(index, name, index >> 8 & 0xff, index & 0xff)
+        addresses = "    inet 10.%d.%d.1/24 brd 10.%d.%d.255 scope global %s\n       valid_lft forever preferred_lft " \
+                    "forever\n    inet6 fd00::%x/64 scope global \n       valid_lft forever preferred_lft forever\n" \
+                    %(index >> 8 & 0xff, index & 0xff, index >> 8 & 0xff, index & 0xff, name, index)
+        stub.answer("link show %s" %name, link)
+        stub.answer("address show dev %s" %name, link + addresses)
+    stub.save()
+
+    def run():
+        for name in names:
+            Interface(name).getAddresses()
+        return len(names)
+    return run
+#---
+
+
+def _tableRoutes(size):
+    return [Route(entry) for entry in routingtable._joinEntries(routeLines(size))]
+#---
+
+
+def caseTableApply(stub, size):
+    """
+    meth:routingtable.RoutingTable.apply of a table of size routes (the writes go to the stub).
+
+    """
+    table = routingtable.RoutingTable(STUB_TABLE, routes = _tableRoutes(size))
+
+    def run():
+        table.apply()
+        return len(table.routes)
+    return run
+#---
+
+
+def caseTableReconcile(stub, size):
+    """
+    Reconciling meth:routingtable.RoutingTable.apply of a table of size routes which is already in sync: reads and
+    parses the live table, then pushes nothing.
+
+    """
+    routes = _tableRoutes(size)
+    for version in (4, 6):
+        stub.answer("-%d route list table %s" %(version, STUB_TABLE),
+                    ''.join(route.render(STUB_TABLE) + '\n' for route in routes if route.version() == version))
+    stub.save()
+    table = routingtable.RoutingTable(STUB_TABLE, routes = routes)
+
+    def run():
+        adds, deletes, replaces = table.apply(reconcile = True)
+        if adds or deletes or replaces:
+            raise BenchmarkError("Table out of sync: %d adds, %d deletes, %d replaces"
+                                 %(len(adds), len(deletes), len(replaces)))
+        return len(table.routes)
+    return run
+#---
+
+
+# Case name -> (setup function, default sizes)
+CASES = {'route_grammar': (caseRouteGrammar, (10000, 100000, 1000000)),
+         'validate_prefix': (caseValidatePrefix, (10000, 100000, 1000000)),
+         'interfaces': (caseInterfaces, (10, 100)),
+         'table_apply': (caseTableApply, (1000, 10000)),
+         'table_reconcile': (caseTableReconcile, (1000, 10000))}
+CASE_ORDER = ('route_grammar', 'validate_prefix', 'interfaces', 'table_apply', 'table_reconcile')
+
+
+# -------- Running --------
+
+def _runCase(stub, name, size, results):
+    """
+    Runs one case (in a process of its own) and puts its measurements on the results queue.
+
+    """
+    try:
+        backend.setBackend(backend.ProcessBackend())
+        stub.reset()
+        run = CASES[name][0](stub, size)
+
+        start = instrument.timer()
+        items = run()
+        seconds = instrument.timer() - start
+
+        # ru_maxrss is in kilobytes on Linux, bytes on macOS
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            peak_rss //= 1024
+        results.put({'seconds': seconds, 'items': items, 'peak_rss_kb': peak_rss,
+                     'ip_commands': len(stub.commands())})
+    except Exception as error:
+        results.put({'error': "%s: %s" %(type(error).__name__, error)})
+#---
+
+
+def runCase(stub, name, size, repeat = 1, timeout = CASE_TIMEOUT):
+    """
+    Times a case, repeat times, each in a fresh process.  A process that dies without reporting (killed, out of
+    memory) or runs longer than param:timeout seconds gives an 'error' result instead of hanging the run.
+
+    :return: Result dictionary: the best time (and the per item time it gives), the highest peak RSS, the number of
+        commands 'ip' got, or 'error'.
+    """
+    best = None
+    for round_number in range(repeat):
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target = _runCase, args = (stub, name, size, results))
+        process.start()
+        measured = _waitCase(process, results, timeout)
+        process.join()
+
+        if 'error' in measured:
+            return {'case': name, 'size': size, 'error': measured['error']}
+        if best is None:
+            best = measured
+        else:
+            best['peak_rss_kb'] = max(best['peak_rss_kb'], measured['peak_rss_kb'])
+            best['seconds'] = min(best['seconds'], measured['seconds'])
+
+    best.update(case = name, size = size, per_item_us = best['seconds'] * 1e6 / max(best['items'], 1))
+    return best
+#---
+
+
+def _waitCase(process, results, timeout):
+    """
+    Waits for the measurements of a case process.
+
+    :return: Measurement dictionary, or one holding 'error' if the process died or timed out first.
+    """
+    deadline = instrument.timer() + timeout
+    while True:
+        try:
+            return results.get(timeout = 1)
+        except queue.Empty:
+            pass
+
+        if not process.is_alive():
+            # It may have reported just before exiting
+            try:
+                return results.get(timeout = 1)
+            except queue.Empty:
+                return {'error': "Case process exited with code %s" %process.exitcode}
+        if instrument.timer() > deadline:
+            process.terminate()
+            return {'error': "Case timed out after %s seconds" %timeout}
+#---
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd = os.path.dirname(os.path.abspath(__file__)),
+                                       stderr = subprocess.STDOUT, universal_newlines = True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+#---
+
+
+def runAll(cases = CASE_ORDER, sizes = None, repeat = 1, progress = None, timeout = CASE_TIMEOUT):
+    """
+    Runs benchmark cases against a stub 'ip'.
+
+    :param cases: Names of the cases to run (see CASES).
+    :param sizes: Sizes to run every case at.  Defaults to each case's own sizes.
+    :param repeat: Runs per case and size (the best time is kept).
+    :param progress: Optional function called with each result as it comes in.
+    :param timeout: Seconds each case process gets (see meth:runCase).
+    :return: Dictionary of 'meta' (commit, Python, platform, time) and 'results' (list of result dictionaries).
+    """
+    for name in cases:
+        if name not in CASES:
+            raise BenchmarkError("Unknown case: %s" %name)
+
+    stub = StubIP()
+    saved_environment = dict(os.environ)
+    stub.install()
+    try:
+        results = []
+        for name in cases:
+            for size in sizes or CASES[name][1]:
+                results.append(runCase(stub, name, size, repeat, timeout))
+                if progress:
+                    progress(results[-1])
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_environment)
+        stub.remove()
+
+    meta = {'commit': _commit(), 'python': platform.python_version(),
+            'implementation': platform.python_implementation(), 'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'repeat': repeat}
+    return {'meta': meta, 'results': results}
+#---
+
+
+def compare(old, new, threshold = 0.1):
+    """
+    Compares two benchmark outputs, case by case.
+
+    :param old: Output of meth:runAll (decoded from JSON) to compare against.
+    :param new: Output of meth:runAll.
+    :param threshold: Slowdown (as a fraction) above which a case counts as a regression.
+    :return: List of (case, size, old seconds, new seconds, change as a fraction, regressed) tuples, for the cases
+        both outputs have.
+    """
+    old_results = dict(((result['case'], result['size']), result) for result in old['results'] if 'error' not in result)
+
+    changes = []
+    for result in new['results']:
+        old_result = old_results.get((result['case'], result['size']))
+        if old_result is None or 'error' in result:
+            continue
+        change = result['seconds'] / old_result['seconds'] - 1 if old_result['seconds'] else 0.0
+        changes.append((result['case'], result['size'], old_result['seconds'], result['seconds'], change,
+                        change > threshold))
+    return changes
+#---
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmarks python-iproute2 against a stub 'ip' command.")
+    parser.add_argument('--case', action = 'append', choices = CASE_ORDER,
+                        help = "Case to run (repeatable, default: all)")
+    parser.add_argument('--sizes', help = "Comma separated sizes to run every case at (default: each case's own)")
+    parser.add_argument('--repeat', type = int, default = 1, help = "Runs per case, the best time is kept")
+    parser.add_argument('--timeout', type = float, default = CASE_TIMEOUT,
+                        help = "Seconds a case process gets before it's counted as hung (default: %d)" %CASE_TIMEOUT)
+    parser.add_argument('--output', help = "Write the results to this JSON file (default: standard output)")
+    parser.add_argument('--compare', help = "JSON results of an earlier run to compare with")
+    parser.add_argument('--threshold', type = float, default = 0.1,
+                        help = "Slowdown counted as a regression by --compare (default: 0.1, ten percent)")
+    arguments = parser.parse_args(argv)
+
+    def progress(result):
+        if 'error' in result:
+            sys.stderr.write("%-16s %9d  error: %s\n" %(result['case'], result['size'], result['error']))
+        else:
+            sys.stderr.write("%-16s %9d  %9.3f s  %9.2f us/item  %8d KB peak\n"
+                             %(result['case'], result['size'], result['seconds'], result['per_item_us'],
+                               result['peak_rss_kb']))
+
+    sizes = [int(size) for size in arguments.sizes.split(',')] if arguments.sizes else None
+    output = runAll(arguments.case or CASE_ORDER, sizes, arguments.repeat, progress, arguments.timeout)
+
+    if arguments.output:
+        with open(arguments.output, 'w') as output_file:
+            json.dump(output, output_file, indent = 2, sort_keys = True)
+    else:
+        json.dump(output, sys.stdout, indent = 2, sort_keys = True)
+        sys.stdout.write('\n')
+
+    failed = any('error' in result for result in output['results'])
+    if arguments.compare:
+        with open(arguments.compare) as old_file:
+            changes = compare(json.load(old_file), output, arguments.threshold)
+        for case, size, old_seconds, new_seconds, change, regressed in changes:
+            flag = '  REGRESSION' if regressed else ''
+            sys.stderr.write("%-16s %9d  %9.3f s -> %9.3f s  %+7.1f%%%s\n" %(case, size, old_seconds, new_seconds,
+                                                                         change * 100, flag))
+        failed = failed or any(change[-1] for change in changes)
+
+    return 1 if failed else 0
+#---
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,378 @@
+#
+# $Id$
+#
+# NAME:         instrument.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Instrumentation of the 'ip' commands the library runs and of the route grammar.  Once meth:enable is called, every
+# 'ip' run (plain, streamed or batched, from any backend) and every child node built by meth:ParseNode.addChildren is
+# reported as an class:Event to the registered sinks:
+#
+#     registry = instrument.PrometheusSink()
+#     instrument.enable(registry)
+#     ...
+#     print(registry.render())
+#
+#   Commands are grouped by kind ('link show', 'route add', 'batch'...), so a high-level call which turns into one
+# 'ip' run per route or interface stands out.  While disabled (the default), the hooks cost one attribute check.
+#
+
+import collections
+import socket
+import threading
+import time
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# 'ip' abbreviations, so 'addr show' and 'address list' count as the same kind
+KIND_ALIASES = {'addr': 'address', 'a': 'address', 'l': 'link', 'r': 'route', 'ro': 'route', 'list': 'show',
+                'ls': 'show', 'lst': 'show', 'sh': 'show'}
+
+COMMAND = 'command'
+PARSE = 'parse'
+
+# One instrumented operation.  type is COMMAND or PARSE; name is the command kind or the grammar node class; size is
+# the bytes of output read (commands) or the tokens handed to the node (parses); return_value is the 'ip' return value.
+Event = collections.namedtuple('Event', 'type name seconds size return_value')
+
+# Clock the timings are taken with: time.perf_counter where there is one (Python 3.3 and later)
+timer = getattr(time, 'perf_counter', time.time)
+
+enabled = False
+_sinks = []
+_sinks_lock = threading.Lock()
+
+
+# -------- Sinks --------
+
+class Sink(object):
+    """
+    Receives instrumentation events.  Sinks may be called from several threads at once.
+    """
+
+    def record(self, event):
+        """
+        Handles an event.
+
+        :param event: Instance of class:Event.
+        """
+        raise NotImplementedError
+    #---
+#---
+
+
+class CallbackSink(Sink):
+    """
+    Hands every event to a function.
+    """
+
+    def __init__(self, callback):
+        """
+        Constructor
+
+        :param callback: Function taking an class:Event.
+        """
+        self.callback = callback
+    #---
+
+
+    def record(self, event):
+        self.callback(event)
+    #---
+#---
+
+
+class StatsdSink(Sink):
+    """
+    Sends every event to a statsd server, as one UDP datagram: a call counter, a latency timer, a byte counter and a
+    per return value error counter for commands ('iproute2.command.route_add.calls:1|c', ...), a timer for parses
+    ('iproute2.parse.NODE_SPEC:0.012|ms').  Send errors are ignored, as statsd is fire and forget.
+    """
+
+    def __init__(self, host = '127.0.0.1', port = 8125, prefix = 'iproute2'):
+        """
+        Constructor
+
+        :param prefix: Prefix of every metric name.
+        """
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    #---
+
+
+    def lines(self, event):
+        """
+        Renders an event as statsd lines.
+
+        """
+        name = "%s.%s.%s" %(self.prefix, event.type, event.name.replace(' ', '_'))
+        milliseconds = event.seconds * 1000
+        if event.type == PARSE:
+            return ["%s:%.3f|ms" %(name, milliseconds)]
+
+        lines = ["%s.calls:1|c" %name, "%s.latency:%.3f|ms" %(name, milliseconds), "%s.bytes:%d|c" %(name, event.size)]
+        if event.return_value:
+            lines.append("%s.errors.%d:1|c" %(name, event.return_value))
+        return lines
+    #---
+
+
+    def record(self, event):
+        try:
+            self.socket.sendto('\n'.join(self.lines(event)).encode(), self.address)
+        except (socket.error, OSError):
+            pass
+    #---
+
+
+    def close(self):
+        self.socket.close()
+    #---
+#---
+
+
+class PrometheusSink(Sink):
+    """
+    Aggregates events in memory: per command kind call counts, latency histograms, bytes read and return value tallies,
+    and per grammar node parse counts and times.  meth:render gives them in the Prometheus text format, for a scrape
+    endpoint; meth:snapshot as plain dictionaries.
+    """
+
+    def __init__(self, prefix = 'iproute2'):
+        """
+        Constructor
+
+        :param prefix: Prefix of every metric name.
+        """
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.reset()
+    #---
+
+
+    def reset(self):
+        with self._lock:
+            self.calls = collections.Counter()
+            self.bytes = collections.Counter()
+            self.errors = collections.Counter()         # (kind, return value) -> count
+            self.seconds = collections.Counter()
+            self.buckets = {}                           # kind -> list of counts, one per LATENCY_BUCKETS entry
+            self.parse_calls = collections.Counter()
+            self.parse_seconds = collections.Counter()
+    #---
+
+
+    def record(self, event):
+        with self._lock:
+            if event.type == PARSE:
+                self.parse_calls[event.name] += 1
+                self.parse_seconds[event.name] += event.seconds
+                return
+
+            self.calls[event.name] += 1
+            self.bytes[event.name] += event.size
+            self.seconds[event.name] += event.seconds
+            if event.return_value:
+                self.errors[(event.name, event.return_value)] += 1
+
+            buckets = self.buckets.get(event.name)
+            if buckets is None:
+                buckets = self.buckets[event.name] = [0] * len(LATENCY_BUCKETS)
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if event.seconds <= bound:
+                    buckets[index] += 1
+                    break
+    #---
+
+
+    def snapshot(self):
+        """
+        Returns the aggregated metrics.
+
+        :return: Dictionary of 'commands' (kind -> dictionary of calls, seconds, bytes, errors by return value and
+            latency buckets as (upper bound, count) tuples) and 'parses' (node name -> dictionary of calls and seconds).
+        """
+        with self._lock:
+            commands = {}
+            for kind in self.calls:
+                commands[kind] = {'calls': self.calls[kind], 'seconds': self.seconds[kind], 'bytes': self.bytes[kind],
+                                  'errors': dict((return_value, count) for (error_kind, return_value), count
+                                                 in self.errors.items() if error_kind == kind),
+                                  'buckets': list(zip(LATENCY_BUCKETS, self.buckets[kind]))}
+            parses = dict((name, {'calls': self.parse_calls[name], 'seconds': self.parse_seconds[name]})
+                          for name in self.parse_calls)
+        return {'commands': commands, 'parses': parses}
+    #---
+
+
+    def render(self):
+        """
+        Renders the metrics in the Prometheus text exposition format.
+
+        """
+        snapshot = self.snapshot()
+        prefix = self.prefix
+        lines = ["# HELP %s_commands_total 'ip' commands run, by kind." %prefix,
+                 "# TYPE %s_commands_total counter" %prefix]
+        for kind, metrics in sorted(snapshot['commands'].items()):
+            lines.append('%s_commands_total{kind="%s"} %d' %(prefix, kind, metrics['calls']))
+
+        lines += ["# HELP %s_command_bytes_total Bytes of 'ip' output read, by kind." %prefix,
+                  "# TYPE %s_command_bytes_total counter" %prefix]
+        for kind, metrics in sorted(snapshot['commands'].items()):
+            lines.append('%s_command_bytes_total{kind="%s"} %d' %(prefix, kind, metrics['bytes']))
+
+        lines += ["# HELP %s_command_errors_total Failed 'ip' commands, by kind and return value." %prefix,
+                  "# TYPE %s_command_errors_total counter" %prefix]
+        for kind, metrics in sorted(snapshot['commands'].items()):
+            for return_value, count in sorted(metrics['errors'].items()):
+                lines.append('%s_command_errors_total{kind="%s",code="%d"} %d' %(prefix, kind, return_value, count))
+
+        lines += ["# HELP %s_command_seconds 'ip' command latency, by kind." %prefix,
+                  "# TYPE %s_command_seconds histogram" %prefix]
+        for kind, metrics in sorted(snapshot['commands'].items()):
+            total = 0
+            for bound, count in metrics['buckets']:
+                total += count
+                lines.append('%s_command_seconds_bucket{kind="%s",le="%g"} %d' %(prefix, kind, bound, total))
+            lines += ['%s_command_seconds_bucket{kind="%s",le="+Inf"} %d' %(prefix, kind, metrics['calls']),
+                      '%s_command_seconds_sum{kind="%s"} %.6f' %(prefix, kind, metrics['seconds']),
+                      '%s_command_seconds_count{kind="%s"} %d' %(prefix, kind, metrics['calls'])]
+
+        lines += ["# HELP %s_parse_seconds_total Time spent building grammar nodes, by node." %prefix,
+                  "# TYPE %s_parse_seconds_total counter" %prefix]
+        for name, metrics in sorted(snapshot['parses'].items()):
+            lines.append('%s_parse_seconds_total{node="%s"} %.6f' %(prefix, name, metrics['seconds']))
+        lines += ["# HELP %s_parses_total Grammar nodes built, by node." %prefix,
+                  "# TYPE %s_parses_total counter" %prefix]
+        for name, metrics in sorted(snapshot['parses'].items()):
+            lines.append('%s_parses_total{node="%s"} %d' %(prefix, name, metrics['calls']))
+
+        return '\n'.join(lines) + '\n'
+    #---
+#---
+
+
+# -------- Switching on and off --------
+
+def enable(*sinks):
+    """
+    Adds sinks and turns instrumentation on.
+
+    :param sinks: Instances of class:Sink.
+    """
+    global enabled, _sinks
+
+    with _sinks_lock:
+        # Copy on write, so meth:record never needs the lock
+        _sinks = _sinks + [sink for sink in sinks if sink not in _sinks]
+        enabled = bool(_sinks)
+#---
+
+
+def disable(sink = None):
+    """
+    Removes a sink, or all of them, turning instrumentation off once none are left.
+
+    :param sink: Sink to remove.  Defaults to all of them.
+    """
+    global enabled, _sinks
+
+    with _sinks_lock:
+        _sinks = [] if sink is None else [kept for kept in _sinks if kept is not sink]
+        enabled = bool(_sinks)
+#---
+
+
+# -------- Hooks --------
+#   Called by the backends and the grammar, only while enabled is set.
+
+def commandKind(arguments):
+    """
+    Names the kind of an 'ip' command: its object and action, without options or operands ('route add',
+    'link show'), or 'batch'.
+
+    :param arguments: Argument string or list, without the leading 'ip'.
+    """
+    tokens = arguments.split() if isinstance(arguments, str) else arguments
+    if '-batch' in tokens:
+        return 'batch'
+
+    words = []
+    for token in tokens:
+        if token.startswith('-'):
+            continue
+        words.append(KIND_ALIASES.get(token, token))
+        if len(words) == 2:
+            break
+    return ' '.join(words)
+#---
+
+
+def record(event_type, name, seconds, size = 0, return_value = 0):
+    """
+    Reports an event to every sink.
+
+    """
+    event = Event(event_type, name, seconds, size, return_value)
+    for sink in _sinks:
+        sink.record(event)
+#---
+
+
+def timeCommand(arguments, function, *args):
+    """
+    Runs a function returning an 'ip' result dictionary and reports it as a command.
+
+    :param arguments: 'ip' arguments, for meth:commandKind.
+    :return: What the function returns.
+    """
+    start = timer()
+    ip_result = function(*args)
+    record(COMMAND, commandKind(arguments), timer() - start, len(ip_result['stdout'] or ''),
+           ip_result['return_value'])
+    return ip_result
+#---
+
+
+def timeStream(arguments, lines):
+    """
+    Passes the lines of a streamed 'ip' command through, reporting the command once the stream ends (an exception
+    from the stream counts as return value 1).
+
+    :param arguments: 'ip' arguments, for meth:commandKind.
+    :param lines: Iterable of output lines.
+    :return: Generator of the same lines.
+    """
+    start = timer()
+    size = 0
+    return_value = 0
+    try:
+        for line in lines:
+            size += len(line)
+            yield line
+    except GeneratorExit:
+        raise
+    except Exception:
+        return_value = 1
+        raise
+    finally:
+        record(COMMAND, commandKind(arguments), timer() - start, size, return_value)
+#---
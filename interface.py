@@ -23,7 +23,12 @@
 #   planned.
 #
 
-from lib import nixcommon
+import threading
+import time
+
+from . import backend
+from . import ipprefix
+from . import monitor
 
 IP_V4 = 4
 IP_V6 = 6
@@ -44,6 +49,66 @@ class RequiresEscalationError(InterfaceError):
     pass
 class AddressError(InterfaceError):
     pass
+class InterfaceBatchError(InterfaceError):
+    """
+    Raised when some of the items in a batch failed.  The rest of the batch is still applied.
+    """
+
+    def __init__(self, message, failures = None):
+        """
+        Constructor
+
+        :param message: Error message.
+        :param failures: List of (address or interface name, exception) tuples.
+        """
+        super(InterfaceBatchError, self).__init__(message)
+        self.failures = failures if failures is not None else []
+
+
+def _addressError(return_value, error_text, exists_message):
+    """
+    Builds the exception for a failed address change (``None`` if it didn't fail).
+
+    """
+    if return_value == 254:
+        return AddressError(exists_message)
+    elif return_value == 2:
+        return RequiresEscalationError("Altering interface addresses requires escalated privileges.")
+    elif return_value:
+        return InterfaceError("Unexpected error: %s" %error_text)
+    return None
+#---
+
+
+def _linkStateError(return_value, error_text):
+    """
+    Builds the exception for a failed link state change (``None`` if it didn't fail).
+
+    """
+    if return_value == 2:
+        return RequiresEscalationError("Altering interface state requires escalated privileges.")
+    elif return_value:
+        return InterfaceError("Unexpected error: %s" %error_text)
+    return None
+#---
+
+
+def setLinksState(names, up):
+    """
+    Brings many interfaces up or down in one batch.
+
+    :param names: Iterable of interface names.
+    :param up: ``True`` to bring the interfaces up, ``False`` to bring them down.
+    :raise InterfaceBatchError: With a (name, exception) tuple for every interface which couldn't be changed.
+    """
+    names = list(names)
+    ip_batch = backend.getBackend().setLinksState(names, up)
+
+    failures = [(names[index], _linkStateError(*ip_batch['errors'][index])) for index in sorted(ip_batch['errors'])]
+    if failures:
+        raise InterfaceBatchError("%d of %d interfaces could not be brought %s" %(len(failures), len(names),
+                                                                                 'up' if up else 'down'), failures)
+#---
 
 
 # Interface Class
@@ -56,50 +121,118 @@ class Interface(object):
     units = INT_MBPS
     bandwidth_in = 0
     bandwidth_out = 0
-    addresses = {'v4':[], 'v6':[]}
+    address_ttl = None      # Seconds before the address cache is read again; ``None`` keeps it until invalidated
 
 
-    def __init__(self, name, config = None):
+    def __init__(self, name, config = None, verify = True):
         """
         Constructor
+
+        :param name: Operating system's name for the interface.
+        :param config: Dictionary of configuration parameters.
+        :param verify: Check with the system that the interface exists.  class:InterfaceRegistry skips this, as its dump
+            already proves it.
         """
-        self.setName(name)
+        self._addresses = None
+        self._addresses_read = 0
+        self._address_lock = threading.RLock()
+
+        if verify:
+            self.setName(name)
+        else:
+            self.name = name
 
         if config:
             self.importConfig(config)
     #---
 
 
-    def _iplink(self, arguments):
+    def importConfig(self, config):
         """
-        Runs the 'ip' command with the provided arguments.
-        :param arguments: Argument string to pass to the 'ip' command.
-        :return: Dictionary from meth:nixcommon.runProcess
+        Imports configuration from a dictionary
+
+        :param config: Dictionary of configuration parameters
         """
-        return nixcommon.runProcess("ip link %s" %arguments)
+        for key in config:
+            if hasattr(self, key):
+                setattr(self, key, config[key])
+            else:
+                raise ConfigError("%s is not a valid configuration option!" %key)
+    #---
+
+
+    # -------- Result checks --------
+    #   Shared with the asyncio counterpart in class:aio.AsyncInterface.
+
+    def _checkName(self, ip_link, name):
+        if ip_link['return_value'] == 255:
+            raise InterfaceError("Invalid interface name: %s" %name)
+        elif ip_link['return_value']:
+            raise InterfaceError("Unexpected error: %s" %ip_link['stderr'])
     #---
 
 
-    def _ipaddress(self, arguments):
+    def _checkAddress(self, ip_address, exists_message):
+        error = _addressError(ip_address['return_value'], ip_address['stderr'], exists_message)
+        if error is not None:
+            raise error
+    #---
+
+
+    def _checkAddressBatch(self, operations, ip_batch):
         """
-        Just an alias to the 'ip address' command.
-        :return: Dictionary from meth:nixcommon.runProcess
+        Updates the address cache with the changes of an address batch which went through, and raises for the rest.
+
+        :param operations: List of (action, address) tuples, action being 'add' or 'del'.
+        :param ip_batch: Result of the backend's addressBatch.
+        :raise InterfaceBatchError: With an (address, exception) tuple for every change which failed.
         """
-        return nixcommon.runProcess("ip address %s" %arguments)
+        failures = []
+        for index, (action, address) in enumerate(operations):
+            if index not in ip_batch['errors']:
+                self._updateAddresses(address, action == 'add')
+                continue
+
+            message = "%s %s on %s" %(address, 'already exists' if action == 'add' else 'does not exist', self.name)
+            failures.append((address, _addressError(ip_batch['errors'][index][0], ip_batch['errors'][index][1],
+                                                    message)))
+
+        if failures:
+            raise InterfaceBatchError("%d of %d address changes failed on %s" %(len(failures), len(operations),
+                                                                               self.name), failures)
     #---
 
 
-    def importConfig(self, config):
+    def _addressChanges(self, desired, current, keep_link_local):
         """
-        Imports configuration from a dictionary
+        Works out the address changes for meth:replaceAddresses.
 
-        :param config: Dictionary of configuration parameters
+        :param current: The interface's addresses, as meth:getAddresses returns them.
+        :return: Tuple of (addresses to add, addresses to delete).
         """
-        for key in config:
-            if hasattr(self, key):
-                setattr(self, key, config[key])
-            else:
-                raise ConfigError("%s is not a valid configuration option!" %key)
+        wanted = []
+        for address in desired:
+            try:
+                version, number, length = ipprefix.parsePrefix(address)
+            except ipprefix.PrefixError as error:
+                raise AddressError(str(error))
+            entry = "%s/%d" %(ipprefix.formatPrefix(version, number), length)
+            if entry not in wanted:
+                wanted.append(entry)
+
+        live = ["%s/%s" %entry for entry in current['v4'] + current['v6']]
+
+        deletes = [address for address in live if address not in wanted and
+                   not (keep_link_local and address.lower().startswith(('fe8', 'fe9', 'fea', 'feb')))]
+        adds = [address for address in wanted if address not in live]
+        return adds, deletes
+    #---
+
+
+    def _checkLinkState(self, iproute):
+        error = _linkStateError(iproute['return_value'], iproute['stderr'])
+        if error is not None:
+            raise error
     #---
 
 
@@ -110,16 +243,10 @@ class Interface(object):
         :param name: [String] Operating system's name for the interface
         """
         # Checks to see if the interface name is valid
-        ip_link = self._iplink("show \"%s\"" %name)
+        ip_link = backend.getBackend().showLink(name)
 
-        
-        if ip_link['return_value'] == 255:
-            raise InterfaceError("Invalid interface name: %s" %name)
-        elif ip_link['return_value']:
-            print "return_value: %s" %ip_link['return_value']
-            raise InterfaceError("Unexpected error: %s" %ip_link['stderr'])
-        else:
-            self.name = name
+        self._checkName(ip_link, name)
+        self.name = name
     #---
 
 
@@ -136,31 +263,112 @@ class Interface(object):
     #---
 
 
-    def getAddresses(self):
+    # -------- Address cache --------
+    #   Each interface keeps its own copy of its addresses.  It's read from the system on first use, then kept current
+    # by meth:addAddress and meth:delAddress.  Changes made outside this object are picked up once the cache is
+    # invalidated: by meth:invalidateAddresses, by monitor events (see meth:watch) or when self.address_ttl runs out.
+
+    def _cachedAddresses(self):
         """
-        Fetches the interface's addresses (and caches them locally).
+        Returns a copy of the cached addresses, or ``None`` if the cache is empty or stale.
 
-        :return: Dictionary of interface's v4 and v6 addresses.
         """
-        v4 = []
-        v6 = []
-        ip_address = self._ipaddress("show dev \"%s\"" %self.name)
-        int_ip_info = ip_address['stdout'].strip().splitlines()
+        with self._address_lock:
+            if self._addresses is None:
+                return None
+            if self.address_ttl is not None and time.time() - self._addresses_read > self.address_ttl:
+                return None
+            return {'v4': list(self._addresses['v4']), 'v6': list(self._addresses['v6'])}
+    #---
+
+
+    def _storeAddresses(self, addresses):
+        with self._address_lock:
+            self._addresses = {'v4': list(addresses['v4']), 'v6': list(addresses['v6'])}
+            self._addresses_read = time.time()
+    #---
+
+
+    def _updateAddresses(self, address, added):
+        """
+        Applies a successful add or delete to the cache, so it doesn't have to be read again.
+
+        :param address: Address as passed to meth:addAddress or meth:delAddress.
+        :param added: ``True`` for an add, ``False`` for a delete.
+        """
+        try:
+            version, number, length = ipprefix.parsePrefix(address)
+        except ipprefix.PrefixError:
+            self.invalidateAddresses()      # Not in a form we can match against 'ip' output
+            return
+
+        entry = (ipprefix.formatPrefix(version, number), str(length))
+        with self._address_lock:
+            if self._addresses is None:
+                return
+            entries = self._addresses['v4' if version == IP_V4 else 'v6']
+            if added:
+                if entry not in entries:
+                    entries.append(entry)
+                return
+
+            # Without a prefix length, 'ip' deletes the first match on the address alone
+            if '/' not in address:
+                entry = next((cached for cached in entries if cached[0] == entry[0]), entry)
+            if entry in entries:
+                entries.remove(entry)
+    #---
+
+
+    def invalidateAddresses(self):
+        """
+        Drops the address cache; the next read of self.addresses goes to the system.
+
+        """
+        with self._address_lock:
+            self._addresses = None
+    #---
+
+
+    def _addressEvent(self, event):
+        if event.kind == monitor.ADDRESS_EVENT and event.data['name'] == self.name:
+            self.invalidateAddresses()
+    #---
+
+
+    def watch(self, address_monitor):
+        """
+        Invalidates the address cache whenever a monitor reports an address change on this interface.
 
-        for info_line in int_ip_info:
-            split_line = info_line.strip().split()
+        :param address_monitor: Instance of class:monitor.Monitor watching address events (and started).
+        """
+        address_monitor.addCallback(self._addressEvent)
+    #---
+
+
+    def _getCachedAddresses(self):
+        with self._address_lock:
+            addresses = self._cachedAddresses()
+            if addresses is None:
+                addresses = self.getAddresses()
+            return addresses
+    #---
+
+
+    addresses = property(_getCachedAddresses, _storeAddresses, doc = "Dictionary of the interface's v4 and v6 "
+                         "addresses, read from the system only when the cache is empty or stale.")
 
-            # IPv4 address
-            if split_line[0] == 'inet':
-                v4.append(tuple(split_line[1].split('/')))
-            # IPv6 address
-            elif split_line[0] == 'inet6':
-                v6.append(tuple(split_line[1].split('/')))
 
-        self.addresses['v4'] = v4
-        self.addresses['v6'] = v6
+    def getAddresses(self):
+        """
+        Fetches the interface's addresses (and caches them locally).
+
+        :return: Dictionary of interface's v4 and v6 addresses.
+        """
+        ip_address = backend.getBackend().getAddresses(self.name)
 
-        return self.addresses
+        self._storeAddresses(ip_address['addresses'])
+        return ip_address['addresses']
     #---
 
 
@@ -170,14 +378,11 @@ class Interface(object):
 
         :param address: String containing IP address and subnet in CIDR notation.
         """
-        ip_address = self._ipaddress("add \"%s\" dev \"%s\"" %(address, self.name))
+        ip_address = backend.getBackend().addAddress(self.name, address)
 
-        if ip_address['return_value'] == 254:
-            raise AddressError("%s already exists on %s" %(address,self.name))
-        elif ip_address['return_value']:
-            raise InterfaceError("Unexpected error: %s" %ip_address['stderr'])
+        self._checkAddress(ip_address, "%s already exists on %s" %(address,self.name))
 
-        self.getAddresses()     # Update the IP address cache
+        self._updateAddresses(address, True)
     #---
 
 
@@ -187,14 +392,63 @@ class Interface(object):
 
         :param address: String containing IP address and subnet in CIDR notation.
         """
-        ip_address = self._ipaddress("del \"%s\" dev \"%s\"" %(address, self.name))
+        ip_address = backend.getBackend().delAddress(self.name, address)
 
-        if ip_address['return_value'] == 254:
-            raise AddressError("%s does not exist on %s" %(address,self.name))
-        elif ip_address['return_value']:
-            raise InterfaceError("Unexpected error: %s" %ip_address['stderr'])
+        self._checkAddress(ip_address, "%s does not exist on %s" %(address,self.name))
 
-        self.getAddresses()     # Update the IP address cache
+        self._updateAddresses(address, False)
+    #---
+
+
+    def _addressBatch(self, operations):
+        """
+        Pushes address changes for this interface through one backend batch and updates the address cache.
+
+        :param operations: List of (action, address) tuples, action being 'add' or 'del'.
+        :raise InterfaceBatchError: With an (address, exception) tuple for every change which failed.
+        """
+        ip_batch = backend.getBackend().addressBatch([(action, self.name, address) for action, address in operations])
+
+        self._checkAddressBatch(operations, ip_batch)
+    #---
+
+
+    def addAddresses(self, addresses):
+        """
+        Adds many IP addresses to the interface in one batch.  A failing address doesn't stop the others.
+
+        :param addresses: Iterable of strings containing IP address and subnet in CIDR notation.
+        :raise InterfaceBatchError: With an (address, exception) tuple for every address which couldn't be added;
+            the exceptions follow meth:addAddress (AddressError, RequiresEscalationError...).
+        """
+        self._addressBatch([('add', address) for address in addresses])
+    #---
+
+
+    def delAddresses(self, addresses):
+        """
+        Removes many IP addresses from the interface in one batch.  A failing address doesn't stop the others.
+
+        :param addresses: Iterable of strings containing IP address and subnet in CIDR notation.
+        :raise InterfaceBatchError: As meth:addAddresses.
+        """
+        self._addressBatch([('del', address) for address in addresses])
+    #---
+
+
+    def replaceAddresses(self, desired, keep_link_local = True):
+        """
+        Makes the interface's addresses match a list: missing addresses are added and the rest deleted, in one batch.
+
+        :param desired: Iterable of strings containing IP address and subnet in CIDR notation.
+        :param keep_link_local: Never delete IPv6 link-local (fe80::/10) addresses, which the kernel manages.
+        :return: Tuple of (addresses added, addresses deleted).
+        :raise InterfaceBatchError: As meth:addAddresses.
+        """
+        adds, deletes = self._addressChanges(desired, self.getAddresses(), keep_link_local)
+
+        self._addressBatch([('del', address) for address in deletes] + [('add', address) for address in adds])
+        return adds, deletes
     #---
 
 
@@ -203,12 +457,9 @@ class Interface(object):
         Brings the interface up.
 
         """
-        iproute = self._iplink("set \"%s\" up" %self.name)
-        
-        if iproute['return_value'] == 2:
-            raise RequiresEscalationError("Altering interface state requires escalated privileges.")
-        elif iproute['return_value']:
-            raise InterfaceError("Unexpected error: %s" %iproute['stderr'])
+        iproute = backend.getBackend().setLinkState(self.name, True)
+
+        self._checkLinkState(iproute)
     #---
 
 
@@ -217,12 +468,9 @@ class Interface(object):
         Disables the interface.
 
         """
-        iproute = self._iplink("set \"%s\" down" %self.name)
-        
-        if iproute['return_value'] == 2:
-            raise RequiresEscalationError("Altering interface state requires escalated privileges.")
-        elif iproute['return_value']:
-            raise InterfaceError("Unexpected error: %s" %iproute['stderr'])
+        iproute = backend.getBackend().setLinkState(self.name, False)
+
+        self._checkLinkState(iproute)
     #---
 
 
@@ -231,15 +479,175 @@ class Interface(object):
         Fetches the status of the interface, according to iproute.
 
         :param simple: Return only the status, no additional information if ``True``.
-        :return: Simple status string if param:simple is ``True``, otherwise, full iproute status string.
+        :return: Simple status string if param:simple is ``True``, otherwise, full iproute status string (see meth:link
+            for a typed record).
         """
-        iproute = self._iplink("show \"%s\"" %self.name)
-        
+        iproute = backend.getBackend().showLink(self.name)
+
         if iproute['return_value']:
             raise InterfaceError("Unexpected error: %s" %iproute['stderr'])
 
         if simple:
-            return iproute['stdout'].split('state')[1].split()[0]
+            return iproute['state']
 
         return iproute['stdout']
-    #---
\ No newline at end of file
+    #---
+
+
+    def link(self):
+        """
+        Fetches the interface as a typed record: flags, MTU, operational state, qdisc, kind, traffic counters and its
+        addresses with their lifetimes.
+
+        :return: Instance of class:ipjson.LinkRecord.
+        """
+        iproute = backend.getBackend().getLink(self.name)
+
+        if iproute['return_value']:
+            raise InterfaceError("Unexpected error: %s" %iproute['stderr'])
+
+        return iproute['link']
+    #---
+
+
+# -------- InterfaceRegistry --------
+
+class InterfaceRegistry(object):
+    """
+    Every interface on the host, loaded from a single dump (see meth:backend.Backend.dumpLinks) instead of one probe
+    per interface.  Interfaces handed out by the registry already hold their addresses.
+    """
+    links = {}          # Interface name -> link dictionary from the dump
+    indexes = {}        # Interface name -> ifindex
+    names = {}          # ifindex -> interface name
+    owners = {}         # Address (without prefix length) -> interface name
+
+
+    def __init__(self, load = True):
+        """
+        Constructor
+
+        :param load: Dump the system's interfaces straight away.
+        """
+        self.links = {}
+        self.indexes = {}
+        self.names = {}
+        self.owners = {}
+        self._interfaces = {}
+
+        if load:
+            self.refresh()
+    #---
+
+
+    def refresh(self):
+        """
+        Dumps the system's interfaces again.  Interface objects already handed out are kept (and their addresses
+        updated) as long as the interface still exists.
+
+        """
+        dump = backend.getBackend().dumpLinks()
+        if dump['return_value']:
+            raise InterfaceError("Unexpected error: %s" %dump['stderr'])
+
+        self.links = dict((link['name'], link) for link in dump['links'])
+        self.indexes = dict((name, link['index']) for name, link in self.links.items())
+        self.names = dict((index, name) for name, index in self.indexes.items())
+        self.owners = {}
+        for name, link in self.links.items():
+            for version in ('v4', 'v6'):
+                for address, prefix_len in link['addresses'][version]:
+                    self.owners.setdefault(address, name)
+
+        for name in list(self._interfaces):
+            if name in self.links:
+                self._interfaces[name].addresses = self._addresses(name)
+            else:
+                del self._interfaces[name]
+    #---
+
+
+    def _addressEvent(self, event):
+        interface = self._interfaces.get(event.data['name']) if event.kind == monitor.ADDRESS_EVENT else None
+        if interface is not None:
+            interface.invalidateAddresses()
+    #---
+
+
+    def watch(self, address_monitor):
+        """
+        Invalidates the address cache of the registry's interfaces whenever a monitor reports an address change.
+
+        :param address_monitor: Instance of class:monitor.Monitor watching address events (and started).
+        """
+        address_monitor.addCallback(self._addressEvent)
+    #---
+
+
+    def _addresses(self, name):
+        addresses = self.links[name]['addresses']
+        return {'v4': list(addresses['v4']), 'v6': list(addresses['v6'])}
+    #---
+
+
+    def get(self, name):
+        """
+        Returns the interface object for a name.
+
+        :param name: Operating system's name for the interface.
+        :return: Instance of class:Interface.
+        """
+        if name not in self.links:
+            raise InterfaceError("Invalid interface name: %s" %name)
+
+        if name not in self._interfaces:
+            interface = Interface(name, verify = False)
+            interface.addresses = self._addresses(name)
+            self._interfaces[name] = interface
+        return self._interfaces[name]
+    #---
+
+
+    def byIndex(self, index):
+        """
+        Returns the interface object for an ifindex.
+
+        """
+        if index not in self.names:
+            raise InterfaceError("No interface with index %s" %index)
+        return self.get(self.names[index])
+    #---
+
+
+    def byAddress(self, address):
+        """
+        Returns the interface an address is assigned to.
+
+        :param address: Address, with or without a prefix length.
+        :return: Instance of class:Interface, or ``None`` if no interface holds the address.
+        """
+        name = self.owners.get(address.split('/')[0])
+        return self.get(name) if name is not None else None
+    #---
+
+
+    def __getitem__(self, name):
+        return self.get(name)
+    #---
+
+
+    def __contains__(self, name):
+        return name in self.links
+    #---
+
+
+    def __iter__(self):
+        for name in sorted(self.links, key = self.indexes.get):
+            yield self.get(name)
+    #---
+
+
+    def __len__(self):
+        return len(self.links)
+    #---
+#---
@@ -0,0 +1,292 @@
+#
+# $Id$
+#
+# NAME:         ipjson.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Structured reads of links and addresses through iproute2's JSON output ('ip -j').  Entries are decoded once into
+# typed records (class:LinkRecord, class:AddressRecord) instead of being scraped out of the human readable text, and
+# host-wide dumps are decoded as they're read (see meth:iterArray).  'ip' only speaks JSON from iproute2 4.13 on, so
+# meth:supportsJSON tells whether the installed one does.
+#
+
+import json
+import re
+import subprocess
+
+# 'ip -V' prints either a release ('iproute2-6.1.0') or, up to the 5.x series, a snapshot date ('iproute2-ss170905')
+VERSION = re.compile(r'iproute2-(?:ss(\d{6})|v?(\d+(?:\.\d+)*))')
+JSON_SNAPSHOT = 170905          # 4.13, the first release with 'ip -j'
+
+FOREVER = 0xffffffff            # Address lifetime of permanent addresses
+
+# Keys of an 'addr_info' entry which are flags ("dynamic": true, ...) rather than values
+ADDRESS_FLAGS = ('secondary', 'temporary', 'deprecated', 'tentative', 'dadfailed', 'optimistic', 'home', 'nodad',
+                 'mngtmpaddr', 'noprefixroute', 'autojoin', 'dynamic', 'stable-privacy')
+
+
+# Exceptions
+class IPJSONError(Exception):
+    pass
+
+
+# -------- Records --------
+
+class AddressRecord(object):
+    """
+    One address of a link, from an 'addr_info' entry.
+    """
+    __slots__ = ('family', 'address', 'prefixlen', 'peer', 'broadcast', 'scope', 'label', 'flags', 'valid_lifetime',
+                 'preferred_lifetime')
+
+    def __init__(self, family, address, prefixlen, peer = None, broadcast = None, scope = None, label = None,
+                 flags = (), valid_lifetime = None, preferred_lifetime = None):
+        """
+        Constructor
+
+        :param family: 'inet' or 'inet6'.
+        :param valid_lifetime: Seconds the address has left, or ``None`` if it's permanent (so is preferred_lifetime).
+        """
+        self.family = family
+        self.address = address
+        self.prefixlen = prefixlen
+        self.peer = peer
+        self.broadcast = broadcast
+        self.scope = scope
+        self.label = label
+        self.flags = list(flags)
+        self.valid_lifetime = valid_lifetime
+        self.preferred_lifetime = preferred_lifetime
+    #---
+
+
+    @classmethod
+    def fromJSON(cls, info):
+        """
+        Builds a record from a decoded 'addr_info' entry.
+
+        """
+        lifetimes = [info.get(key) for key in ('valid_life_time', 'preferred_life_time')]
+        lifetimes = [lifetime if lifetime != FOREVER else None for lifetime in lifetimes]
+        return cls(info.get('family'), info.get('local'), info.get('prefixlen'), info.get('address'),
+                   info.get('broadcast'), info.get('scope'), info.get('label'),
+                   [flag for flag in ADDRESS_FLAGS if info.get(flag) is True], *lifetimes)
+    #---
+
+
+    def __str__(self):
+        return "%s/%s" %(self.address, self.prefixlen)
+    #---
+
+
+    def __repr__(self):
+        return "AddressRecord(%r)" %str(self)
+    #---
+#---
+
+
+class LinkRecord(object):
+    """
+    A link, from one entry of 'ip -j -d [-s] link/address show'.  Fields 'ip' didn't print (stats without -s, kind
+    for plain devices...) are ``None``.
+    """
+    __slots__ = ('index', 'name', 'flags', 'mtu', 'operstate', 'qdisc', 'master', 'link', 'link_type', 'address',
+                 'broadcast', 'kind', 'txqlen', 'group', 'stats', 'addresses')
+
+    def __init__(self, index, name, flags = (), mtu = None, operstate = None, qdisc = None, master = None,
+                 link = None, link_type = None, address = None, broadcast = None, kind = None, txqlen = None,
+                 group = None, stats = None, addresses = ()):
+        """
+        Constructor
+
+        :param stats: Dictionary with 'rx' and 'tx' dictionaries of counters (bytes, packets, errors, dropped...).
+        :param addresses: List of class:AddressRecord instances.
+        """
+        self.index = index
+        self.name = name
+        self.flags = list(flags)
+        self.mtu = mtu
+        self.operstate = operstate
+        self.qdisc = qdisc
+        self.master = master
+        self.link = link
+        self.link_type = link_type
+        self.address = address
+        self.broadcast = broadcast
+        self.kind = kind
+        self.txqlen = txqlen
+        self.group = group
+        self.stats = stats
+        self.addresses = list(addresses)
+    #---
+
+
+    @classmethod
+    def fromJSON(cls, entry):
+        """
+        Builds a record from a decoded link entry.
+
+        """
+        return cls(entry.get('ifindex'), entry.get('ifname'), entry.get('flags', ()), entry.get('mtu'),
+                   entry.get('operstate'), entry.get('qdisc'), entry.get('master'), entry.get('link'),
+                   entry.get('link_type'), entry.get('address'), entry.get('broadcast'),
+                   (entry.get('linkinfo') or {}).get('info_kind'), entry.get('txqlen'), entry.get('group'),
+                   entry.get('stats64') or entry.get('stats'),
+                   [AddressRecord.fromJSON(info) for info in entry.get('addr_info', ())])
+    #---
+
+
+    def __repr__(self):
+        return "LinkRecord(%r)" %self.name
+    #---
+
+
+    def linkDict(self):
+        """
+        Converts the record to the link dictionary the text parser gives (see meth:backend.parseLinkLine), with its
+        addresses (see meth:addressDict).
+
+        """
+        link = {'index': self.index, 'name': self.name, 'flags': list(self.flags), 'addresses': self.addressDict()}
+        for key, value in (('mtu', self.mtu), ('state', self.operstate), ('qdisc', self.qdisc),
+                           ('master', self.master)):
+            if value is not None:
+                link[key] = value
+        return link
+    #---
+
+
+    def addressDict(self):
+        """
+        Converts the addresses to the dictionary of 'v4' and 'v6' lists of (address, prefix length) tuples the text
+        parser gives (see meth:backend.parseAddresses).
+
+        """
+        addresses = {'v4': [], 'v6': []}
+        for address in self.addresses:
+            if address.family in ('inet', 'inet6'):
+                addresses['v4' if address.family == 'inet' else 'v6'].append((address.address, str(address.prefixlen)))
+        return addresses
+    #---
+#---
+
+
+# -------- Decoding --------
+
+def iterArray(stream, chunk_size = 65536):
+    """
+    Decodes a JSON array as it's read, yielding each element as soon as it's complete, so a host-wide dump never has
+    to be held (or decoded) all at once.
+
+    :param stream: File object (text mode) holding the array.
+    :param chunk_size: Number of characters to read at a time.
+    :return: Generator of decoded elements.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    started = False
+    eof = False
+
+    while True:
+        # Skip the separators between elements
+        while position < len(buffer) and buffer[position] in ' \t\r\n,[':
+            if buffer[position] == '[':
+                if started:
+                    break
+                started = True
+            position += 1
+
+        if position < len(buffer):
+            if not started:
+                raise IPJSONError("Expected a JSON array, got %r" %buffer[position:position + 20])
+            if buffer[position] == ']':
+                return
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # The element isn't all there yet
+                if eof:
+                    raise IPJSONError("Truncated JSON array")
+            else:
+                yield element
+                position = end
+                continue
+
+        if eof:
+            if started:
+                raise IPJSONError("Truncated JSON array")
+            return
+
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+#---
+
+
+def parseLinks(text):
+    """
+    Decodes a whole 'ip -j link/address show' output.
+
+    :return: List of class:LinkRecord instances.
+    """
+    try:
+        return [LinkRecord.fromJSON(entry) for entry in json.loads(text or '[]')]
+    except ValueError as error:
+        raise IPJSONError("Bad JSON from 'ip': %s" %error)
+#---
+
+
+# -------- iproute2 versions --------
+
+_version = None
+
+
+def iprouteVersion():
+    """
+    Returns the version string of the installed iproute2 ('6.1.0', 'ss170905'), read once from 'ip -V'.
+
+    """
+    global _version
+
+    if _version is None:
+        try:
+            output = subprocess.check_output(['ip', '-V'], stderr = subprocess.STDOUT, universal_newlines = True)
+        except (OSError, subprocess.CalledProcessError):
+            output = ''
+        match = VERSION.search(output)
+        _version = '' if not match else ('ss' + match.group(1) if match.group(1) else match.group(2))
+    return _version
+#---
+
+
+def supportsJSON(version = None):
+    """
+    Tells whether an iproute2 version can print JSON.
+
+    :param version: Version string as returned by meth:iprouteVersion (the default).
+    """
+    version = iprouteVersion() if version is None else version
+    if version.startswith('ss'):
+        return int(version[2:]) >= JSON_SNAPSHOT
+    try:
+        return tuple(int(part) for part in version.split('.')) >= (4, 13)
+    except ValueError:
+        return False
+#---
@@ -0,0 +1,341 @@
+#
+# $Id$
+#
+# NAME:         ippool.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   A pool of long-lived 'ip -force -batch -' coprocesses.  Commands are written to a worker's stdin one line at a time,
+# each followed by a sentinel (an unknown 'ip' object) which is guaranteed to fail with a known message without
+# touching the kernel; everything read before that message belongs to the command.  Workers which die (argument errors
+# make 'ip' exit even with -force) are restarted.
+#
+#   'ip link show' switches the batch process' address family to AF_PACKET for good, which breaks any 'ip address' or
+# 'ip route' listing run after it in the same process.  Link listings are therefore kept on their own workers.
+#
+#   Global options ('-6', '-j', ...) can't be given on a batch line, only on the batch process' own command line, so
+# commands which start with them go to workers started with the same options.
+#
+
+import contextlib
+import itertools
+import subprocess
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Abbreviations 'ip' accepts for 'link' and its listing actions
+LINK_OBJECT = ('l', 'li', 'lin', 'link')
+LIST_ACTIONS = ('s', 'sh', 'sho', 'show', 'l', 'ls', 'li', 'lis', 'list', 'lst')
+
+# Global options a worker can be started with (options taking a value aren't, as they'd need a worker per value)
+WORKER_OPTIONS = ('-4', '-6', '-0', '-j', '-json', '-d', '-details', '-s', '-stats', '-o', '-oneline')
+
+# Error text -> 'ip' return value.  Batch mode only reports pass/fail, so the return value the callers check for is
+# rebuilt from the message.
+ERROR_RETURN_VALUES = (
+    ('Operation not permitted', 2),
+    ('File exists', 254),
+    ('already assigned', 254),
+    ('Cannot assign requested address', 254),
+    ('Address not found', 254),
+    ('does not exist', 255),
+    ('Cannot find device', 255),
+    ('No such device', 255),
+)
+
+
+# Exceptions
+class IPPoolError(Exception):
+    pass
+
+
+def returnValue(error_text):
+    """
+    Works out the return value 'ip' would have exited with for an error message.
+
+    :param error_text: Error output of a failed command.
+    :return: Integer return value.
+    """
+    for text, return_value in ERROR_RETURN_VALUES:
+        if text in error_text:
+            return return_value
+    return 1
+#---
+
+
+def splitOptions(arguments):
+    """
+    Splits the leading global options off a command.
+
+    :param arguments: Argument string to pass to the 'ip' command.
+    :return: Tuple of (sorted tuple of options, rest of the argument string), or ``None`` if the command has an option
+        a worker can't be started with (see WORKER_OPTIONS).
+    """
+    options = set()
+    arguments = arguments.lstrip()
+    while arguments.startswith('-'):
+        option, _, arguments = arguments.partition(' ')
+        if option not in WORKER_OPTIONS:
+            return None
+        options.add(option)
+        arguments = arguments.lstrip()
+    return tuple(sorted(options)), arguments
+#---
+
+
+def isLinkListing(arguments):
+    """
+    Checks whether a command is an 'ip link' listing (which changes the batch process' address family).
+
+    :param arguments: Argument string to pass to the 'ip' command.
+    :return: ``True`` for link listings.
+    """
+    tokens = arguments.split()
+    return bool(tokens) and tokens[0] in LINK_OBJECT and (len(tokens) == 1 or tokens[1] in LIST_ACTIONS)
+#---
+
+
+# -------- IPWorker --------
+
+class IPWorker(object):
+    """
+    A single 'ip -force -batch -' coprocess.  Not thread safe; the pool hands each worker to one caller at a time.
+    """
+    command = ['ip', '-force', '-batch', '-']
+    process = None
+    line = 0            # Number of lines written to the current process
+    sentinels = None    # Source of unique sentinel names
+
+
+    def __init__(self, options = ()):
+        """
+        Constructor
+
+        :param options: Global options to start 'ip' with (see WORKER_OPTIONS).
+        """
+        self.command = ['ip'] + list(options) + ['-force', '-batch', '-']
+        self.sentinels = itertools.count()
+        self.start()
+    #---
+
+
+    def start(self):
+        """
+        (Re)starts the coprocess.  stderr is folded into stdout so that output and errors stay in order.
+
+        """
+        self.stop()
+        self.process = subprocess.Popen(self.command, stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+                                        stderr = subprocess.STDOUT, universal_newlines = True)
+        self.line = 0
+    #---
+
+
+    def stop(self):
+        """
+        Stops the coprocess, if it's running.
+
+        """
+        if self.process is None:
+            return
+
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.process = None
+    #---
+
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+    #---
+
+
+    def feed(self, lines):
+        """
+        Writes command lines to the coprocess, followed by a sentinel, and reads everything they print.  The lines are
+        written before any output is read, so callers keep what they feed at once small enough for the pipes.
+
+        :param lines: List of argument strings.
+        :return: Tuple of (output, batch line number of the first line, return value or ``None``).  The output holds
+            errors and their 'Command failed -:<line>' markers as well.  The return value is set if 'ip' exited (on an
+            argument error) before it reached the sentinel; the worker is restarted then.
+        :raise IPPoolError: If the coprocess died before the lines could be written (it's restarted too).
+        """
+        for line in lines:
+            if '\n' in line:
+                raise IPPoolError("Commands can't span multiple lines: %r" %line)
+        if not self.alive():
+            self.start()
+
+        sentinel = "ipbatch-sentinel-%d" %next(self.sentinels)
+        sentinel_text = "Object \"%s\" is unknown, try \"ip help\"." %sentinel
+        first_line = self.line + 1
+
+        try:
+            self.process.stdin.write(''.join("%s\n" %line for line in lines) + "%s\n" %sentinel)
+            self.process.stdin.flush()
+        except (IOError, OSError):
+            self.start()
+            raise IPPoolError("ip coprocess died, command not run")
+        self.line += len(lines) + 1
+
+        output = []
+        while True:
+            line = self.process.stdout.readline()
+            # EOF: 'ip' exited on one of the lines
+            if not line:
+                return_value = self.process.wait()
+                self.start()
+                return ''.join(output), first_line, return_value or 1
+
+            if line.rstrip('\n') == sentinel_text:
+                self.process.stdout.readline()      # The sentinel's own 'Command failed' marker
+                break
+            output.append(line)
+
+        return ''.join(output), first_line, None
+    #---
+
+
+    def run(self, arguments):
+        """
+        Runs one command through the coprocess.
+
+        :param arguments: Argument string to pass to the 'ip' command.
+        :return: Dictionary in the same format as meth:nixcommon.runProcess
+        """
+        try:
+            output, command_line, exited = self.feed([arguments])
+        except IPPoolError as error:
+            return {'return_value': 1, 'stdout': '', 'stderr': str(error)}
+        if exited is not None:
+            return {'return_value': exited, 'stdout': '', 'stderr': output}
+
+        marker = "Command failed -:%d\n" %command_line
+        if output.endswith(marker):
+            stderr = output[:-len(marker)]
+            return {'return_value': returnValue(stderr), 'stdout': '', 'stderr': stderr}
+        return {'return_value': 0, 'stdout': output, 'stderr': ''}
+    #---
+#---
+
+
+# -------- IPPool --------
+
+class IPPool(object):
+    """
+    A fixed size pool of class:IPWorker coprocesses, safe to share between threads.  Link listings and all other
+    commands each get up to self.size workers for every set of global options used (see the module description).
+    """
+    size = 4
+
+
+    def __init__(self, size = None):
+        """
+        Constructor.  Workers are started on first use.
+
+        :param size: Number of coprocesses to keep for each kind of command.
+        """
+        if size:
+            self.size = size
+        if self.size < 1:
+            raise IPPoolError("Pool size must be at least 1.")
+
+        self._idle = {}         # (options, link listing) -> queue of idle workers
+        self._started = {}
+        self._workers = []
+        self._lock = threading.Lock()
+    #---
+
+
+    def _acquire(self, key):
+        """
+        Takes an idle worker, starting a new one if the pool isn't full yet.
+
+        :param key: Which set of workers to take from: tuple of (options, link listing).
+        """
+        with self._lock:
+            if key not in self._idle:
+                self._idle[key] = queue.LifoQueue()
+                self._started[key] = 0
+        try:
+            return self._idle[key].get_nowait()
+        except queue.Empty:
+            with self._lock:
+                if self._started[key] < self.size:
+                    worker = IPWorker(key[0])
+                    self._workers.append(worker)
+                    self._started[key] += 1
+                    return worker
+            return self._idle[key].get()
+    #---
+
+
+    @contextlib.contextmanager
+    def worker(self, options = (), link_listing = False):
+        """
+        Lends a worker out for several commands in a row (see meth:IPWorker.feed).
+
+        :param options: Global options the worker is started with.
+        :param link_listing: Take one of the link listing workers.
+        """
+        key = (tuple(sorted(options)), link_listing)
+        worker = self._acquire(key)
+        try:
+            yield worker
+        finally:
+            self._idle[key].put(worker)
+    #---
+
+
+    def run(self, arguments):
+        """
+        Runs one command on the first free worker.
+
+        :param arguments: Argument string to pass to the 'ip' command.
+        :return: Dictionary in the same format as meth:nixcommon.runProcess
+        :raise IPPoolError: If the command has an option no worker can take (see meth:splitOptions).
+        """
+        split = splitOptions(arguments)
+        if split is None:
+            raise IPPoolError("'ip %s' has an option the pool's workers can't be started with." %arguments)
+        options, arguments = split
+
+        with self.worker(options, isLinkListing(arguments)) as worker:
+            return worker.run(arguments)
+    #---
+
+
+    def close(self):
+        """
+        Stops every worker.
+
+        """
+        with self._lock:
+            for worker in self._workers:
+                worker.stop()
+    #---
+#---
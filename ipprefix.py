@@ -0,0 +1,196 @@
+#
+# $Id$
+#
+# NAME:         ipprefix.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Strict parsing of canonical IPv4/IPv6 addresses and CIDR prefixes into integers.  Only the forms 'ip' itself prints
+# are accepted ('192.0.2.0/24', '2001:db8::/32', or a bare address); anything fuzzier is left to cidrize.  Results are
+# kept in a bounded LRU cache, as routing dumps repeat the same prefixes across tables and polls.
+#
+
+import binascii
+import collections
+import socket
+import threading
+
+IP_V4 = 4
+IP_V6 = 6
+
+FAMILIES = {IP_V4: socket.AF_INET, IP_V6: socket.AF_INET6}
+MAX_LENGTH = {IP_V4: 32, IP_V6: 128}
+DIGITS = '0123456789'       # str.isdigit() takes other scripts' digits (and '²'), which int() then refuses
+
+
+# Exceptions
+class PrefixError(Exception):
+    pass
+
+
+# -------- LRUCache --------
+
+class LRUCache(object):
+    """
+    A small, thread safe, least recently used cache.
+    """
+    size = 65536
+
+
+    def __init__(self, size = None):
+        """
+        Constructor
+
+        :param size: Maximum number of entries to keep.
+        """
+        if size:
+            self.size = size
+
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    #---
+
+
+    def __len__(self):
+        return len(self._entries)
+    #---
+
+
+    def get(self, key, default = None):
+        """
+        Fetches an entry, marking it as the most recently used.
+
+        :param key: Cache key.
+        :param default: Value to return on a miss.
+        """
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = value
+            self.hits += 1
+            return value
+    #---
+
+
+    def put(self, key, value):
+        """
+        Stores an entry, dropping the least recently used one if the cache is full.
+
+        :param key: Cache key.
+        :param value: Value to store.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            if len(self._entries) > self.size:
+                self._entries.popitem(last = False)
+    #---
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+    #---
+#---
+
+
+cache = LRUCache()
+_MISSING = object()
+
+
+def _parse(prefix):
+    """
+    Uncached version of meth:parsePrefix.
+
+    """
+    address, slash, length = prefix.partition('/')
+    version = IP_V6 if ':' in address else IP_V4
+
+    try:
+        packed = socket.inet_pton(FAMILIES[version], address)
+    except (socket.error, ValueError, TypeError):
+        raise PrefixError("Invalid address: %s" %address)
+
+    if slash:
+        if not length or length.strip(DIGITS) or (len(length) > 1 and length[0] == '0') or \
+           int(length) > MAX_LENGTH[version]:
+            raise PrefixError("Invalid prefix length: %s" %prefix)
+        length = int(length)
+    else:
+        length = MAX_LENGTH[version]
+
+    return version, int(binascii.hexlify(packed), 16), length
+#---
+
+
+def parsePrefix(prefix):
+    """
+    Strictly parses a canonical address or CIDR prefix.  Host bits are allowed (and kept).
+
+    :param prefix: String such as '192.0.2.0/24', '2001:db8::/32' or '192.0.2.1'.
+    :return: Tuple of (IP version, address as an integer, prefix length).
+    """
+    parsed = cache.get(prefix, _MISSING)
+    if parsed is _MISSING:
+        try:
+            parsed = _parse(prefix)
+        except PrefixError as error:
+            parsed = str(error)     # Failures are cached by their message
+        cache.put(prefix, parsed)
+
+    if not isinstance(parsed, tuple):
+        raise PrefixError(parsed)
+    return parsed
+#---
+
+
+def networkMask(version, length):
+    """
+    Builds the netmask for a prefix length.
+
+    :param version: IP version.
+    :param length: Prefix length.
+    :return: Netmask as an integer.
+    """
+    bits = MAX_LENGTH[version]
+    return ((1 << length) - 1) << (bits - length)
+#---
+
+
+def formatPrefix(version, address, length = None):
+    """
+    Formats an integer address (and optional prefix length) the way 'ip' prints it.
+
+    :param version: IP version.
+    :param address: Address as an integer.
+    :param length: Prefix length.  Host prefixes (/32, /128) and ``None`` are printed as bare addresses.
+    :return: String.
+    """
+    hex_address = '%0*x' %(MAX_LENGTH[version] // 4, address)
+    text = socket.inet_ntop(FAMILIES[version], binascii.unhexlify(hex_address))
+
+    if length is None or length == MAX_LENGTH[version]:
+        return text
+    return "%s/%d" %(text, length)
+#---
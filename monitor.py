@@ -0,0 +1,258 @@
+#
+# $Id$
+#
+# NAME:         monitor.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Watches route, link and address changes as they happen, by wrapping a long-running 'ip -o monitor'.  Route events
+# are parsed through the route grammar (see class:route.Route); events can be read with an iterator, handed to
+# callbacks from a background thread, or pushed onto a queue (including an asyncio.Queue).
+#
+
+import logging
+import re
+import subprocess
+import threading
+
+from . import backend
+from .route import Route, RouteError
+
+# Event kinds and actions.  The kernel reports changes as new objects, so ADD also covers changes.
+ROUTE_EVENT = 'route'
+LINK_EVENT = 'link'
+ADDRESS_EVENT = 'address'
+ADD = 'add'
+DELETE = 'del'
+
+# 'ip monitor label' prefixes -> event kind
+LABELS = {'[ROUTE]': ROUTE_EVENT, '[LINK]': LINK_EVENT, '[ADDR]': ADDRESS_EVENT}
+OBJECTS = {ROUTE_EVENT: 'route', LINK_EVENT: 'link', ADDRESS_EVENT: 'address'}
+
+ADDRESS_LINE = re.compile(r'^(\d+): (\S+)\s+(inet6?) (\S+)')
+
+log = logging.getLogger(__name__)
+
+
+# Exceptions
+class MonitorError(Exception):
+    pass
+
+
+class MonitorEvent(object):
+    """
+    A single change reported by the kernel.
+    """
+    kind = None         # ROUTE_EVENT, LINK_EVENT or ADDRESS_EVENT
+    action = None       # ADD or DELETE
+    data = None         # class:route.Route for route events, a dictionary for link and address events
+    raw_data = ''       # The line as printed by 'ip monitor'
+
+    def __init__(self, kind, action, data, raw_data):
+        self.kind = kind
+        self.action = action
+        self.data = data
+        self.raw_data = raw_data
+    #---
+
+
+    def __str__(self):
+        return self.raw_data
+    #---
+#---
+
+
+def _parseAddress(text):
+    match = ADDRESS_LINE.match(text)
+    if not match:
+        return None
+
+    return {'index': int(match.group(1)), 'name': match.group(2), 'family': match.group(3),
+            'address': match.group(4)}
+#---
+
+
+def parseEvent(line):
+    """
+    Parses one line of 'ip -o monitor label' output.
+
+    :param line: Output line.
+    :return: Instance of class:MonitorEvent, or ``None`` for lines which aren't route, link or address changes (or
+        which can't be parsed).
+    """
+    line = line.strip()
+    if not line.startswith('['):
+        return None
+
+    label, _, text = line.partition(']')
+    kind = LABELS.get(label + ']')
+    if kind is None:
+        return None
+
+    action = ADD
+    if text.startswith('Deleted '):
+        action = DELETE
+        text = text[len('Deleted '):]
+
+    if kind == ROUTE_EVENT:
+        try:
+            data = Route(text)
+        except RouteError:
+            return None
+    elif kind == LINK_EVENT:
+        data = backend.parseLinkLine(text)
+    else:
+        data = _parseAddress(text)
+
+    if data is None:
+        return None
+    return MonitorEvent(kind, action, data, line)
+#---
+
+
+# -------- Monitor --------
+
+class Monitor(object):
+    """
+    Delivers kernel route/link/address events.  Either iterate over the monitor (which blocks the calling thread), or
+    register callbacks/queues and call meth:start to have a background thread deliver them.
+    """
+    kinds = (ROUTE_EVENT, LINK_EVENT, ADDRESS_EVENT)
+    process = None
+
+
+    def __init__(self, kinds = None):
+        """
+        Constructor
+
+        :param kinds: Event kinds to watch (ROUTE_EVENT, LINK_EVENT, ADDRESS_EVENT).  Defaults to all of them.
+        """
+        if kinds:
+            self.kinds = tuple(kinds)
+        for kind in self.kinds:
+            if kind not in OBJECTS:
+                raise MonitorError("Unknown event kind: %s" %kind)
+
+        self._callbacks = []
+        self._thread = None
+        self._lock = threading.Lock()
+    #---
+
+
+    def _start(self):
+        """
+        Starts the 'ip monitor' process.
+
+        """
+        with self._lock:
+            if self.process is not None and self.process.poll() is None:
+                raise MonitorError("The monitor is already running.")
+            self.process = subprocess.Popen(['ip', '-o', 'monitor', 'label'] + [OBJECTS[kind] for kind in self.kinds],
+                                            stdout = subprocess.PIPE, universal_newlines = True)
+            return self.process
+    #---
+
+
+    def __iter__(self):
+        """
+        Yields events as they arrive, until meth:stop is called.
+
+        :return: Generator of class:MonitorEvent instances.
+        """
+        process = self._start()
+        try:
+            for line in iter(process.stdout.readline, ''):
+                event = parseEvent(line)
+                if event is not None:
+                    yield event
+        finally:
+            self.stop()
+    #---
+
+
+    def addCallback(self, callback):
+        """
+        Registers a function to call (from the monitor thread) with every event.  Exceptions it raises are logged (see
+        meth:_dispatch).
+
+        :param callback: Callable taking a class:MonitorEvent.
+        """
+        self._callbacks.append(callback)
+    #---
+
+
+    def removeCallback(self, callback):
+        self._callbacks.remove(callback)
+    #---
+
+
+    def addQueue(self, queue, loop = None):
+        """
+        Pushes every event onto a queue.
+
+        :param queue: A Queue.Queue, or an asyncio.Queue when loop is given.
+        :param loop: asyncio event loop which owns queue.  Events are handed over with loop.call_soon_threadsafe.
+        """
+        if loop is None:
+            self.addCallback(queue.put)
+        else:
+            self.addCallback(lambda event: loop.call_soon_threadsafe(queue.put_nowait, event))
+    #---
+
+
+    def _dispatch(self):
+        """
+        Hands every event to every callback.  A callback which raises is logged and skipped for that event; the other
+        callbacks, and the thread, carry on.
+
+        """
+        for event in self:
+            for callback in list(self._callbacks):
+                try:
+                    callback(event)
+                except Exception:
+                    log.exception("Monitor callback %r failed on event %r", callback, event.raw_data)
+    #---
+
+
+    def start(self):
+        """
+        Delivers events to the registered callbacks and queues from a background (daemon) thread.
+
+        """
+        self._thread = threading.Thread(target = self._dispatch, name = 'iproute2-monitor')
+        self._thread.daemon = True
+        self._thread.start()
+    #---
+
+
+    def stop(self):
+        """
+        Stops the monitor.
+
+        """
+        with self._lock:
+            process, self.process = self.process, None
+
+        if process is not None and process.poll() is None:
+            process.terminate()
+            process.wait()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+            self._thread = None
+    #---
+#---
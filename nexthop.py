@@ -0,0 +1,285 @@
+#
+# $Id$
+#
+# NAME:         nexthop.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Nexthops.  class:NextHop is one leg of a multipath (ECMP) route.  class:NexthopObject is a kernel nexthop object
+# ('ip nexthop'), which any number of routes can point at with 'nhid'; replacing the object (or the members of a
+# group) repoints every one of those routes in a single kernel update.
+#
+
+from . import backend
+from . import routegrammar
+
+
+# Exceptions
+class NexthopError(Exception):
+    pass
+
+
+# -------- NextHop --------
+
+class NextHop(object):
+    """
+    One 'nexthop via ... dev ... weight ...' clause of a multipath route.
+    """
+    via = None
+    device = None
+    weight = None
+    flags = []          # 'onlink', 'pervasive', and the 'dead'/'linkdown' flags the kernel reports
+
+
+    def __init__(self, via = None, device = None, weight = None, flags = None):
+        """
+        Constructor
+
+        :param via: Gateway address (optionally preceded by its family, as in 'inet6 fe80::1').
+        :param device: Output interface name.
+        :param weight: Relative weight (string or integer); the kernel treats a missing weight as 1.
+        :param flags: List of nexthop flags.
+        """
+        self.via = via
+        self.device = device
+        self.weight = str(weight) if weight is not None else None
+        self.flags = list(flags or [])
+    #---
+
+
+    def __str__(self):
+        """
+        Converts the nexthop to the iproute2 clause (without the leading 'nexthop').
+        """
+        segments = []
+        if self.via: segments += ['via', self.via]
+        if self.device: segments += ['dev', self.device]
+        if self.weight: segments += ['weight', self.weight]
+        segments += [flag for flag in self.flags if flag in routegrammar.NH.flags]
+
+        return ' '.join(segments)
+    #---
+
+
+    def __repr__(self):
+        return "NextHop(%r)" %str(self)
+    #---
+
+
+    def key(self):
+        """
+        Identifies the nexthop the way the kernel compares them (the weight defaults to 1, state flags don't count).
+
+        """
+        return self.via, self.device, self.weight or '1'
+    #---
+
+
+    def __eq__(self, other):
+        return isinstance(other, NextHop) and self.key() == other.key()
+    #---
+
+
+    def __ne__(self, other):
+        return not self == other
+    #---
+
+
+    def __hash__(self):
+        return hash(self.key())
+    #---
+#---
+
+
+# -------- NexthopObject --------
+
+class NexthopObject(object):
+    """
+    A kernel nexthop object: either a single gateway/device, a blackhole, or a group of other nexthop objects.
+    """
+    id = None
+    via = None
+    device = None
+    group = []          # List of (member id, weight) tuples; weight is ``None`` when not given
+    proto = None
+    scope = None
+    type = None         # Group type ('mpath', 'resilient')
+    flags = []          # 'blackhole', 'onlink', 'fdb'
+    unparsed = []       # Tokens which aren't part of the grammar
+    nexthop = None      # iproute2 string the object was parsed from
+
+
+    def __init__(self, nexthop = None, **attributes):
+        """
+        Constructor
+
+        :param nexthop: Optional 'ip nexthop show' line to parse.
+        :param attributes: Attributes to set (id, via, device, group, proto, flags...).
+        """
+        self.group = []
+        self.flags = []
+        self.unparsed = []
+
+        if nexthop:
+            self.parse(nexthop)
+        for name, value in attributes.items():
+            if not hasattr(self, name):
+                raise NexthopError("%s is not a nexthop attribute" %name)
+            setattr(self, name, value)
+        if self.id is not None:
+            self.id = str(self.id)
+    #---
+
+
+    def __str__(self):
+        """
+        Converts the nexthop object to the iproute2 string taken by 'ip nexthop add'.
+        """
+        if self.id is None:
+            return self.nexthop or ''
+
+        segments = ['id', self.id]
+        if self.group:
+            segments += ['group', formatGroup(self.group)]
+            if self.type: segments += ['type', self.type]
+        elif 'blackhole' in self.flags:
+            segments.append('blackhole')
+        else:
+            if self.via: segments += ['via', self.via]
+            if self.device: segments += ['dev', self.device]
+        segments += [flag for flag in self.flags if flag != 'blackhole']
+        if self.proto: segments += ['proto', self.proto]
+
+        return ' '.join(segments)
+    #---
+
+
+    def parse(self, nexthop):
+        """
+        Parses an 'ip nexthop show' line into this object.
+
+        :param nexthop: iproute2 nexthop string.
+        """
+        self.nexthop = nexthop
+        try:
+            grammar = routegrammar.NEXTHOP(nexthop.split())
+        except (routegrammar.NEXTHOP_Error, IndexError) as error:
+            raise NexthopError("Unable to parse nexthop '%s': %s" %(nexthop, error))
+
+        self.id = grammar.id
+        self.via = grammar.via
+        self.device = grammar.dev
+        self.group = parseGroup(grammar.group) if grammar.group else []
+        self.proto = grammar.proto
+        self.scope = grammar.scope
+        self.type = grammar.type
+        self.flags = list(grammar.FLAGS)
+        self.unparsed = list(grammar.next_data or [])
+    #---
+
+
+    def _ipnexthop(self, arguments):
+        """
+        Wrapper for calls to 'ip nexthop'.
+
+        """
+        return backend.getBackend().ip("nexthop %s" %arguments)
+    #---
+
+
+    def apply(self, replace = False):
+        """
+        Creates the nexthop object, or replaces it in place (which repoints every route using it).
+
+        :param replace: Use 'ip nexthop replace' instead of 'ip nexthop add'.
+        """
+        if self.id is None:
+            raise NexthopError("Nexthop objects need an id.")
+
+        ipnexthop = self._ipnexthop("%s %s" %('replace' if replace else 'add', self))
+        if ipnexthop['return_value']:
+            raise NexthopError("Unexpected error: %s" %ipnexthop['stderr'])
+    #---
+
+
+    def remove(self):
+        """
+        Deletes the nexthop object.  The kernel also deletes every route which points at it.
+
+        """
+        ipnexthop = self._ipnexthop("del id %s" %self.id)
+        if ipnexthop['return_value']:
+            raise NexthopError("Unexpected error: %s" %ipnexthop['stderr'])
+    #---
+#---
+
+
+def parseGroup(group):
+    """
+    Parses a nexthop group ('1/2', '1,3/2,5').
+
+    :param group: Group string.
+    :return: List of (member id, weight) tuples.
+    """
+    members = []
+    for member in group.split('/'):
+        member_id, _, weight = member.partition(',')
+        members.append((member_id, weight or None))
+    return members
+#---
+
+
+def formatGroup(members):
+    """
+    Formats a list of (member id, weight) tuples as a nexthop group string.
+
+    """
+    return '/'.join("%s,%s" %(member_id, weight) if weight else str(member_id) for member_id, weight in members)
+#---
+
+
+def listNexthops():
+    """
+    Reads the kernel's nexthop objects.
+
+    :return: Dictionary of id -> class:NexthopObject.
+    """
+    nexthops = {}
+    try:
+        for line in backend.getBackend().ipStream("nexthop show"):
+            if line.strip():
+                nexthop = NexthopObject(line.strip())
+                nexthops[nexthop.id] = nexthop
+    except backend.BackendError as error:
+        raise NexthopError(str(error))
+    return nexthops
+#---
+
+
+def applyNexthops(nexthops, replace = True):
+    """
+    Pushes many nexthop objects through one batch.  Single nexthops go first, so groups can refer to them.
+
+    :param nexthops: Iterable of class:NexthopObject instances.
+    :param replace: Use 'ip nexthop replace' (the default) instead of 'ip nexthop add'.
+    :return: List of (NexthopObject, error text) tuples for the objects which failed.
+    """
+    nexthops = sorted(nexthops, key = lambda nexthop: bool(nexthop.group))
+    ip_batch = backend.getBackend().batch(["nexthop %s %s" %('replace' if replace else 'add', nexthop)
+                                           for nexthop in nexthops])
+    return [(nexthops[index], ip_batch['errors'][index]) for index in sorted(ip_batch['errors'])]
+#---
@@ -23,21 +23,36 @@
 # many things.  It spun out of my need to parse iproute2 grammars, so bear that in mind.
 #
 
-from lib import orderedset
+
+from . import instrument
+
 
 class ParseNode(object):
-    raw_data = ''       # The node's raw, text data
-    next_data = None    # Data which will be passed to the child nodes of this node
-    child_classes = orderedset.OrderedSet() # Ordered list of the parser nodes 'under' this node (child_classes)
-    children = {}
+    """
+    Base grammar node.  Nodes keep all of their state in __slots__ (subclasses list their variables in their own
+    __slots__), so parse trees are small and never share anything between instances or threads.
+    """
+    __slots__ = ('raw_data', 'next_data', 'children')
+    options = ()        # Keywords which take a single value (see meth:keywordHandlers)
 
-    def __init__(self, tokens, child_class_list = list()):
+    #   raw_data:   The node's raw, text data
+    #   next_data:  Data which will be passed to the child nodes (or the next sibling) of this node.  Once it has
+    #               been handed on it's dropped, and a parent ends up with whatever its last child didn't use, so the
+    #               tokens a tree consumed aren't kept alive by it.
+    #   children:   Tuple of the child nodes, in parse order (look them up by class name with node['NAME'])
+
+    def __init__(self, tokens, child_class_list = ()):
         """
         Constructor.  Calls meth:parse to parse the incoming tokens and then adds any child nodes.
         :param tokens: List of text tokens to parse
         :param child_class_list: List of child classes to parse token lists
 
         """
+        for field in self.fields():
+            setattr(self, field, None)
+        self.raw_data = ''
+        self.children = ()
+
         # The token list can potentially be empty (not all grammar options are used)
         if tokens:
             self.next_data = self.parse(tokens)    # Call the child class' parser
@@ -51,58 +66,96 @@ class ParseNode(object):
     #---
 
 
+    @classmethod
+    def fields(cls):
+        """
+        Returns the names of the variables of this class (every __slots__ entry along the class hierarchy).
+
+        :return: Tuple of names.
+        """
+        fields = cls.__dict__.get('_fields')
+        if fields is None:
+            fields = []
+            for klass in reversed(cls.__mro__):
+                fields += [name for name in klass.__dict__.get('__slots__', ()) if name not in fields]
+            fields = tuple(fields)
+            cls._fields = fields
+        return fields
+    #---
+
+
+    def _child(self, name):
+        """
+        Finds a node below this one by class name, searching children before grandchildren.
+
+        :return: Instance of class:ParseNode, or ``None``.
+        """
+        for child in self.children:
+            if child.__class__.__name__ == name:
+                return child
+        for child in self.children:
+            node = child._child(name)
+            if node is not None:
+                return node
+        return None
+    #---
+
+
     # Dictionary type getter/setters
 
     def __getitem__(self, item):
         """
-        Getter for dictionary style operation.  Supports class variables and referencing child classes by their class
-        names.
+        Getter for dictionary style operation.  Supports the node's variables and referencing nodes below this one by
+        their class names.
         :param item: String
 
         """
-        try:
-            return self.__dict__[item]
-        # If the item doesn't exist, see if it matches a child's name
-        except KeyError:
-            if item in self.children:
-                return self.children[item]
-            else:
-                raise
+        if item in self.fields():
+            return getattr(self, item)
+
+        node = self._child(item)
+        if node is None:
+            raise KeyError(item)
+        return node
     #---
 
 
     def __setitem__(self, key, value):
         """
-        Setter for dictionary style operation.  Supports class variables and referencing child classes by their class
+        Setter for dictionary style operation.  Supports the node's variables and replacing child nodes by their class
         names.
         :param key: String
         :param value: String
 
         """
-        try:
-            self.__dict__[key] = value
-        except KeyError:
-            if key in self.children:
-                self.children[key] = value
-            else:
-                raise
+        if key in self.fields():
+            setattr(self, key, value)
+            return
+
+        children = list(self.children)
+        for position, child in enumerate(children):
+            if child.__class__.__name__ == key:
+                children[position] = value
+                self.children = tuple(children)
+                return
+        raise KeyError(key)
     #---
 
 
     def __delitem__(self, key):
         """
-        Deletion operator for dictionary style operation.  Supports class variables and referencing child classes by
-        their class names.
+        Deletion operator for dictionary style operation.  Variables are reset to ``None``; child nodes are dropped.
         :param key: String
 
         """
-        try:
-            del self.__dict__[key]
-        except KeyError:
-            if key in self.children:
-                del self.children[key]
-            else:
-                raise
+        if key in self.fields():
+            setattr(self, key, None)
+            return
+
+        children = tuple(child for child in self.children if child.__class__.__name__ != key)
+        if len(children) == len(self.children):
+            raise KeyError(key)
+        self.children = children
     #---
 
 
@@ -110,21 +163,98 @@ class ParseNode(object):
     def _addRawSegment(self, segment): self.raw_data += "%s " %segment
 
 
+    @classmethod
+    def keywordHandlers(cls):
+        """
+        Returns the keyword -> handler table of this class, building it the first time it's needed.  Every grammar
+        class gets its own table, made from its cls.options tuple.  A handler is called as handler(node, tokens,
+        position) and returns the position of the next token to parse, or ``None`` if it didn't use the token.  Options
+        use meth:_parseOption unless the class defines its own handler, named after the option ('via' -> _parseVia).
+
+        :return: Dictionary of keyword to handler.
+        """
+        handlers = cls.__dict__.get('_keyword_handlers')
+        if handlers is None:
+            handlers = dict((option, getattr(cls, '_parse' + option.capitalize(), cls._parseOption))
+                            for option in cls.options)
+            cls._keyword_handlers = handlers
+        return handlers
+    #---
+
+
+    def _parseOption(self, tokens, position):
+        """
+        Keyword handler for options: stores the value which follows the keyword under the keyword's name.
+
+        :param tokens: List of text tokens
+        :param position: Position of the keyword in tokens
+        :return: Position of the token after the value, or ``None`` if the keyword has no value.
+        """
+        if position + 1 >= len(tokens):
+            return None
+
+        self[tokens[position]] = tokens[position + 1]
+        self._addRawSegment(tokens[position])
+        self._addRawSegment(tokens[position + 1])
+        return position + 2
+    #---
+
+
+    def _parseKeywords(self, tokens, position = 0):
+        """
+        Walks the tokens once, from position to the end, handing each keyword to its handler (see meth:keywordHandlers).
+
+        :param tokens: List of text tokens
+        :param position: Position of the first token to look at
+        :return: Tuple of the tokens that were not used by the parser, in their original order.
+        """
+        handlers = self.keywordHandlers()
+        unused = []
+        token_count = len(tokens)
+
+        while position < token_count:
+            handler = handlers.get(tokens[position])
+            next_position = handler(self, tokens, position) if handler else None
+
+            if next_position is None:
+                unused.append(tokens[position])
+                position += 1
+            else:
+                position = next_position
+
+        # Clean up raw_data
+        self.raw_data = self.raw_data.strip()
+
+        # A tuple is smaller than a list, and every node with nothing left over shares the empty one
+        return tuple(unused)
+    #---
+
+
     def addChildren(self, nodes, node_data):
         """
-        Adds children to the child_classes ordered set.
+        Parses the child nodes, in order, each one getting the tokens the one before it didn't use.
 
-        :param nodes: List of instances of class:ParseNode
+        :param nodes: List of subclasses of class:ParseNode
 
         """
         data = node_data
+        children = list(self.children)
+        timed = instrument.enabled
         for node in nodes:
+            if children:
+                children[-1].next_data = None
             # Instantiate the grammar node
-            new_node = node(data)
-            # Save the new, instantiated node in a dict by it's class name
-            self.children[new_node.__class__.__name__] = new_node
+            if timed:
+                start = instrument.timer()
+                new_node = node(data)
+                instrument.record(instrument.PARSE, node.__name__, instrument.timer() - start, len(data or ()))
+            else:
+                new_node = node(data)
+            children.append(new_node)
             # Save unused data to be used by next node
             data = new_node.next_data
+        self.children = tuple(children)
+        self.next_data = data
     #---
 #---
 
@@ -0,0 +1,286 @@
+#
+# $Id$
+#
+# NAME:         radix.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   A path compressed binary (Patricia) trie over integer prefixes, used for longest prefix match lookups.  Each
+# prefix can carry several values (routes with the same prefix but a different metric or tos, for example).  Nodes
+# without values only exist where two branches split.
+#
+
+from . import ipprefix
+
+
+class RadixNode(object):
+    """
+    A node in the trie.  address is always masked to length.
+    """
+    __slots__ = ('address', 'length', 'children', 'values')
+
+    def __init__(self, address, length, values = None):
+        self.address = address
+        self.length = length
+        self.children = [None, None]
+        self.values = values if values is not None else []
+    #---
+#---
+
+
+class RadixTree(object):
+    """
+    Longest prefix match trie for one IP version.
+    """
+    version = None
+    bits = 0
+    root = None
+
+
+    def __init__(self, version = ipprefix.IP_V4):
+        """
+        Constructor
+
+        :param version: IP version of the prefixes held (ipprefix.IP_V4 or ipprefix.IP_V6).
+        """
+        self.version = version
+        self.bits = ipprefix.MAX_LENGTH[version]
+        self.root = None
+    #---
+
+
+    def _mask(self, address, length):
+        return address & ipprefix.networkMask(self.version, length)
+    #---
+
+
+    def _bit(self, address, position):
+        """
+        Returns the bit of address at position (0 being the most significant).
+
+        """
+        return (address >> (self.bits - 1 - position)) & 1
+    #---
+
+
+    def _common(self, address, length, node):
+        """
+        Returns the length of the prefix shared by (address, length) and a node.
+
+        """
+        limit = min(length, node.length)
+        difference = (address ^ node.address) & ipprefix.networkMask(self.version, limit)
+        if not difference:
+            return limit
+        return self.bits - difference.bit_length()
+    #---
+
+
+    def insert(self, address, length, value):
+        """
+        Adds a value under a prefix.
+
+        :param address: Network address as an integer (host bits are ignored).
+        :param length: Prefix length.
+        :param value: Value to store.
+        """
+        address = self._mask(address, length)
+        parent = None
+        node = self.root
+
+        while node is not None:
+            common = self._common(address, length, node)
+
+            # The new prefix branches off above this node: put a node in between
+            if common < node.length:
+                if common == length:
+                    between = RadixNode(address, length, [value])
+                else:
+                    between = RadixNode(self._mask(address, common), common)
+                    between.children[self._bit(address, common)] = RadixNode(address, length, [value])
+                between.children[self._bit(node.address, common)] = node
+                self._replace(parent, node, between)
+                return
+
+            if node.length == length:
+                node.values.append(value)
+                return
+
+            parent = node
+            node = node.children[self._bit(address, node.length)]
+
+        self._replace(parent, None, RadixNode(address, length, [value]), address)
+    #---
+
+
+    def _replace(self, parent, old, new, address = None):
+        """
+        Hangs new in place of old under parent (or at the root).
+
+        """
+        if parent is None:
+            self.root = new
+        elif old is not None:
+            parent.children[parent.children.index(old)] = new
+        else:
+            parent.children[self._bit(address, parent.length)] = new
+    #---
+
+
+    def remove(self, address, length, value):
+        """
+        Removes a value from a prefix, dropping nodes which are no longer needed.
+
+        :param address: Network address as an integer.
+        :param length: Prefix length.
+        :param value: Value to remove.
+        :return: ``True`` if the value was found.
+        """
+        address = self._mask(address, length)
+        path = []
+        node = self.root
+
+        while node is not None and node.length <= length:
+            if self._common(address, length, node) < node.length:
+                break
+            if node.length == length:
+                if value not in node.values:
+                    return False
+                node.values.remove(value)
+                self._prune(path, node)
+                return True
+            path.append(node)
+            node = node.children[self._bit(address, node.length)]
+
+        return False
+    #---
+
+
+    def _prune(self, path, node):
+        """
+        Drops a node which no longer holds values, collapsing it into its child when it has one.  A node that is dropped
+        outright may leave its parent with a single child, so the parent is checked next.
+
+        :param path: Ancestors of node, root first.
+        :param node: Node to check.
+        """
+        while node is not None and not node.values:
+            children = [child for child in node.children if child is not None]
+            if len(children) == 2:
+                return
+
+            parent = path.pop() if path else None
+            self._replace(parent, node, children[0] if children else None)
+            if children:
+                return
+            node = parent
+    #---
+
+
+    def lookup(self, address):
+        """
+        Longest prefix match.
+
+        :param address: Address as an integer.
+        :return: Tuple of (network, length, values) for the most specific prefix containing address, or ``None``.
+        """
+        best = None
+        node = self.root
+
+        while node is not None:
+            if self._common(address, self.bits, node) < node.length:
+                break
+            if node.values:
+                best = node
+            if node.length == self.bits:
+                break
+            node = node.children[self._bit(address, node.length)]
+
+        if best is None:
+            return None
+        return best.address, best.length, best.values
+    #---
+
+
+    def covering(self, address, length):
+        """
+        Finds every prefix which contains (or equals) a prefix.
+
+        :param address: Network address as an integer.
+        :param length: Prefix length.
+        :return: List of (network, length, values) tuples, least specific first.
+        """
+        found = []
+        node = self.root
+
+        while node is not None and node.length <= length:
+            if self._common(address, length, node) < node.length:
+                break
+            if node.values:
+                found.append((node.address, node.length, node.values))
+            if node.length == length:
+                break
+            node = node.children[self._bit(address, node.length)]
+
+        return found
+    #---
+
+
+    def coveredBy(self, address, length):
+        """
+        Finds every prefix contained in (or equal to) a prefix.
+
+        :param address: Network address as an integer.
+        :param length: Prefix length.
+        :return: List of (network, length, values) tuples, in address order.
+        """
+        node = self.root
+
+        while node is not None:
+            common = self._common(address, length, node)
+            if common >= length:
+                return list(self._walk(node))
+            if common < node.length:
+                break
+            node = node.children[self._bit(address, node.length)]
+
+        return []
+    #---
+
+
+    def _walk(self, node):
+        """
+        Yields every valued node under (and including) node, in address order.
+
+        """
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.values:
+                yield node.address, node.length, node.values
+            for child in reversed(node.children):
+                if child is not None:
+                    stack.append(child)
+    #---
+
+
+    def __iter__(self):
+        if self.root is not None:
+            for entry in self._walk(self.root):
+                yield entry
+    #---
+#---
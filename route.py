@@ -23,7 +23,10 @@
 #   planned.
 #
 
-from lib import nixcommon
+from . import backend
+from . import ipprefix
+from . import nexthop
+from . import routegrammar
 
 # Exceptions
 class RouteError(Exception):
@@ -33,6 +36,13 @@ class RouteError(Exception):
 TYPE = ('unicast', 'local', 'broadcast', 'multicast', 'throw', 'unreachable', 'prohibit', 'blackhole', 'nat')
 SCOPE = ('host', 'link', 'global', "%d")
 
+# Kernel defaults, used when a route doesn't say
+DEFAULT_METRIC = {ipprefix.IP_V4: 0, ipprefix.IP_V6: 1024}
+TABLE_IDS = {'default': '253', 'main': '254', 'local': '255'}
+
+# Attributes compared by meth:Route.matches
+MATCH_ATTRIBUTES = ('nexthop', 'device', 'source', 'proto', 'scope', 'nhflags', 'nhid')
+
 # Route
 class Route(object):
     """
@@ -43,16 +53,40 @@ class Route(object):
     source = None
     device = None
     description = None
-    options = []
+    options = []            # Route OPTIONS other than 'src', as a flat list of keyword/value tokens
+    route = None            # iproute2 string the route was parsed from
+
+    # NODE_SPEC options
+    type = None
+    tos = None
+    table = None
+    proto = None
+    scope = None
+    metric = None
+
+    nhflags = None
+    nexthops = []           # class:nexthop.NextHop instances of a multipath route (nexthop/device are then unset)
+    nhid = None             # Kernel nexthop object the route points at (see class:nexthop.NexthopObject)
+    unparsed = []           # Tokens from the parsed string which aren't part of the grammar ('linkdown', 'pref', ...)
+    family = None           # IP version of the table listing the route came from, which a 'default dev X' route
+                            # needs (nothing in its text tells the versions apart)
 
 
-    def __init__(self, route = None):
+    def __init__(self, route = None, family = None):
         """
         Constructor
 
+        :param route: Optional iproute2 route string (as printed by 'ip route show') to parse.
+        :param family: IP version the route was listed under ('ip -6 route show' gives 6).
         """
+        self.options = []
+        self.nexthops = []
+        self.unparsed = []
+        self.family = family
+
         if route:
             self.route = route
+            self.parse()
 
     #---
 
@@ -61,23 +95,150 @@ class Route(object):
         """
         Converts route to iproute2 string.
         """
+        return self.render()
+    #---
+
+
+    def render(self, table = None):
+        """
+        Converts route to iproute2 string.
+
+        :param table: Table to name when the route doesn't name one itself.
+        """
+        if not self.network:
+            return self.route or ''
+
+        segments = [self.type] if self.type else []
+        segments.append(self.network)
+        for option in ('tos', 'table', 'proto', 'scope', 'metric'):
+            value = getattr(self, option)
+            if option == 'table' and value is None:
+                value = table
+            if value is not None:
+                segments += [option, str(value)]
+        # A nexthop object replaces the route's own nexthops (the kernel refuses both)
+        if self.nhid is not None:
+            segments += ['nhid', self.nhid]
+        elif not self.nexthops:
+            if self.nexthop: segments += ['via', self.nexthop]
+            if self.device: segments += ['dev', self.device]
+            if self.nhflags: segments.append(self.nhflags)
+        if self.source: segments += ['src', self.source]
+        segments += self.options
+
+        # 'nexthop' clauses have to come last: 'ip' reads everything after the first one as nexthops
+        if self.nhid is None:
+            for route_nexthop in self.nexthops:
+                segments += ['nexthop', str(route_nexthop)]
+
+        return ' '.join(segments)
+    #---
+
+
+    def version(self):
+        """
+        Works out the IP version of the route: the family it was listed under if that's known, otherwise its prefix
+        ('default' routes go by their nexthop or source, and are taken as IPv4 when they have neither).
+
+        :return: ipprefix.IP_V4 or ipprefix.IP_V6
+        """
+        if self.family:
+            return int(self.family)
+        gateway = self.nexthop or (self.nexthops[0].via if self.nexthops else None)
+        address = self.network if self.network != 'default' else (gateway or self.source or '')
+        return ipprefix.IP_V6 if ':' in address else ipprefix.IP_V4
+    #---
+
+
+    def key(self, table = None):
+        """
+        Identifies the route the way the kernel does, by (prefix, tos, metric, table).  Prefixes are compared as
+        networks and defaults are filled in, so different spellings of the same route give the same key.
+
+        :param table: Table to assume when the route doesn't name one.
+        :return: Hashable tuple.
+        """
+        version = self.version()
+        if self.network == 'default':
+            address, length = 0, 0
+        else:
+            version, address, length = ipprefix.parsePrefix(self.network)
+            address &= ipprefix.networkMask(version, length)
+
+        tos = self.tos or '0'
+        try:
+            tos = int(tos, 0)
+        except ValueError:
+            pass
+
+        metric = int(self.metric) if self.metric is not None else DEFAULT_METRIC[version]
+        table = str(self.table or table or 'main')
+
+        return version, address, length, tos, metric, TABLE_IDS.get(table, table)
+    #---
+
+
+    def matches(self, other):
+        """
+        Checks whether another route (normally one read back from the kernel) satisfies this one.  Only the attributes
+        set on this route are compared, so anything the kernel fills in by itself doesn't count as a difference.
+
+        :param other: Instance of class:Route with the same meth:key.
+        :return: ``True`` if the routes match.
+        """
+        if (self.type or 'unicast') != (other.type or 'unicast'):
+            return False
+
+        for attribute in MATCH_ATTRIBUTES:
+            value = getattr(self, attribute)
+            if value is not None and value != getattr(other, attribute):
+                return False
+
+        # Multipath routes match on the set of nexthops, whatever order the kernel lists them in
+        if self.nexthops and set(self.nexthops) != set(other.nexthops):
+            return False
+
+        other_options = dict(zip(other.options[::2], other.options[1::2]))
+        for option, value in zip(self.options[::2], self.options[1::2]):
+            if other_options.get(option) != value:
+                return False
+
+        return True
     #---
 
 
     def _iproute(self, arguments):
         """
-        Wrapper for calls to 'ip route'.
+        Wrapper for calls to 'ip route', for the route's IP version.
 
         """
-        return nixcommon.runProcess("ip route %s" %arguments)
+        return backend.getBackend().ip("-%d route %s" %(self.version(), arguments))
     #---
 
 
     def validate(self):
         """
-        Validates a route based on it's network definition.
+        Validates a route based on it's network definition: the prefix has to be valid and, as the kernel requires, have
+        no host bits set.  Checks which involve other routes are in meth:routingtable.RoutingTable.validate.
 
+        :raise RouteError: If the network isn't valid.
         """
+        if self.network in (None, 'default'):
+            return
+
+        try:
+            version, address, length = ipprefix.parsePrefix(self.network)
+        except ipprefix.PrefixError:
+            # Non-canonical spellings go by the grammar, which can't tell where the host bits are
+            error_txt = routegrammar.NODE_SPEC.validatePrefix(self.network)
+            if error_txt:
+                raise RouteError("Invalid network %s: %s" %(self.network, error_txt))
+            return
+
+        network = address & ipprefix.networkMask(version, length)
+        if network != address:
+            raise RouteError("Invalid network %s: host bits are set (the network is %s)"
+                             %(self.network, ipprefix.formatPrefix(version, network, length)))
     #---
 
 
@@ -86,22 +247,56 @@ class Route(object):
         Applies the route to the appropriate table.
 
         """
-        if not self.route:
+        route_cfg = str(self)
+        if not route_cfg:
             raise RouteError('Invalid routing entry (blank).')
 
         self.validate()
-        route_cfg = "add %s" %self.network
+        iproute = self._iproute("add %s" %route_cfg)
 
-        if self.device: route_cfg += "device %s" %self.device
-        if self.nexthop: route_cfg += "via %s" %self.nexthop
-
-        self._iproute(route_cfg)
+        if iproute['return_value']:
+            raise RouteError("Unexpected error: %s" %iproute['stderr'])
     #---
 
-    def parse(self):
+    def parse(self, route = None):
         """
-        Parses a routing string from iproute2.
+        Parses a routing string from iproute2 (through class:routegrammar.ROUTE) into this route.
 
+        :param route: iproute2 route string.  Defaults to the string the route was constructed with.
         """
+        if route:
+            self.route = route
+        if not self.route:
+            raise RouteError('Invalid routing entry (blank).')
+
+        try:
+            grammar = routegrammar.ROUTE(self.route.split())
+        except (routegrammar.NODE_SPEC_Error, routegrammar.INFO_SPEC_Error, IndexError) as error:
+            raise RouteError("Unable to parse route '%s': %s" %(self.route, error))
+
+        node_spec = grammar['NODE_SPEC']
+        self.type = node_spec.TYPE
+        self.network = node_spec.PREFIX
+        for option in ('tos', 'table', 'proto', 'scope', 'metric'):
+            setattr(self, option, getattr(node_spec, option))
+
+        nh = grammar['NH']
+        self.nexthop = nh.via
+        self.device = nh.dev
+        self.nhflags = nh.NHFLAGS
+
+        info_spec = grammar['INFO_SPEC']
+        self.nhid = info_spec.nhid
+        self.nexthops = [nexthop.NextHop(hop.via, hop.dev, hop.weight, hop.HOPFLAGS)
+                         for hop in info_spec.nexthops or ()]
+
+        options = grammar['OPTIONS']
+        self.source = options.src
+        self.options = []
+        for option in options.options:
+            if option != 'src' and getattr(options, option) is not None:
+                self.options += [option, getattr(options, option)]
+
+        self.unparsed = list(options.next_data or [])
     #---
 #---
@@ -23,7 +23,8 @@
 #
 
 import sys
-import parsenode
+from . import parsenode
+from . import ipprefix
 import cidrize
 
 # -------- NODE_SPEC --------
@@ -36,17 +37,12 @@ class NODE_SPEC(parsenode.ParseNode):
     Defines the 'NODE_SPEC' segment of the iproute2 routing grammar.
     """
     # Defined by iproute2's grammar
-    types = ('unicast', 'local', 'broadcast', 'multicast', 'throw', 'unreachable', 'prohibit', 'blackhole', 'nat')
+    types = ('unicast', 'local', 'broadcast', 'multicast', 'throw', 'unreachable', 'prohibit', 'blackhole', 'nat',
+             'anycast')
     options = ('tos','table','proto','scope','metric')
 
     # NODE_SPEC variables/options
-    TYPE = None
-    PREFIX = None
-    tos = None
-    table = None
-    proto = None
-    scope = None
-    metric = None
+    __slots__ = ('TYPE', 'PREFIX', 'tos', 'table', 'proto', 'scope', 'metric')
 
     def __init__(self, tokens):
         """
@@ -68,58 +64,56 @@ class NODE_SPEC(parsenode.ParseNode):
 
         """
 
+        position = 0
+
         # Type is optional
         if tokens[0] in self.types:
             self.TYPE = tokens[0]
             self._addRawSegment(self.TYPE)      # Make sure we have the string segment stored
-            tokens.remove(tokens[0])
+            position += 1
 
         # PREFIX validation
-        error_txt = self.validatePrefix(tokens[0])
+        if position >= len(tokens):
+            raise NODE_SPEC_Error("Prefix is missing")
+
+        error_txt = self.validatePrefix(tokens[position])
         if not error_txt:
-            self.PREFIX = tokens[0]
+            self.PREFIX = tokens[position]
             self._addRawSegment(self.PREFIX)     # Make sure we have the string segment stored
-            tokens.remove(tokens[0])
+            position += 1
         else:
-            raise NODE_SPEC_Error("Prefix (%s) did not pass validation, %s" %(tokens[0], error_txt))
+            raise NODE_SPEC_Error("Prefix (%s) did not pass validation, %s" %(tokens[position], error_txt))
 
         # Option parsing
-        new_token_list = list(tokens)
-        matched_option = False
-        for token in tokens:
-            # If we matched a token, it had a parameter we need to ignore
-            if matched_option:
-                matched_option = False
-                continue
-
-            # If the token is matched, store it
-            if token in self.options:
-                self[token] = tokens[tokens.index(token)+1]
-                self._addRawSegment(token)
-                self._addRawSegment(self[token])
-                new_token_list.pop(new_token_list.index(token)+1)   # remove option parameter
-                new_token_list.remove(token)                # remove the option from the list
-                matched_option = True
-
-        # Clean up raw_data
-        self.raw_data = self.raw_data.strip()
-
-        return new_token_list
+        return self._parseKeywords(tokens, position)
     #---
 
 
-    def validatePrefix(self, prefix):
+    @staticmethod
+    def validatePrefix(prefix):
         """
-        Validates an Internet network or ip address (/32).
+        Validates an Internet network or ip address (/32).  Canonical prefixes are checked by the (cached) strict
+        parser in class:ipprefix; cidrize is only used for anything that parser rejects.
 
         :param prefix, The network in CIDR notation.
         :return, Text of error from cidrize on error, otherwise None.
 
         """
+        # iproute2's name for 0/0
+        if prefix == 'default':
+            return None
+
+        try:
+            ipprefix.parsePrefix(prefix)
+        except ipprefix.PrefixError:
+            pass
+        else:
+            return None
+
         try:
             cidrize.cidrize(prefix)
         except cidrize.CidrizeError:
-            return sys.exc_value
+            return sys.exc_info()[1]
         else:
             return None
     #---
@@ -134,12 +128,11 @@ class NH(parsenode.ParseNode):
     """
     options = ('via', 'dev', 'weight')
     flags = ('onlink', 'pervasive')
+    hop_flags = ('onlink', 'pervasive', 'dead', 'linkdown')     # Flags 'ip' prints after each multipath nexthop
+    families = ('inet', 'inet6')
 
-    # NH variables/options
-    NHFLAGS = None
-    via = None
-    dev = None
-    weight = None
+    # NH variables/options (HOPFLAGS is only set on the NH nodes of multipath 'nexthop' clauses)
+    __slots__ = ('NHFLAGS', 'via', 'dev', 'weight', 'HOPFLAGS')
 
 
     def __init__(self, tokens):
@@ -156,34 +149,29 @@ class NH(parsenode.ParseNode):
         :return, Array of tokens that were not used by the parser.
 
         """
+        position = 0
+
         # NHFLAGS is optional
         if tokens[0] in self.flags:
             self.NHFLAGS = tokens[0]
             self._addRawSegment(self.NHFLAGS)      # Make sure we have the string segment stored
-            tokens.remove(tokens[0])
+            position += 1
 
         # Option parsing
-        new_token_list = list(tokens)
-        matched_option = False
-        for token in tokens:
-            # If we matched a token, it had a parameter we need to ignore
-            if matched_option:
-                matched_option = False
-                continue
+        return self._parseKeywords(tokens, position)
+    #---
 
-            # If the token is matched, store it
-            if token in self.options:
-                self[token] = tokens[tokens.index(token)+1]
-                self._addRawSegment(token)
-                self._addRawSegment(self[token])
-                new_token_list.pop(new_token_list.index(token)+1)   # remove option parameter
-                new_token_list.remove(token)                # remove the option from the list
-                matched_option = True
 
-        # Clean up raw_data
-        self.raw_data = self.raw_data.strip()
+    def _parseVia(self, tokens, position):
+        """
+        Keyword handler for 'via', which may name the gateway's address family ('via inet6 fe80::1' on an IPv4 route).
 
-        return new_token_list
+        """
+        if position + 2 < len(tokens) and tokens[position + 1] in self.families:
+            self.via = "%s %s" %(tokens[position + 1], tokens[position + 2])
+            self._addRawSegment("via %s" %self.via)
+            return position + 3
+        return self._parseOption(tokens, position)
     #---
 #----
 
@@ -194,24 +182,14 @@ class OPTIONS(parsenode.ParseNode):
     """
     Defines the 'OPTIONS' segment of the iproute2 routing grammar.
     """
-    options = ('mtu', 'advmss','rtt','rttvar','reordering','window','cwnd','initcwnd','ssthresh','realms','src',
-               'rto_min','hoplimit','initrwnd')
+    options = ('mtu', 'advmss','rtt','rttvar','reordering','window','cwnd','initcwnd','ssthresh','realm','realms',
+               'src','rto_min','hoplimit','initrwnd','congctl','features','quickack','fastopen_no_cookie')
+    # Metrics which take a 'lock' modifier ('mtu lock 1400'), so the kernel never changes them on its own
+    lockable = ('mtu', 'advmss', 'rtt', 'rttvar', 'reordering', 'window', 'cwnd', 'initcwnd', 'ssthresh', 'rto_min',
+                'hoplimit', 'initrwnd', 'congctl')
 
     # OPTIONS variables/options
-    mtu = None
-    advmss = None
-    rtt = None
-    rttvar = None
-    reordering = None
-    window = None
-    cwnd = None
-    initcwnd = None
-    ssthresh = None
-    realms = None
-    src = None
-    rto_min = None
-    hoplimit = None
-    initrwnd = None
+    __slots__ = options
 
 
     def __init__(self, tokens):
@@ -229,27 +207,26 @@ class OPTIONS(parsenode.ParseNode):
 
         """
         # Option parsing
-        new_token_list = list(tokens)
-        matched_option = False
-        for token in tokens:
-            # If we matched a token, it had a parameter we need to ignore
-            if matched_option:
-                matched_option = False
-                continue
+        return self._parseKeywords(tokens)
+    #---
 
-            # If the token is matched, store it
-            if token in self.options:
-                self[token] = tokens[tokens.index(token)+1]
-                self._addRawSegment(token)
-                self._addRawSegment(self[token])
-                new_token_list.pop(new_token_list.index(token)+1)   # remove option parameter
-                new_token_list.remove(token)                # remove the option from the list
-                matched_option = True
 
-        # Clean up raw_data
-        self.raw_data = self.raw_data.strip()
+    def _parseOption(self, tokens, position):
+        """
+        Keyword handler for options.  A locked metric keeps its modifier in the value ('lock 1400'), so it renders
+        back the way it was given.
+
+        """
+        keyword = tokens[position]
+        if keyword not in self.lockable or position + 1 >= len(tokens) or tokens[position + 1] != 'lock':
+            return super(OPTIONS,self)._parseOption(tokens, position)
+        if position + 2 >= len(tokens):
+            return None
 
-        return new_token_list
+        self[keyword] = "lock %s" %tokens[position + 2]
+        self._addRawSegment(keyword)
+        self._addRawSegment(self[keyword])
+        return position + 3
     #---
 #----
 
@@ -261,10 +238,13 @@ class INFO_SPEC_Error(Exception):
 
 class INFO_SPEC(parsenode.ParseNode):
     """
-    Defines the 'INFO_SPEC' segment of the iproute2 routing grammar.
+    Defines the 'INFO_SPEC' segment of the iproute2 routing grammar.  A route has either one NH (the NH child), a
+    kernel nexthop object ('nhid'), or several 'nexthop NH' clauses (multipath), which are kept in self.nexthops.
     """
-    #TODO: This is reference to NH according to the grammar, and there can be multiples.  Fix it to support this.
-    nexthop = None
+    options = ('nhid',)
+
+    # INFO_SPEC variables/options.  nexthops holds the NH nodes of the 'nexthop' clauses, in order.
+    __slots__ = ('nhid', 'nexthops')
 
 
     def __init__(self, tokens):
@@ -272,7 +252,162 @@ class INFO_SPEC(parsenode.ParseNode):
     #---
 
     def parse(self, tokens):
-        return tokens
+        """
+        Splits off the 'nexthop' clauses (each runs until the next 'nexthop' keyword) and parses each one with NH.
+        Whatever the clauses don't use is handed on to the NH and OPTIONS children.
+
+        :param tokens:
+        :return, Array of tokens that were not used by the parser.
+
+        """
+        nexthops = []
+        unused = []
+        position = 0
+        token_count = len(tokens)
+
+        while position < token_count:
+            if tokens[position] != 'nexthop':
+                unused.append(tokens[position])
+                position += 1
+                continue
+
+            end = position + 1
+            while end < token_count and tokens[end] != 'nexthop':
+                end += 1
+            clause = tokens[position + 1:end]
+            position = end
+
+            nexthop = NH(clause) if clause else None
+            if nexthop is None or (nexthop.via is None and nexthop.dev is None):
+                raise INFO_SPEC_Error("Nexthop without a gateway or device: nexthop %s" %' '.join(clause))
+
+            # Flags after the first token are per-nexthop flags; anything else belongs to the route
+            nexthop.HOPFLAGS = [nexthop.NHFLAGS] if nexthop.NHFLAGS else []
+            for token in nexthop.next_data or []:
+                if token in NH.hop_flags:
+                    nexthop.HOPFLAGS.append(token)
+                else:
+                    unused.append(token)
+            nexthops.append(nexthop)
+
+        self.nexthops = tuple(nexthops)
+        return self._parseKeywords(unused)
+    #---
+#---
+
+
+# -------- NEXTHOP --------
+
+class NEXTHOP_Error(Exception):
+    pass
+
+class NEXTHOP(NH):
+    """
+    A kernel nexthop object, as printed by 'ip nexthop show' and taken by 'ip nexthop add' (not part of the route
+    grammar itself).  Shares NH's handling of 'via'.
+    """
+    options = ('id', 'via', 'dev', 'group', 'proto', 'scope', 'type')
+    flags = ('blackhole', 'onlink', 'fdb')
+
+    # NEXTHOP variables/options (via and dev come from NH)
+    __slots__ = ('id', 'group', 'proto', 'scope', 'type', 'FLAGS')
+
+
+    def __init__(self, tokens):
+        super(NEXTHOP,self).__init__(tokens)
+    #---
+
+
+    def parse(self, tokens):
+        """
+        Parses an 'ip nexthop' object.
+
+        :param tokens:
+        :return, Array of tokens that were not used by the parser.
+
+        """
+        if tokens[0] != 'id':
+            raise NEXTHOP_Error("Nexthop objects start with 'id': %s" %' '.join(tokens))
+
+        unused = self._parseKeywords(tokens)
+        self.FLAGS = [token for token in unused if token in self.flags]
+        return tuple(token for token in unused if token not in self.flags)
+    #---
+#---
+
+
+# -------- RULE --------
+
+class RULE_Error(Exception):
+    pass
+
+class RULE(parsenode.ParseNode):
+    """
+    A policy routing rule, as printed by 'ip rule show' and taken by 'ip rule add' (not part of the route grammar
+    itself).  'ip' takes several spellings of some keywords, and prints some of them differently than it takes them
+    ('lookup' for 'table'), so every keyword is stored under the name given in aliases.
+    """
+    options = ('from', 'to', 'tos', 'dsfield', 'fwmark', 'iif', 'iifname', 'oif', 'oifname', 'uidrange', 'ipproto',
+               'sport', 'dport', 'pref', 'priority', 'order', 'table', 'lookup', 'protocol', 'proto', 'realms', 'goto',
+               'suppress_prefixlength', 'suppress_ifgroup', 'nat', 'map-to')
+    aliases = {'from': 'source', 'to': 'destination', 'dsfield': 'tos', 'iifname': 'iif', 'oifname': 'oif',
+               'pref': 'priority', 'order': 'priority', 'lookup': 'table', 'protocol': 'proto', 'map-to': 'nat'}
+    flags = ('not', 'l3mdev')
+    types = ('unicast', 'blackhole', 'unreachable', 'prohibit', 'nop')
+
+    # RULE variables/options
+    __slots__ = ('source', 'destination', 'tos', 'fwmark', 'iif', 'oif', 'uidrange', 'ipproto', 'sport', 'dport',
+                 'priority', 'table', 'proto', 'realms', 'goto', 'suppress_prefixlength', 'suppress_ifgroup', 'nat',
+                 'TYPE', 'FLAGS')
+
+
+    def __init__(self, tokens):
+        super(RULE,self).__init__(tokens)
+    #---
+
+
+    def parse(self, tokens):
+        """
+        Parses an 'ip rule' entry.
+
+        :param tokens:
+        :return, Array of tokens that were not used by the parser.
+
+        """
+        position = 0
+
+        # 'ip rule show' starts every rule with its priority
+        if tokens[0].endswith(':'):
+            if not tokens[0][:-1].isdigit():
+                raise RULE_Error("Bad rule priority: %s" %tokens[0])
+            self.priority = tokens[0][:-1]
+            self._addRawSegment(tokens[0])
+            position += 1
+
+        unused = self._parseKeywords(tokens, position)
+        self.FLAGS = [token for token in unused if token in self.flags]
+        types = [token for token in unused if token in self.types]
+        if len(types) > 1:
+            raise RULE_Error("A rule can only have one type: %s" %' '.join(types))
+        self.TYPE = types[0] if types else None
+
+        return tuple(token for token in unused if token not in self.flags and token not in self.types)
+    #---
+
+
+    def _parseOption(self, tokens, position):
+        """
+        Keyword handler for options, storing the value under the keyword's alias (see class:RULE).
+
+        """
+        if position + 1 >= len(tokens):
+            return None
+
+        keyword = tokens[position]
+        self[self.aliases.get(keyword, keyword)] = tokens[position + 1]
+        self._addRawSegment(keyword)
+        self._addRawSegment(tokens[position + 1])
+        return position + 2
     #---
 #---
 
@@ -284,7 +419,7 @@ class ROUTE(parsenode.ParseNode):
     Defines the 'ROUTE' segment of the the iproute2 routing grammar.
     """
     actions = ('add', 'del', 'change', 'append', 'replace', 'monitor')
-    action = None
+    __slots__ = ('action',)
 
     def __init__(self, tokens):
         super(ROUTE,self).__init__(tokens, [NODE_SPEC, INFO_SPEC])
@@ -302,7 +437,7 @@ class ROUTE(parsenode.ParseNode):
         if tokens[0] in self.actions:
             self.action = tokens[0]
             self._addRawSegment(self.action)     # Make sure we have the string segment stored
-            tokens.remove(tokens[0])
+            return tokens[1:]
 
         return tokens
     #---
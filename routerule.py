@@ -19,14 +19,88 @@
 #   limitations under the License.
 #
 # DESCRIPTION:
-#   Class which allows the manipulation of a routing rule.
+#   Class which allows the manipulation of a routing rule, and class:RuleSet, which keeps a whole policy (thousands of
+# rules) in sync with the kernel and can work out offline which rule a packet would hit.
 #
 
+import collections
+import socket
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from lib import nixcommon
+from . import backend
+from . import ipprefix
+from . import routegrammar
+from .route import TABLE_IDS
+
+# Rule attributes which select packets, and the ones which say what happens to them (the action)
+SELECTOR_ATTRIBUTES = ('invert', 'source', 'destination', 'tos', 'fwmark', 'iif', 'oif', 'uidrange', 'ipproto',
+                       'sport', 'dport', 'l3mdev')
+ACTION_ATTRIBUTES = ('type', 'table', 'goto', 'proto', 'realms', 'suppress_prefixlength', 'suppress_ifgroup', 'nat')
+
+# Options rendered as 'keyword value', in the order 'ip rule' prints them
+SELECTOR_OPTIONS = ('tos', 'fwmark', 'iif', 'oif', 'uidrange', 'ipproto', 'sport', 'dport')
+ACTION_OPTIONS = ('goto', 'proto', 'realms', 'suppress_prefixlength', 'suppress_ifgroup', 'nat')
+
+FWMARK_MASK = 0xffffffff
 
 # Exceptions
 class RouteRuleError(Exception):
     pass
+class RuleBatchError(RouteRuleError):
+    """
+    Raised when some of the rules in a batch could not be pushed.  The rest of the batch is still applied.
+    """
+
+    def __init__(self, message, failures = None):
+        """
+        Constructor
+
+        :param message: Error message.
+        :param failures: List of (RouteRule, error text) tuples.
+        """
+        super(RuleBatchError, self).__init__(message)
+        self.failures = failures if failures is not None else []
+
+
+# A packet for meth:RuleSet.evaluate.  Only source and destination are required; fields left as None never match a
+# rule which selects on them.
+Packet = collections.namedtuple('Packet', 'source destination fwmark iif oif uid tos ipproto sport dport')
+Packet.__new__.__defaults__ = (0, None, None, None, 0, None, None, None)
+
+
+def _number(value):
+    return int(value, 0) if isinstance(value, str) else int(value)
+#---
+
+
+def _range(value):
+    """
+    Parses a 'N' or 'N-M' range (uidrange, sport, dport) into a (low, high) tuple.
+
+    """
+    low, _, high = str(value).partition('-')
+    return int(low), int(high or low)
+#---
+
+
+def _protocol(value):
+    """
+    Converts an IP protocol name ('tcp') or number to its number.  Names which aren't known stay as they are.
+
+    """
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return socket.getprotobyname(value)
+        except (socket.error, OSError):
+            return value
+#---
 
 
 # RouteRule
@@ -34,11 +108,559 @@ class RouteRule(object):
     """
     Defines a routing rule for Linux's iproute2.
     """
+    priority = None
+    family = None           # IP version; only needed when neither source nor destination is set (defaults to 4)
+    invert = False          # 'not': the rule applies to the packets the selector doesn't match
+    source = None
+    destination = None
+    tos = None
+    fwmark = None           # 'mark' or 'mark/mask'
+    iif = None
+    oif = None
+    uidrange = None         # 'low-high'
+    ipproto = None
+    sport = None            # 'port' or 'low-high'
+    dport = None
+    l3mdev = False
+
+    type = None             # None (a table lookup), 'blackhole', 'unreachable', 'prohibit' or 'nop'
+    table = None
+    goto = None
+    proto = None
+    realms = None
+    suppress_prefixlength = None
+    suppress_ifgroup = None
+    nat = None
+
+    unparsed = []           # Tokens from the parsed string which aren't part of the grammar ('[detached]', ...)
+    rule = None             # iproute2 string the rule was parsed from
+
+
+    def __init__(self, rule = None, **attributes):
+        """
+        Constructor
+
+        :param rule: Optional iproute2 rule string (as printed by 'ip rule show') to parse.
+        :param attributes: Attributes to set (priority, source, table, fwmark...).
+        """
+        self.unparsed = []
+
+        if rule:
+            self.parse(rule)
+        for name, value in attributes.items():
+            if not hasattr(self, name):
+                raise RouteRuleError("%s is not a rule attribute" %name)
+            setattr(self, name, value)
+    #---
+
+
+    def __str__(self):
+        """
+        Converts the rule to the iproute2 string taken by 'ip rule add' and 'ip rule del'.
+        """
+        segments = ['not'] if self.invert else []
+        segments += ['from', str(self.source or 'all')]
+        if self.destination: segments += ['to', str(self.destination)]
+        for option in SELECTOR_OPTIONS:
+            value = getattr(self, option)
+            if value is not None:
+                segments += [option, str(value)]
+        if self.l3mdev: segments.append('l3mdev')
+
+        if self.priority is not None: segments += ['pref', str(self.priority)]
+        if self.table is not None: segments += ['table', str(self.table)]
+        if self.type and self.type != 'unicast': segments.append(self.type)
+        for option in ACTION_OPTIONS:
+            value = getattr(self, option)
+            if value is not None:
+                segments += [option, str(value)]
+
+        return ' '.join(segments)
+    #---
+
+
+    def __repr__(self):
+        return "RouteRule(%r)" %str(self)
+    #---
+
+
+    def parse(self, rule):
+        """
+        Parses a rule string from iproute2 (through class:routegrammar.RULE) into this rule.
+
+        :param rule: iproute2 rule string.
+        """
+        self.rule = rule
+        try:
+            grammar = routegrammar.RULE(rule.split())
+        except (routegrammar.RULE_Error, IndexError) as error:
+            raise RouteRuleError("Unable to parse rule '%s': %s" %(rule, error))
+
+        for attribute in SELECTOR_OPTIONS + ACTION_OPTIONS + ('priority', 'table'):
+            setattr(self, attribute, grammar[attribute])
+        # 'ip' prints 'from all' for rules without a source
+        self.source = grammar.source if grammar.source != 'all' else None
+        self.destination = grammar.destination if grammar.destination != 'all' else None
+        self.invert = 'not' in grammar.FLAGS
+        self.l3mdev = 'l3mdev' in grammar.FLAGS
+        self.type = grammar.TYPE
+        self.unparsed = list(grammar.next_data or [])
+    #---
+
+
+    def version(self):
+        """
+        Works out the IP version of the rule from its source or destination, or its family.
+
+        :return: ipprefix.IP_V4 or ipprefix.IP_V6
+        """
+        for prefix in (self.source, self.destination):
+            if prefix:
+                return ipprefix.IP_V6 if ':' in str(prefix) else ipprefix.IP_V4
+        return int(self.family or ipprefix.IP_V4)
+    #---
+
+
+    def selector(self):
+        """
+        Returns the selector part of the rule in a canonical form (prefixes as integers, fwmarks with their mask,
+        ranges as tuples...), so different spellings of the same selector compare equal.
+
+        :return: Hashable tuple.
+        """
+        selector = []
+        for attribute in SELECTOR_ATTRIBUTES:
+            value = getattr(self, attribute)
+            if value is None:
+                pass
+            elif attribute in ('source', 'destination'):
+                version, address, length = ipprefix.parsePrefix(str(value))
+                value = (address & ipprefix.networkMask(version, length), length)
+            elif attribute == 'fwmark':
+                mark, _, mask = str(value).partition('/')
+                value = (_number(mark), _number(mask) if mask else FWMARK_MASK)
+            elif attribute == 'tos':
+                value = _number(value)
+            elif attribute in ('uidrange', 'sport', 'dport'):
+                value = _range(value)
+            elif attribute == 'ipproto':
+                value = _protocol(value)
+            else:
+                value = value or None
+            selector.append(value)
+        return tuple(selector)
+    #---
+
+
+    def key(self):
+        """
+        Identifies the rule: its IP version, priority and selector.
+
+        :return: Hashable tuple.
+        """
+        priority = int(self.priority) if self.priority is not None else None
+        return self.version(), priority, self.selector()
+    #---
+
+
+    def matches(self, other):
+        """
+        Checks whether another rule (normally one read back from the kernel) does what this one does.  Only the action
+        attributes set on this rule are compared, so anything the kernel fills in by itself doesn't count.
+
+        :param other: Instance of class:RouteRule with the same meth:key.
+        :return: ``True`` if the rules match.
+        """
+        if (self.type or 'unicast') != (other.type or 'unicast'):
+            return False
+
+        for attribute in ACTION_ATTRIBUTES[1:]:
+            value = getattr(self, attribute)
+            if value is None:
+                continue
+            other_value = getattr(other, attribute)
+            if attribute == 'table':
+                value, other_value = TABLE_IDS.get(str(value), str(value)), TABLE_IDS.get(other_value, other_value)
+            if str(value) != str(other_value):
+                return False
+        return True
+    #---
+
+
+    def _iprule(self, action):
+        """
+        Runs 'ip rule' for this rule, in the rule's address family.
+
+        """
+        ip_batch = backend.getBackend().batch(["rule %s %s" %(action, self)], self.version())
+        if ip_batch['errors']:
+            raise RouteRuleError("Unexpected error: %s" %ip_batch['errors'][0])
+    #---
+
+
+    def apply(self):
+        """
+        Adds the rule to the system.
+
+        """
+        self._iprule('add')
+    #---
+
+
+    def remove(self):
+        """
+        Deletes the rule from the system.
+
+        """
+        self._iprule('del')
+    #---
+#---
+
+
+def listRules(version = ipprefix.IP_V4):
+    """
+    Reads the kernel's rules of one IP version.
+
+    :param version: IP version.
+    :return: List of class:RouteRule instances, in priority order.
+    """
+    rules = []
+    try:
+        for line in backend.getBackend().ipStream("-%d rule show" %version):
+            if line.strip():
+                rules.append(RouteRule(line.strip(), family = version))
+    except backend.BackendError as error:
+        raise RouteRuleError(str(error))
+    return rules
+#---
+
 
-    def __init__(self):
+# -------- RuleSet --------
+
+class RuleSet(object):
+    """
+    A set of rules, indexed by priority and by selector, which can be synced with the kernel (see meth:apply) and asked
+    which rule a packet would hit (see meth:evaluate).
+    """
+    rules = []
+    versions = (ipprefix.IP_V4, ipprefix.IP_V6)     # IP versions a reconcile looks after
+    keep_priorities = (0, 32766, 32767)             # The kernel's own rules (local, main, default) are never deleted
+    _by_priority = None
+    _by_selector = None
+
+
+    def __init__(self, rules = ()):
         """
         Constructor
 
+        :param rules: Iterable of class:RouteRule instances.
+        """
+        self.rules = []
+        self._by_priority = {}
+        self._by_selector = {}
+        for rule in rules:
+            self.addRule(rule)
+    #---
+
+
+    def __len__(self):
+        return len(self.rules)
+    #---
+
+
+    def __iter__(self):
+        return iter(self.rules)
+    #---
+
+
+    def addRule(self, rule):
+        """
+        Adds a rule to the set.  It isn't applied to the system until meth:apply is called.
+
+        :param rule: Instance of class:RouteRule.
+        """
+        if not isinstance(rule, RouteRule):
+            raise RouteRuleError("Rule is not a 'RouteRule' object.")
+
+        self.rules.append(rule)
+        version, priority, selector = rule.key()
+        self._by_priority.setdefault((version, priority), []).append(rule)
+        self._by_selector.setdefault((version, selector), []).append(rule)
+    #---
+
+
+    def removeRule(self, rule):
+        """
+        Removes a rule from the set.  The change isn't applied to the system until meth:apply is called.
+
+        :param rule: Instance of class:RouteRule.
+        """
+        try:
+            self.rules.remove(rule)
+        except ValueError:
+            raise RouteRuleError("Rule '%s' is not in the set." %rule)
+
+        version, priority, selector = rule.key()
+        for index, key in ((self._by_priority, (version, priority)), (self._by_selector, (version, selector))):
+            index[key].remove(rule)
+            if not index[key]:
+                del index[key]
+    #---
+
+
+    def byPriority(self, priority, version = ipprefix.IP_V4):
+        """
+        Returns the rules with a priority.
+
+        :return: List of class:RouteRule instances.
+        """
+        return list(self._by_priority.get((version, int(priority)), []))
+    #---
+
+
+    def bySelector(self, rule):
+        """
+        Returns the rules with the same selector (and IP version) as a rule, whatever their priority.
+
+        :param rule: Instance of class:RouteRule, or a rule string such as 'from 10.0.0.0/8 fwmark 0x1'.
+        :return: List of class:RouteRule instances.
+        """
+        if not isinstance(rule, RouteRule):
+            rule = RouteRule(rule)
+        return list(self._by_selector.get((rule.version(), rule.selector()), []))
+    #---
+
+
+    def parse(self):
+        """
+        Reads the system's rules (of every IP version in self.versions) into this set.
+
+        """
+        self.rules = []
+        self._by_priority = {}
+        self._by_selector = {}
+        for version in self.versions:
+            for rule in listRules(version):
+                self.addRule(rule)
+    #---
+
+
+    def diff(self):
+        """
+        Compares the rules in this set with the system's.  Rules are paired up by meth:RouteRule.key, and a pair
+        which doesn't meth:RouteRule.matches is replaced (rules can't be changed in place, so that's a delete and an
+        add).
+
+        :return: Tuple of (rules to add, live rules to delete, (live rule, rule) pairs to replace).
         """
+        desired = collections.OrderedDict()
+        for rule in self.rules:
+            if rule.priority is None:
+                raise RouteRuleError("Rule '%s' has no priority; the kernel would pick one, so it can't be synced."
+                                     %rule)
+            desired[rule.key()] = rule
+
+        deletes = []
+        replaces = []
+        for version in self.versions:
+            for live_rule in listRules(version):
+                rule = desired.pop(live_rule.key(), None)
+
+                if rule is None:
+                    if int(live_rule.priority) not in self.keep_priorities:
+                        deletes.append(live_rule)
+                elif not rule.matches(live_rule):
+                    replaces.append((live_rule, rule))
+
+        # Rules of IP versions this set doesn't look after are left alone
+        adds = [rule for key, rule in desired.items() if key[0] in self.versions]
+
+        return adds, deletes, replaces
+    #---
+
+
+    def apply(self, reconcile = False):
+        """
+        Applies the rules to the system, through one 'ip -batch' per IP version.
+
+        :param reconcile: Only push the differences between this set and the system's rules (see meth:diff).  Live
+            rules which aren't in this set are deleted (except those in self.keep_priorities).
+        :return: The (adds, deletes, replaces) which were pushed when reconciling, otherwise ``None``.
+        """
+        changes = None
+        if not reconcile:
+            commands = [('add', rule) for rule in self.rules]
+        else:
+            changes = adds, deletes, replaces = self.diff()
+            # Deletes go first, so a replaced rule is out of the way of its successor
+            commands = ([('del', rule) for rule in deletes] + [('del', live_rule) for live_rule, rule in replaces] +
+                        [('add', rule) for live_rule, rule in replaces] + [('add', rule) for rule in adds])
+
+        failures = []
+        for version in (ipprefix.IP_V4, ipprefix.IP_V6):
+            family_commands = [(action, rule) for action, rule in commands if rule.version() == version]
+            if not family_commands:
+                continue
+
+            ip_batch = backend.getBackend().batch(["rule %s %s" %(action, rule) for action, rule in family_commands],
+                                                  version)
+            for index in sorted(ip_batch['errors']):
+                failures.append((family_commands[index][1], ip_batch['errors'][index]))
+
+        if failures:
+            raise RuleBatchError("%d of %d rule changes could not be applied" %(len(failures), len(commands)), failures)
+        return changes
+    #---
+
+
+    # -------- Offline evaluation --------
+    #   Rules are walked in priority order, the way the kernel does: 'nop' rules are passed over and 'goto' skips ahead.
+    # The first other rule whose selector matches is the answer.  Whether its table then has a route (or
+    # suppress_prefixlength throws it away) depends on the routes, so it isn't checked here; neither are l3mdev rules,
+    # which never match.
+
+    def _ordered(self, version):
+        """
+        Returns the rules of an IP version in priority order, as (rule, priority, selector) tuples, the selector being
+        a dictionary of meth:RouteRule.selector.
+
+        """
+        rules = sorted((rule for rule in self.rules if rule.version() == version),
+                       key = lambda rule: int(rule.priority or 0))
+        return [(rule, int(rule.priority or 0), dict(zip(SELECTOR_ATTRIBUTES, rule.selector()))) for rule in rules]
+    #---
+
+
+    def _columns(self, packets, version):
+        """
+        Converts packets to the values meth:_ruleMask compares: one NumPy array per field when NumPy is installed,
+        otherwise a list of one dictionary per packet.  Missing numbers become -1 (0 for fwmark and tos).
+
+        """
+        rows = []
+        for packet in packets:
+            packet = Packet(*packet)
+            row = {'fwmark': int(packet.fwmark or 0), 'tos': int(packet.tos or 0), 'iif': packet.iif,
+                   'oif': packet.oif}
+            for field in ('uid', 'sport', 'dport'):
+                value = getattr(packet, field)
+                row[field] = int(value) if value is not None else -1
+            ipproto = _protocol(packet.ipproto) if packet.ipproto is not None else -1
+            row['ipproto'] = ipproto if isinstance(ipproto, int) else -1
+            for field in ('source', 'destination'):
+                address = getattr(packet, field)
+                if isinstance(address, int):
+                    address_version = version
+                else:
+                    address_version, address = ipprefix.parsePrefix(str(address))[:2]
+                if address_version != version:
+                    raise RouteRuleError("Packet %s is not IPv%d" %(str(packet), version))
+                if numpy is not None and version == ipprefix.IP_V6:
+                    row[field + '_hi'], row[field + '_lo'] = address >> 64, address & 0xffffffffffffffff
+                else:
+                    row[field] = address
+            rows.append(row)
+
+        if numpy is None:
+            return rows
+
+        columns = {}
+        for name in (rows[0] if rows else ()):
+            values = [row[name] for row in rows]
+            if name in ('iif', 'oif'):
+                columns[name] = numpy.array(values, dtype = object)
+            elif name.endswith('_hi') or name.endswith('_lo') or (name in ('source', 'destination', 'fwmark')):
+                columns[name] = numpy.array(values, dtype = numpy.uint64)
+            else:
+                columns[name] = numpy.array(values, dtype = numpy.int64)
+        return columns
+    #---
+
+
+    def _ruleMask(self, selector, columns, version):
+        """
+        Tests a rule's selector (see meth:_ordered) against packet values: NumPy arrays (giving a boolean array) or one
+        packet's values (giving a bool).  Only operators which work on both are used.
+
+        """
+        if selector['l3mdev']:
+            return columns['tos'] != columns['tos']
+        mask = columns['tos'] == columns['tos']
+
+        for field in ('source', 'destination'):
+            if selector[field] is None:
+                continue
+            network, length = selector[field]
+            netmask = ipprefix.networkMask(version, length)
+            if field in columns:
+                mask = mask & ((columns[field] & netmask) == network)
+            else:
+                for part, shift in (('_hi', 64), ('_lo', 0)):
+                    part_mask = (netmask >> shift) & 0xffffffffffffffff
+                    mask = mask & ((columns[field + part] & part_mask) == (network >> shift) & part_mask)
+
+        if selector['fwmark'] is not None:
+            mark, mark_mask = selector['fwmark']
+            mask = mask & (((columns['fwmark'] ^ mark) & mark_mask) == 0)
+        if selector['tos'] is not None:
+            mask = mask & (columns['tos'] == selector['tos'])
+        for field in ('iif', 'oif'):
+            if selector[field] is not None:
+                mask = mask & (columns[field] == selector[field])
+        if selector['ipproto'] is not None:
+            mask = mask & (columns['ipproto'] == selector['ipproto'])
+        for attribute, field in (('uidrange', 'uid'), ('sport', 'sport'), ('dport', 'dport')):
+            if selector[attribute] is not None:
+                low, high = selector[attribute]
+                mask = mask & (columns[field] >= low) & (columns[field] <= high)
+
+        if selector['invert']:
+            mask = mask ^ True
+        return mask
+    #---
+
+
+    def evaluate(self, packets, version = ipprefix.IP_V4):
+        """
+        Works out which rule each packet would hit, without touching the system (see the notes above).  With NumPy
+        installed, every rule is tested against all of the packets at once.
+
+        :param packets: Iterable of class:Packet instances (or tuples in the same order).  Addresses are strings, or
+            integers.
+        :param version: IP version of the packets (only rules of that version are used).
+        :return: List holding the class:RouteRule each packet hits (or ``None``), in the order of packets.
+        """
+        rules = self._ordered(version)
+        columns = self._columns(packets, version)
+
+        if numpy is not None:
+            count = len(columns['tos']) if columns else 0
+            hits = numpy.full(count, -1, dtype = numpy.int64)
+            start = numpy.zeros(count, dtype = numpy.int64)     # Priority a 'goto' moved the packet on to
+            for index, (rule, priority, selector) in enumerate(rules):
+                active = (hits < 0) & (start <= priority)
+                if not active.any():
+                    continue
+                matched = active & self._ruleMask(selector, columns, version)
+                if rule.goto is not None:
+                    start[matched] = int(rule.goto)
+                elif rule.type != 'nop':
+                    hits[matched] = index
+            return [rules[index][0] if index >= 0 else None for index in hits.tolist()]
+
+        results = []
+        for row in columns:
+            hit = None
+            start = 0
+            for rule, priority, selector in rules:
+                if priority < start or not self._ruleMask(selector, row, version):
+                    continue
+                if rule.goto is not None:
+                    start = int(rule.goto)
+                elif rule.type != 'nop':
+                    hit = rule
+                    break
+            results.append(hit)
+        return results
     #---
-#---
\ No newline at end of file
+#---
@@ -0,0 +1,396 @@
+#
+# $Id$
+#
+# NAME:         routestore.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   A compact, column oriented store for very large routing tables.  Each route is a row across parallel typed arrays
+# (network, prefix length, metric, and ids into interned string tables for everything else), about 40 bytes per IPv4
+# route instead of a few KB for a parsed class:Route.  Routes are only built when a row is read.  The store behaves
+# like a list of routes, so it can stand in for RoutingTable.routes (see meth:RoutingTable.parse).
+#
+#   When NumPy is installed, the columns can be read as NumPy arrays without copying, and meth:RouteStore.select
+# filters with vectorized comparisons; otherwise it falls back to plain loops.
+#
+
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import ipprefix
+from .nexthop import NextHop
+from .route import Route
+
+# Column name -> array typecode.  proto, scope, type and tos are 8 bit values in the kernel, so their string tables
+# can't outgrow a byte.  Metrics of -1 mean "not set".
+COLUMNS = (('length', 'B'), ('metric', 'q'), ('tos', 'B'), ('proto', 'B'), ('scope', 'B'), ('type', 'B'),
+           ('table', 'I'), ('device', 'I'), ('gateway', 'I'), ('source', 'I'), ('extra', 'I'))
+NETWORK_COLUMNS = {ipprefix.IP_V4: (('network', 'I'),),
+                   ipprefix.IP_V6: (('network_hi', 'Q'), ('network_lo', 'Q'))}
+
+# Columns holding ids into a string table, and the Route attribute each one comes from
+STRING_COLUMNS = (('tos', 'tos'), ('proto', 'proto'), ('scope', 'scope'), ('type', 'type'), ('table', 'table'),
+                  ('device', 'device'), ('gateway', 'nexthop'), ('source', 'source'))
+
+
+# Exceptions
+class RouteStoreError(Exception):
+    pass
+
+
+# -------- Interner --------
+
+class Interner(object):
+    """
+    Maps values to small integer ids and back.  Id 0 is always ``None``.
+    """
+
+    def __init__(self):
+        self.values = [None]
+        self.ids = {None: 0}
+    #---
+
+
+    def intern(self, value):
+        """
+        Returns the id of a value, adding it if it's new.
+
+        """
+        value_id = self.ids.get(value)
+        if value_id is None:
+            value_id = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return value_id
+    #---
+
+
+    def __len__(self):
+        return len(self.values)
+    #---
+#---
+
+
+# -------- RouteStore --------
+
+class RouteStore(object):
+    """
+    Column store of routes.  Rows are kept per IP version; as a sequence the store lists every IPv4 route, then every
+    IPv6 route.
+    """
+
+    def __init__(self, routes = None):
+        """
+        Constructor
+
+        :param routes: Optional iterable of class:Route instances to load.
+        """
+        self.strings = dict((name, Interner()) for name, attribute in STRING_COLUMNS)
+        self.strings['extra'] = Interner()
+        self.columns = {}
+        for version in (ipprefix.IP_V4, ipprefix.IP_V6):
+            self.columns[version] = dict((name, array.array(typecode))
+                                         for name, typecode in NETWORK_COLUMNS[version] + COLUMNS)
+
+        if routes is not None:
+            self.extend(routes)
+    #---
+
+
+    def __len__(self):
+        return self.count(ipprefix.IP_V4) + self.count(ipprefix.IP_V6)
+    #---
+
+
+    def count(self, version):
+        """
+        Number of routes of one IP version.
+
+        """
+        return len(self.columns[version]['length'])
+    #---
+
+
+    def _locate(self, index):
+        """
+        Converts a sequence index into (version, row).
+
+        """
+        v4_count = self.count(ipprefix.IP_V4)
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("route index out of range")
+        if index < v4_count:
+            return ipprefix.IP_V4, index
+        return ipprefix.IP_V6, index - v4_count
+    #---
+
+
+    # -------- Adding routes --------
+
+    def append(self, route):
+        """
+        Adds a route.
+
+        :param route: Instance of class:Route.
+        """
+        if route.network == 'default':
+            version, network, length = route.version(), 0, 0
+        else:
+            try:
+                version, network, length = ipprefix.parsePrefix(route.network)
+            except ipprefix.PrefixError as error:
+                raise RouteStoreError("Can't store route '%s': %s" %(route, error))
+
+        row = {'length': length, 'metric': int(route.metric) if route.metric is not None else -1,
+               'extra': self.strings['extra'].intern(self._extra(route))}
+        for name, attribute in STRING_COLUMNS:
+            value = getattr(route, attribute)
+            row[name] = self.strings[name].intern(str(value) if value is not None else None)
+        if version == ipprefix.IP_V4:
+            row['network'] = network
+        else:
+            row['network_hi'], row['network_lo'] = network >> 64, network & 0xffffffffffffffff
+
+        columns = self.columns[version]
+        try:
+            for name, column in columns.items():
+                column.append(row[name])
+        except OverflowError as error:
+            # Keep the columns the same length
+            size = min(len(column) for column in columns.values())
+            for column in columns.values():
+                del column[size:]
+            raise RouteStoreError("Can't store route '%s': %s" %(route, error))
+    #---
+
+
+    def extend(self, routes):
+        for route in routes:
+            self.append(route)
+    #---
+
+
+    def _extra(self, route):
+        """
+        Packs the rarely used parts of a route (which don't get a column) into one hashable value.
+
+        """
+        nexthops = tuple((hop.via, hop.device, hop.weight, tuple(hop.flags)) for hop in route.nexthops)
+        extra = (route.nhflags, route.nhid, tuple(route.options), nexthops, tuple(route.unparsed), route.description)
+        if not any(extra):
+            return None
+        return extra
+    #---
+
+
+    # -------- Reading routes --------
+
+    def network(self, version, row):
+        """
+        Returns a row's network as an integer.
+
+        """
+        columns = self.columns[version]
+        if version == ipprefix.IP_V4:
+            return columns['network'][row]
+        return (columns['network_hi'][row] << 64) | columns['network_lo'][row]
+    #---
+
+
+    def route(self, version, row):
+        """
+        Builds the class:Route for a row.
+
+        :param version: IP version.
+        :param row: Row number within that version.
+        :return: New class:Route instance.
+        """
+        columns = self.columns[version]
+        route = Route(family = version)
+
+        length = columns['length'][row]
+        network = self.network(version, row)
+        if length == 0 and network == 0:
+            route.network = 'default'
+        else:
+            route.network = ipprefix.formatPrefix(version, network, length)
+
+        metric = columns['metric'][row]
+        route.metric = str(metric) if metric >= 0 else None
+        for name, attribute in STRING_COLUMNS:
+            setattr(route, attribute, self.strings[name].values[columns[name][row]])
+
+        extra = self.strings['extra'].values[columns['extra'][row]]
+        if extra is not None:
+            route.nhflags, route.nhid, options, nexthops, unparsed, route.description = extra
+            route.options = list(options)
+            route.nexthops = [NextHop(via, device, weight, flags) for via, device, weight, flags in nexthops]
+            route.unparsed = list(unparsed)
+        return route
+    #---
+
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[position] for position in range(*index.indices(len(self)))]
+        return self.route(*self._locate(index))
+    #---
+
+
+    def __iter__(self):
+        for version in (ipprefix.IP_V4, ipprefix.IP_V6):
+            for row in range(self.count(version)):
+                yield self.route(version, row)
+    #---
+
+
+    # -------- Removing routes --------
+
+    def pop(self, index = -1):
+        """
+        Removes a row and returns its route.
+
+        """
+        version, row = self._locate(index)
+        route = self.route(version, row)
+        for column in self.columns[version].values():
+            column.pop(row)
+        return route
+    #---
+
+
+    def remove(self, route):
+        """
+        Removes the first row holding a route equal to route (same meth:Route.key and the same iproute2 string).
+
+        :raise ValueError: If there isn't one, like list.remove.
+        """
+        key = route.key()
+        text = str(route)
+        for index, stored in enumerate(self):
+            if stored.key() == key and str(stored) == text:
+                self.pop(index)
+                return
+        raise ValueError("route not in store")
+    #---
+
+
+    # -------- Columns and filters --------
+
+    def column(self, version, name):
+        """
+        Returns a column: a NumPy array sharing the column's memory when NumPy is installed, the array.array itself
+        otherwise.  String columns hold ids into self.strings[name].values.
+
+        :param version: IP version.
+        :param name: Column name (see COLUMNS and NETWORK_COLUMNS).
+        """
+        column = self.columns[version][name]
+        if numpy is None:
+            return column
+        if not len(column):
+            return numpy.zeros(0, dtype = column.typecode)
+        return numpy.frombuffer(column, dtype = column.typecode)
+    #---
+
+
+    def select(self, version, within = None, **criteria):
+        """
+        Finds the rows matching all of the given criteria.
+
+        :param version: IP version to search.
+        :param within: Only rows whose prefix lies inside this prefix (CIDR notation).
+        :param criteria: Column name -> value, compared for equality.  String columns take the string (device = 'eth0',
+            proto = 'bgp'); 'length' and 'metric' take integers.
+        :return: List of sequence indexes (use store[index] to get the route).
+        """
+        wanted = []
+        for name, value in criteria.items():
+            if name in self.strings:
+                value_id = self.strings[name].ids.get(str(value) if value is not None else None)
+                if value_id is None:
+                    return []
+                wanted.append((name, value_id))
+            elif name in ('length', 'metric'):
+                wanted.append((name, int(value) if value is not None else -1))
+            else:
+                raise RouteStoreError("Unknown column: %s" %name)
+
+        prefix = prefix_length = None
+        if within is not None:
+            within_version, prefix, prefix_length = ipprefix.parsePrefix(within)
+            if within_version != version:
+                return []
+            prefix &= ipprefix.networkMask(version, prefix_length)
+
+        offset = 0 if version == ipprefix.IP_V4 else self.count(ipprefix.IP_V4)
+        if numpy is not None:
+            return [int(row) + offset for row in self._selectVectorized(version, wanted, prefix, prefix_length)]
+
+        # One pass per criterion, each over the rows that are left
+        columns = self.columns[version]
+        rows = range(self.count(version))
+        for name, value in wanted:
+            column = columns[name]
+            rows = [row for row in rows if column[row] == value]
+        if prefix_length is not None:
+            lengths = columns['length']
+            netmask = ipprefix.networkMask(version, prefix_length)
+            rows = [row for row in rows if lengths[row] >= prefix_length and
+                    self.network(version, row) & netmask == prefix]
+        return [row + offset for row in rows]
+    #---
+
+
+    def _selectVectorized(self, version, wanted, prefix, prefix_length):
+        """
+        NumPy version of the row filter in meth:select.
+
+        :return: NumPy array of row numbers.
+        """
+        mask = numpy.ones(self.count(version), dtype = bool)
+        for name, value in wanted:
+            mask &= self.column(version, name) == value
+
+        if prefix_length is not None:
+            mask &= self.column(version, 'length') >= prefix_length
+            netmask = ipprefix.networkMask(version, prefix_length)
+            if version == ipprefix.IP_V4:
+                mask &= (self.column(version, 'network') & numpy.uint32(netmask)) == numpy.uint32(prefix)
+            else:
+                for name, shift in (('network_hi', 64), ('network_lo', 0)):
+                    part_mask = numpy.uint64((netmask >> shift) & 0xffffffffffffffff)
+                    part = numpy.uint64((prefix >> shift) & 0xffffffffffffffff)
+                    mask &= (self.column(version, name) & part_mask) == part
+
+        return numpy.nonzero(mask)[0]
+    #---
+
+
+    def memoryUsage(self):
+        """
+        Bytes held by the columns (the string tables come on top, but they're small for real tables).
+
+        """
+        return sum(column.itemsize * len(column) for columns in self.columns.values() for column in columns.values())
+    #---
+#---
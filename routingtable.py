@@ -22,13 +22,57 @@
 #   Defines a routing table.
 #
 
-from lib import nixcommon
+import collections
+import copy
+import hashlib
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import backend
+from . import ipprefix
+from . import radix
+from . import routerule
+from . import routestore
+from .route import Route, RouteError, DEFAULT_METRIC, TABLE_IDS
+
+# Problems meth:RoutingTable.validate reports, in the order they're listed for a route.  index is the route's index in
+# RoutingTable.routes; other is the index of the route the problem is with (for duplicates, the first route with that
+# key; for overlaps, the most specific route whose prefix holds this one), the interface address whose subnet holds the
+# route (connected), the error text (invalid) or ``None`` (host bits).
+ISSUE_INVALID = 'invalid'
+ISSUE_HOST_BITS = 'host_bits'
+ISSUE_DUPLICATE = 'duplicate'
+ISSUE_OVERLAP = 'overlap'
+ISSUE_CONNECTED = 'connected'
+
+ISSUE_KINDS = (ISSUE_INVALID, ISSUE_HOST_BITS, ISSUE_DUPLICATE, ISSUE_OVERLAP, ISSUE_CONNECTED)
+
+RouteIssue = collections.namedtuple('RouteIssue', 'kind index other')
 
 # Exceptions
 class RoutingTableError(Exception):
     pass
 class InvalidRouteError(RoutingTableError):
     pass
+class BatchError(RoutingTableError):
+    """
+    Raised when some of the routes in a batch could not be pushed.  The rest of the batch is still applied (unless
+    the batch was rolled back, see meth:RoutingTable.swap).
+    """
+
+    def __init__(self, message, failures = None):
+        """
+        Constructor
+
+        :param message: Error message.
+        :param failures: List of (Route, error text) tuples (RouteRule for the rules of a swap).
+        """
+        super(BatchError, self).__init__(message)
+        self.failures = failures if failures is not None else []
 
 
 # RoutingTable
@@ -39,16 +83,27 @@ class RoutingTable(object):
     name = None
     description = None
     routes = []
+    batch_size = 1000       # Number of routes sent through each 'ip -batch' run
+    _index = None           # Longest prefix match tries, see meth:index
+    _snapshot = None        # (IP version, SHA-1) of each live route entry -> Route, from the last incremental parse
+    keep_protocols = ('kernel',)    # Live routes installed by these protocols are never deleted by a reconcile
 
     def __init__(self, name, description = None, routes = []):
         """
         Constructor
 
+        :param routes: Iterable of class:Route instances, or a class:routestore.RouteStore (which is used as is).
         """
         self.name = name
+        self.routes = []
+        self._index = None
+        self._snapshot = None
 
         if description: self.description = description
-        if routes: self.routes = routes
+        if isinstance(routes, routestore.RouteStore):
+            self.routes = routes
+        elif routes:
+            self.routes = list(routes)
     #---
 
 
@@ -59,25 +114,18 @@ class RoutingTable(object):
     #---
 
 
-    def _iproute_table(self, arguments):
-        """
-        Wrapper for calls to 'ip route'.
-
-        """
-        return nixcommon.runProcess("ip route %s table %s" %(arguments,self.name))
-    #---
-
-
     def addRoute(self, route):
         """
         Adds a route to the routing table.  This route will not be applied to the system until meth:apply() is called.
         :param route: Instance of class:Route.
 
         """
-        if type(route) != route.Route:
+        if not isinstance(route, Route):
             raise InvalidRouteError("Route is not a 'Route' object.")
 
         self.routes.append(route)
+        if self._index is not None:
+            self._indexRoute(route)
     #---
 
 
@@ -85,16 +133,545 @@ class RoutingTable(object):
         """
         Removes a route from the routing table.  This change will not be applied to the system until meth:apply() is
         called.
+        :param route: Instance of class:Route.
+
+        """
+        try:
+            self.routes.remove(route)
+        except ValueError:
+            raise InvalidRouteError("Route '%s' is not in table %s." %(route, self.name))
+
+        if self._index is not None:
+            version, address, length = route.key(self.name)[:3]
+            # A class:routestore.RouteStore hands out new Route objects, so the index may hold a different one
+            if not self._index[version].remove(address, length, route):
+                self._index = None
+    #---
+
+
+    # -------- Longest prefix match --------
+    #   The index is built on the first query and kept current by meth:addRoute and meth:removeRoute.  meth:parse
+    # starts it over; code which replaces self.routes directly should call meth:index with rebuild set.
+
+    def _indexRoute(self, route):
+        version, address, length = route.key(self.name)[:3]
+        self._index[version].insert(address, length, route)
+    #---
+
+
+    def index(self, rebuild = False):
+        """
+        Returns the longest prefix match tries of this table, building them if needed.
+
+        :param rebuild: Build the tries again from self.routes.
+        :return: Dictionary of IP version to class:radix.RadixTree.
+        """
+        if self._index is None or rebuild:
+            self._index = {ipprefix.IP_V4: radix.RadixTree(ipprefix.IP_V4),
+                           ipprefix.IP_V6: radix.RadixTree(ipprefix.IP_V6)}
+            for route in self.routes:
+                self._indexRoute(route)
+        return self._index
+    #---
+
+
+    def _best(self, routes):
+        """
+        Picks the route the kernel would use out of several with the same prefix (the lowest metric).
+
+        """
+        return min(routes, key = lambda route: route.key(self.name)[4])
+    #---
+
+
+    def lookup(self, address):
+        """
+        Finds the route this table would use for a destination.
+
+        :param address: Destination address, as a string.
+        :return: Instance of class:Route, or ``None`` if nothing matches.
+        """
+        version, address, length = ipprefix.parsePrefix(address)
+        match = self.index()[version].lookup(address)
+        return self._best(match[2]) if match else None
+    #---
+
+
+    def lookupMany(self, addresses, version = ipprefix.IP_V4):
+        """
+        Batch version of meth:lookup.
+
+        :param addresses: Iterable of address strings, or of integers (a list, an array.array, a NumPy array...).
+        :param version: IP version of integer addresses.
+        :return: List of class:Route instances (or ``None``), in the same order as addresses.
+        """
+        trees = self.index()
+        results = []
+        for address in addresses:
+            if isinstance(address, (str, type(u''))):
+                address_version, address = ipprefix.parsePrefix(address)[:2]
+            else:
+                address_version, address = version, int(address)
+
+            match = trees[address_version].lookup(address)
+            results.append(self._best(match[2]) if match else None)
+        return results
+    #---
+
+
+    def covering(self, prefix):
+        """
+        Finds the routes whose prefix contains (or is) a prefix.
+
+        :param prefix: Prefix in CIDR notation.
+        :return: List of class:Route instances, least specific first.
+        """
+        version, address, length = ipprefix.parsePrefix(prefix)
+        return [route for network, network_length, routes in self.index()[version].covering(address, length)
+                for route in routes]
+    #---
+
+
+    def coveredBy(self, prefix):
+        """
+        Finds the routes whose prefix is inside (or is) a prefix.
+
+        :param prefix: Prefix in CIDR notation.
+        :return: List of class:Route instances, in address order.
+        """
+        version, address, length = ipprefix.parsePrefix(prefix)
+        return [route for network, network_length, routes in self.index()[version].coveredBy(address, length)
+                for route in routes]
+    #---
+
+
+    def validate(self, connected = None, overlaps = True):
+        """
+        Checks the whole table before it's pushed: prefixes which don't parse or have host bits set, duplicate routes
+        (the same meth:Route.key), routes nested inside another route's prefix and routes inside the subnet of an
+        interface address.
+
+        The prefixes are turned into integer columns, one set per IP version (IPv6 networks as high and low 64 bit
+        halves).  Duplicates are found by sorting the rows and sweeping for equal neighbours; for each prefix length in
+        the table, the prefixes of that length are sorted and every longer prefix, cut down to that length, is looked up
+        in them by binary search.  With NumPy the columns are arrays and each step is vectorized; tables kept in a
+        class:routestore.RouteStore are read straight from its columns.
+
+        :param connected: Interface subnets (CIDR strings) to check against.  Defaults to the subnets of the addresses
+            on the host's links (see meth:backend.Backend.dumpLinks); pass an empty list to skip the check.  Routes
+            with proto kernel (the connected routes themselves) aren't reported.
+        :param overlaps: Report routes nested in another route's prefix.  Nesting under a default route isn't reported.
+        :return: List of class:RouteIssue, by route index then kind.
+        """
+        if connected is None:
+            connected = self._connectedSubnets()
+        subnets = dict((version, ([], [], [])) for version in (ipprefix.IP_V4, ipprefix.IP_V6))
+        for subnet in connected:
+            version, address, length = ipprefix.parsePrefix(subnet)
+            if length < ipprefix.MAX_LENGTH[version]:
+                subnets[version][0].append(address & ipprefix.networkMask(version, length))
+                subnets[version][1].append(length)
+                subnets[version][2].append(subnet)
+
+        issues = []
+        for version, (indexes, addresses, lengths, key_columns, kernel) in self._validationColumns(issues).items():
+            if not len(indexes):
+                continue
+            subnet_addresses, subnet_lengths, subnet_texts = subnets[version]
+            sweep = _sweepVectorized if numpy is not None else _sweep
+            host_bits, duplicates, covering, inside = sweep(version, addresses, lengths, key_columns, subnet_addresses,
+                                                            subnet_lengths, 1 if overlaps else None)
+            if numpy is not None:
+                indexes = indexes.tolist()
+                kernel = kernel.tolist()
 
+            issues += [RouteIssue(ISSUE_HOST_BITS, indexes[row], None) for row, other in host_bits]
+            issues += [RouteIssue(ISSUE_DUPLICATE, indexes[row], indexes[other]) for row, other in duplicates]
+            issues += [RouteIssue(ISSUE_OVERLAP, indexes[row], indexes[other]) for row, other in covering]
+            issues += [RouteIssue(ISSUE_CONNECTED, indexes[row], subnet_texts[other]) for row, other in inside
+                       if not kernel[row]]
+
+        ranks = dict((kind, rank) for rank, kind in enumerate(ISSUE_KINDS))
+        issues.sort(key = lambda issue: (issue.index, ranks[issue.kind]))
+        return issues
+    #---
+
+
+    def _connectedSubnets(self):
+        """
+        Lists the subnets of the addresses on the host's links.
+
+        """
+        dump = backend.getBackend().dumpLinks()
+        if dump['return_value']:
+            raise RoutingTableError("Unexpected error: %s" %dump['stderr'])
+        return ["%s/%s" %(address, length) for link in dump['links'] for family in ('v4', 'v6')
+                for address, length in link['addresses'][family]]
+    #---
+
+
+    def _validationColumns(self, issues):
+        """
+        Turns the routes into the columns meth:validate works on.  Routes which can't be placed are reported into
+        issues.
+
+        :return: Dictionary of IP version to (route indexes, addresses, prefix lengths, key columns, kernel flags):
+            NumPy arrays when NumPy is installed, otherwise lists.  Addresses are a tuple of uint64 arrays (one per 64
+            bits) with NumPy, integers without.  Key columns are a tuple of columns which are equal for two routes when
+            their meth:Route.key is, once the prefix is left out.  Kernel flags are set for routes with proto kernel.
+        """
+        if numpy is not None and isinstance(self.routes, routestore.RouteStore):
+            return self._storeColumns()
+
+        columns = dict((version, ([], [], [], [], [])) for version in (ipprefix.IP_V4, ipprefix.IP_V6))
+        classes = {}
+        for index, route in enumerate(self.routes):
+            if route.network == 'default':
+                version, address, length = route.version(), 0, 0
+            else:
+                try:
+                    version, address, length = ipprefix.parsePrefix(route.network)
+                except ipprefix.PrefixError:
+                    try:
+                        route.validate()
+                    except RouteError as error:
+                        issues.append(RouteIssue(ISSUE_INVALID, index, str(error)))
+                    # Otherwise it's a spelling only the grammar takes, and it's left out of the checks
+                    continue
+
+            key_class = route.key(self.name)[3:]
+            rows = columns[version]
+            rows[0].append(index)
+            rows[1].append(address)
+            rows[2].append(length)
+            rows[3].append(classes.setdefault(key_class, len(classes)))
+            rows[4].append(route.proto == 'kernel')
+
+        arrays = {}
+        for version, (indexes, addresses, lengths, key_classes, kernel) in columns.items():
+            if numpy is None:
+                arrays[version] = (indexes, addresses, lengths, (key_classes,), kernel)
+            else:
+                arrays[version] = (numpy.array(indexes, dtype = numpy.int64), _splitAddresses(version, addresses),
+                                   numpy.array(lengths, dtype = numpy.int64),
+                                   (numpy.array(key_classes, dtype = numpy.int64),), numpy.array(kernel, dtype = bool))
+        return arrays
+    #---
+
+
+    def _storeColumns(self):
+        """
+        meth:_validationColumns for a class:routestore.RouteStore, read from its columns without building routes.
+
+        """
+        store = self.routes
+
+        def normalized(name, convert):
+            # Ids into a string table -> ids of the canonical values
+            canonical = {}
+            return numpy.array([canonical.setdefault(convert(value), len(canonical))
+                                for value in store.strings[name].values], dtype = numpy.int64)
+
+        def tos(value):
+            try:
+                return int(value or '0', 0)
+            except ValueError:
+                return value
+
+        tos_ids = normalized('tos', tos)
+        table_name = lambda value: str(value or self.name or 'main')
+        table_ids = normalized('table', lambda value: TABLE_IDS.get(table_name(value), table_name(value)))
+
+        columns = {}
+        offset = 0
+        for version in (ipprefix.IP_V4, ipprefix.IP_V6):
+            count = store.count(version)
+            if version == ipprefix.IP_V4:
+                addresses = (store.column(version, 'network').astype(numpy.uint64),)
+            else:
+                addresses = (store.column(version, 'network_hi').copy(), store.column(version, 'network_lo').copy())
+
+            metrics = store.column(version, 'metric')
+            metrics = numpy.where(metrics < 0, DEFAULT_METRIC[version], metrics)
+            key_columns = (tos_ids[store.column(version, 'tos')], metrics, table_ids[store.column(version, 'table')])
+            kernel_id = store.strings['proto'].ids.get('kernel')
+            kernel = numpy.zeros(count, dtype = bool)
+            if kernel_id is not None:
+                kernel = store.column(version, 'proto') == kernel_id
+
+            columns[version] = (numpy.arange(offset, offset + count), addresses,
+                                store.column(version, 'length').astype(numpy.int64), key_columns, kernel)
+            offset += count
+        return columns
+    #---
+
+
+    def _command(self, action, route):
         """
+        Renders an 'ip route' command line for one of this table's routes.
+
+        """
+        return "route %s %s" %(action, route.render(self.name))
     #---
 
 
-    def apply(self):
+    def _batch(self, action, routes):
+        """
+        Pushes an action for every route through 'ip -batch', self.batch_size routes at a time and one batch per IP
+        version (so 'ip' is told the family, which a 'default dev X' route doesn't carry).  A failing route does not
+        stop the routes after it.
+
+        :param action: 'ip route' action ('add', 'del', 'replace', ...), or ``None`` if routes holds (action, Route)
+            tuples.
+        :param routes: List of class:Route instances.
+        :return: List of (Route, error text) tuples for the routes which failed.
+        """
+        failures = []
+        for version, family_routes in _byVersion(action, routes):
+            for start in range(0, len(family_routes), self.batch_size):
+                chunk = family_routes[start:start + self.batch_size]
+                commands = [self._command(action, route) for action, route in chunk]
+                ip_batch = backend.getBackend().batch(commands, version)
+
+                for index in sorted(ip_batch['errors']):
+                    failures.append((chunk[index][1], ip_batch['errors'][index]))
+
+        return failures
+    #---
+
+
+    def diff(self):
+        """
+        Compares the routes in this table with the live table.  Routes are paired up by meth:Route.key, and a pair
+        which doesn't meth:Route.matches is replaced.
+
+        :return: Tuple of (routes to add, live routes to delete, routes to replace).
+        """
+        return self._diff(live_route for version in (4, 6) for live_route in self.iterRoutes(version))
+    #---
+
+
+    def _diff(self, live_routes):
+        """
+        meth:diff against a given list of live routes.
+
+        """
+        # self.routes is only walked once, as a class:routestore.RouteStore builds new Route objects on every pass
+        desired = collections.OrderedDict((route.key(self.name), route) for route in self.routes)
+
+        deletes = []
+        replaces = []
+        for live_route in live_routes:
+            route = desired.pop(live_route.key(self.name), None)
+
+            if route is None:
+                if live_route.proto not in self.keep_protocols:
+                    deletes.append(live_route)
+            elif not route.matches(live_route):
+                replaces.append(route)
+
+        # Whatever is left wasn't found in the live table (for duplicate keys, the last route wins)
+        adds = list(desired.values())
+
+        return adds, deletes, replaces
+    #---
+
+
+    def apply(self, reconcile = False, atomic = False, scratch = None):
         """
         Applies the routing table definition to the system.
 
+        :param reconcile: Only push the differences between this table and the live table (see meth:diff).  Live
+            routes which aren't in this table are deleted, so a table that is already in sync costs no writes.
+        :param atomic: Replace the live table without ever showing a partly updated one (see meth:swap).
+        :param scratch: Unused table id for an atomic apply to build the new table in.
+        :return: The (adds, deletes, replaces) which were pushed when reconciling, otherwise ``None``.
+        """
+        if atomic:
+            self.swap(scratch)
+            return None
+
+        changes = None
+        if not reconcile:
+            failures = self._batch('add', self.routes)
+        else:
+            changes = adds, deletes, replaces = self.diff()
+            failures = self._batch(None, [('del', route) for route in deletes] +
+                                         [('replace', route) for route in replaces] +
+                                         [('add', route) for route in adds])
+
+        if failures:
+            raise BatchError("%d of %d routes could not be applied to table %s" %(len(failures), len(self.routes),
+                                                                                  self.name), failures)
+        return changes
+    #---
+
+
+    def swap(self, scratch = None):
+        """
+        Replaces the live table with this table's routes, without a window in which only some of them are in place.
+
+        With a scratch table, the routes are loaded into it in bulk, then every rule which looks this table up is
+        pointed at the scratch table.  Each new rule goes in next to the old one, with the same priority, so the old
+        one still wins; deleting the old rule then flips the traffic over in a single kernel update.  While the
+        scratch table carries the traffic, this table is brought up to date in place (only the routes which changed
+        are written, as in the swap without a scratch table) and the rules are flipped back the same way; the scratch
+        table is flushed at the end.  The table keeps its id, so rule definitions (see class:routerule.RuleSet) stay
+        valid.
+
+        Without a scratch table, or when no rule looks this table up by id (main, for example, is also used by
+        routes the kernel adds by itself), the live table is changed in place with one batch of 'replace' operations
+        and the stale routes are deleted at the end of it.
+
+        Either way, a failed load is rolled back: the replaced routes are put back, the rules are moved back to this
+        table and the scratch table is flushed.  BatchError is raised.
+
+        :param scratch: Id of an unused, empty table.
+        """
+        table_id = TABLE_IDS.get(str(self.name), str(self.name))
+        rules = []
+        if scratch is not None and table_id not in TABLE_IDS.values():
+            if TABLE_IDS.get(str(scratch), str(scratch)) == table_id:
+                raise RoutingTableError("The scratch table can't be the table itself (%s)." %self.name)
+            rules = [rule for version in (ipprefix.IP_V4, ipprefix.IP_V6) for rule in routerule.listRules(version)
+                     if rule.table is not None and TABLE_IDS.get(rule.table, rule.table) == table_id]
+
+        if not rules:
+            self._swapInPlace()
+        else:
+            self._swapTables(str(scratch), rules)
+    #---
+
+
+    def _swapInPlace(self):
+        """
+        meth:swap without a scratch table: replaces, then deletes, all in one batch.
+
+        """
+        live_routes = [live_route for version in (4, 6) for live_route in self.iterRoutes(version)]
+        commands = self._swapCommands(live_routes)
+
+        failures = self._batch(None, commands)
+        if failures:
+            undo_failures = self._batch(None, self._swapUndo(commands, failures, live_routes))
+            raise self._swapError(commands, failures, undo_failures)
+    #---
+
+
+    def _swapCommands(self, live_routes):
+        """
+        Lists the changes of an in-place swap: every new or changed route is replaced, then the stale routes deleted.
+
+        :return: List of (action, Route) tuples, for meth:_batch.
+        """
+        adds, deletes, replaces = self._diff(live_routes)
+        return [('replace', route) for route in replaces + adds] + [('del', route) for route in deletes]
+    #---
+
+
+    def _swapUndo(self, commands, failures, live_routes):
+        """
+        Lists the changes which put back the live table after a failed in-place swap: the old version of every
+        replaced route, no added routes, and the deleted routes.
+
+        :return: List of (action, Route) tuples, for meth:_batch.
+        """
+        live = dict((live_route.key(self.name), live_route) for live_route in live_routes)
+        failed = set(id(route) for route, text in failures)
+        undo = []
+        for action, route in commands:
+            if id(route) in failed:
+                continue
+            if action == 'del':
+                undo.append(('add', route))
+            elif route.key(self.name) in live:
+                undo.append(('replace', live[route.key(self.name)]))
+            else:
+                undo.append(('del', route))
+        return undo
+    #---
+
+
+    def _swapError(self, commands, failures, undo_failures):
+        message = "%d of %d changes could not be applied to table %s, the changes were rolled back" %(len(failures),
+                                                                                                      len(commands),
+                                                                                                      self.name)
+        if undo_failures:
+            message += " (%d of them could not be undone)" %len(undo_failures)
+        return BatchError(message, failures)
+    #---
+
+
+    def _swapTables(self, scratch, rules):
+        """
+        meth:swap through a scratch table: loads it, moves the rules over to it, updates this table in place, moves the
+        rules back and flushes the scratch table.
+
         """
+        live_routes = [live_route for version in (4, 6) for live_route in self.iterRoutes(version)]
+        staging = RoutingTable(scratch)
+        staging.batch_size = self.batch_size
+        for version in (4, 6):
+            route = next(staging.iterRoutes(version), None)
+            if route is not None:
+                raise RoutingTableError("Scratch table %s is not empty (it holds %s)." %(scratch, route))
+
+        # Routes which name this table have to go into the scratch table instead
+        for route in self.routes:
+            if route.table is not None:
+                route = copy.copy(route)
+                route.table = None
+            staging.routes.append(route)
+
+        failures = staging._batch('add', staging.routes)
+        if failures:
+            self._flush(scratch)
+            raise BatchError("%d of %d routes could not be loaded into scratch table %s, nothing was switched over"
+                             %(len(failures), len(staging.routes), scratch), failures)
+
+        moved, failures = _moveRules(rules, scratch)
+        if failures:
+            self._flush(scratch)
+            raise BatchError("%d rules could not be switched to scratch table %s, the swap was rolled back"
+                             %(len(failures), scratch), failures)
+
+        # The scratch table carries the traffic while this one is updated.  If that fails, the update is undone, so
+        # the rules go back to the table as it was.
+        commands = self._swapCommands(live_routes)
+        failures = self._batch(None, commands)
+        if failures:
+            undo_failures = self._batch(None, self._swapUndo(commands, failures, live_routes))
+            moved, rule_failures = _moveRules(moved, self.name)
+            if rule_failures:
+                raise BatchError("%d of %d changes could not be applied to table %s, and its rules still look up "
+                                 "scratch table %s" %(len(failures), len(commands), self.name, scratch), failures)
+            self._flush(scratch)
+            raise self._swapError(commands, failures, undo_failures)
+
+        moved, failures = _moveRules(moved, self.name)
+        if failures:
+            raise BatchError("%d rules could not be switched back from scratch table %s to table %s"
+                             %(len(failures), scratch, self.name), failures)
+        self._snapshot = None
+
+        errors = self._flush(scratch)
+        if errors:
+            raise RoutingTableError("Swapped table %s, but scratch table %s could not be flushed: %s"
+                                    %(self.name, scratch, '; '.join(errors)))
+    #---
+
+
+    def _flush(self, table):
+        """
+        Deletes every route (of both IP versions) in a table.
+
+        :return: List of error texts.  A table which doesn't exist is already empty, so that isn't an error.
+        """
+        errors = []
+        for version in (ipprefix.IP_V4, ipprefix.IP_V6):
+            ip_batch = backend.getBackend().batch(["route flush table %s" %table], version)
+            errors += [text for text in ip_batch['errors'].values() if 'FIB table does not exist' not in text]
+        return errors
     #---
 
 
@@ -103,22 +680,443 @@ class RoutingTable(object):
         Removes the routing table from the system.
 
         """
+        failures = self._batch('del', self.routes)
+
+        if failures:
+            raise BatchError("%d of %d routes could not be removed from table %s" %(len(failures), len(self.routes),
+                                                                                   self.name), failures)
+    #---
+
+
+    def _iproute_table_stream(self, arguments, version = None):
+        """
+        Runs 'ip route <arguments>' on this table.  Yields one route entry at a time; multipath routes, which 'ip'
+        prints over several lines, are joined back into a single entry.
+
+        :param version: IP version to list (4 or 6).  Defaults to whatever 'ip' defaults to (IPv4).
+        """
+        family = "-%d " %version if version else ''
+        return _joinEntries(backend.getBackend().ipStream("%sroute %s table %s" %(family, arguments, self.name)))
     #---
 
 
-    def parse(self):
+    def _liveEntries(self, versions = (ipprefix.IP_V4, ipprefix.IP_V6)):
         """
-        Parses the live routing table referred to by self.name and stores the data in this class.
+        Reads the route entries of the live table, as 'ip' prints them (see meth:_iproute_table_stream).
 
+        :param versions: IP versions to list, one after the other (``None`` for whatever 'ip' defaults to).
+        :return: Generator of (IP version, route entry) tuples.
         """
+        for version in versions:
+            try:
+                for entry in self._iproute_table_stream('list', version):
+                    yield version, entry
+            except backend.BackendError as error:
+                # The kernel only creates IPv6 tables once they hold a route
+                if 'FIB table does not exist' not in str(error):
+                    raise RoutingTableError("Unexpected parse error: %s" %error)
+    #---
+
 
-        table_info = self._iproute_table('list')
+    def iterRoutes(self, version = None):
+        """
+        Parses the live routing table referred to by self.name, one route at a time.  The output of 'ip' is read as
+        it's produced, so memory use doesn't depend on the size of the table.
 
-        if table_info['return_code']:
-            raise RoutingTableError("Unexpected parse error: %s" %table_info['stderr'])
+        :param version: IP version to list (4 or 6).  Defaults to whatever 'ip' defaults to (IPv4).
+        :return: Generator of class:Route instances.
+        """
+        try:
+            for version, entry in self._liveEntries((version,)):
+                yield Route(entry, version)
+        except RouteError as error:
+            raise InvalidRouteError(str(error))
+    #---
 
 
-        # network
+    def parse(self, compact = False, incremental = False):
+        """
+        Parses the live routing table referred to by self.name (both IP versions) and stores the data in this class.
+
+        :param compact: Keep the routes in a class:routestore.RouteStore instead of a list of Route objects.  Meant for
+            very large tables: each route takes a few dozen bytes, and Route objects are built only when read.
+        :param incremental: Only parse the entries which changed since the last incremental parse (see
+            meth:_parseIncremental).  Meant for polling: the cost of a poll then follows the churn, not the table size.
+        :return: Tuple of (added, removed, unchanged) routes when incremental, otherwise ``None``.
+        """
+        if incremental:
+            if compact:
+                raise RoutingTableError("Incremental parsing keeps Route objects, it can't be combined with compact.")
+            return self._parseIncremental(self._liveEntries())
+
+        routes = (route for version in (ipprefix.IP_V4, ipprefix.IP_V6) for route in self.iterRoutes(version))
+        self.routes = routestore.RouteStore(routes) if compact else list(routes)
+        self._index = None
+        self._snapshot = None
     #---
 
-#---
\ No newline at end of file
+
+    def _parseIncremental(self, entries):
+        """
+        Re-reads the live table, only running the route grammar on entries which weren't there on the last incremental
+        parse.  Entries are recognised by their IP version and the SHA-1 of their text (which is all that's kept of the
+        old output), and the Route objects of unchanged entries are reused, so they shouldn't be modified between polls.
+        The first incremental parse reads every entry as added.
+
+        :param entries: Iterable of the live table's (IP version, route entry) tuples, of both IP versions (see
+            meth:_liveEntries).
+        :return: Tuple of (added, removed, unchanged) lists of class:Route instances.
+        """
+        previous = self._snapshot or {}
+        snapshot = collections.OrderedDict()
+        routes = []
+        added = []
+        unchanged = []
+        try:
+            for version, entry in entries:
+                digest = (version, hashlib.sha1(entry.encode('utf-8')).digest())
+                route = previous.get(digest)
+                if route is None:
+                    route = Route(entry, version)
+                    added.append(route)
+                else:
+                    unchanged.append(route)
+                snapshot[digest] = route
+                routes.append(route)
+        except RouteError as error:
+            raise InvalidRouteError(str(error))
+        removed = [route for digest, route in previous.items() if digest not in snapshot]
+
+        # The index only has to follow the changes if it was built from the last snapshot's routes (meth:addRoute and
+        # meth:removeRoute may have changed self.routes since)
+        if self._index is not None:
+            in_step = len(self.routes) == len(previous) and all(route is old_route for route, old_route in
+                                                                 zip(self.routes, previous.values()))
+            if not in_step:
+                self._index = None
+            else:
+                for route in removed:
+                    version, address, length = route.key(self.name)[:3]
+                    self._index[version].remove(address, length, route)
+                for route in added:
+                    self._indexRoute(route)
+
+        self.routes = routes
+        self._snapshot = snapshot
+        return added, removed, unchanged
+    #---
+
+#---
+
+
+def _moveRules(rules, table):
+    """
+    Points rules at another table, one batch per IP version: all the new rules go in first, next to the old ones with
+    the same priority (so the old ones still win), then the deletes of the old rules do the flips.  If a batch fails,
+    every change which went through is undone in reverse, which flips traffic back just as atomically.
+
+    :param rules: List of class:routerule.RouteRule instances, as the kernel lists them.
+    :param table: Table the rules should look up.
+    :return: Tuple of (the moved rules, list of (rule, error text) tuples).  Nothing was moved if there are failures.
+    """
+    moved = []
+    failures = []
+    pushed = []     # (IP version, changes which went through)
+    for version in (ipprefix.IP_V4, ipprefix.IP_V6):
+        old_rules = [rule for rule in rules if rule.version() == version]
+        new_rules = [copy.copy(rule) for rule in old_rules]
+        for rule in new_rules:
+            rule.table = str(table)
+        changes = [('add', rule) for rule in new_rules] + [('del', rule) for rule in old_rules]
+        if not changes:
+            continue
+
+        ip_batch = backend.getBackend().batch(["rule %s %s" %(action, rule) for action, rule in changes], version)
+        pushed.append((version, [change for index, change in enumerate(changes)
+                                 if index not in ip_batch['errors']]))
+        if ip_batch['errors']:
+            failures = [(changes[index][1], ip_batch['errors'][index]) for index in sorted(ip_batch['errors'])]
+            break
+        moved += new_rules
+
+    if failures:
+        # The old rules come back (behind the new ones) before the new ones go
+        for version, changes in pushed:
+            backend.getBackend().batch(["rule %s %s" %('del' if action == 'add' else 'add', rule)
+                                        for action, rule in reversed(changes)], version)
+        return [], failures
+    return moved, []
+#---
+
+
+def _joinLine(entry, line):
+    """
+    Adds one line of 'ip route' output to the entry being joined (see meth:_joinEntries).
+
+    :param entry: Entry read so far, or ``None``.
+    :return: Tuple of (finished entry or ``None``, entry read so far).
+    """
+    if line[:1].isspace() and entry is not None:
+        return None, entry + ' ' + line.strip()
+    return entry or None, line.strip()
+#---
+
+
+def _joinEntries(lines):
+    """
+    Joins multipath routes, which 'ip' prints over several lines (the nexthops indented), back into single entries.
+
+    :param lines: Iterable of 'ip route' output lines.
+    :return: Generator of route entries.
+    """
+    entry = None
+    for line in lines:
+        finished, entry = _joinLine(entry, line)
+        if finished:
+            yield finished
+
+    if entry:
+        yield entry
+#---
+
+
+def _byVersion(action, routes):
+    """
+    Splits (action, Route) tuples by IP version, keeping their order within each version.
+
+    :param action: Action for every route, or ``None`` if routes already holds (action, Route) tuples.
+    :param routes: List of class:Route instances (or tuples).
+    :return: List of (IP version, list of (action, Route) tuples), for the versions which have routes.
+    """
+    if action:
+        routes = [(action, route) for route in routes]
+
+    by_version = collections.OrderedDict((version, []) for version in (ipprefix.IP_V4, ipprefix.IP_V6))
+    for action, route in routes:
+        by_version[route.version()].append((action, route))
+    return [(version, family_routes) for version, family_routes in by_version.items() if family_routes]
+#---
+
+
+def _dumpTables(version, tables, results):
+    """
+    Reads every route of one IP version with a single 'ip route show table all' and sorts them by table.  Runs in its
+    own thread for meth:loadTables, so the outcome goes into results[version]: a dictionary of table name -> list of
+    routes, or the exception which stopped the dump.
+
+    """
+    routes = collections.OrderedDict()
+    try:
+        for entry in _joinEntries(backend.getBackend().ipStream("-%d route show table all" %version)):
+            route = Route(entry, version)
+            # 'ip' leaves out 'table main'
+            table = str(route.table or 'main')
+            if tables is None or table in tables:
+                routes.setdefault(table, []).append(route)
+    except backend.BackendError as error:
+        results[version] = RoutingTableError("Unexpected parse error: %s" %error)
+    except RouteError as error:
+        results[version] = InvalidRouteError(str(error))
+    else:
+        results[version] = routes
+#---
+
+
+def loadTables(tables = None, versions = (4, 6), concurrent = False):
+    """
+    Reads all of the system's routing tables with one 'ip route show table all' dump per IP version, instead of one
+    'ip' run (and kernel dump) per table.  Routes are sorted into tables by the table they name, which 'ip' prints
+    for every table but main.
+
+    :param tables: Only keep these tables (names as 'ip' prints them: 'main', 'local', '100'...).  Defaults to all.
+    :param versions: IP versions to read.
+    :param concurrent: Run the dumps of the different IP versions at the same time, each in its own thread.
+    :return: Dictionary of table name -> class:RoutingTable, in the order the tables first show up.
+    """
+    if tables is not None:
+        tables = set(str(table) for table in tables)
+
+    results = {}
+    if concurrent:
+        threads = [threading.Thread(target = _dumpTables, args = (version, tables, results)) for version in versions]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        for version in versions:
+            _dumpTables(version, tables, results)
+
+    routing_tables = collections.OrderedDict()
+    for version in versions:
+        if isinstance(results[version], Exception):
+            raise results[version]
+        for name, routes in results[version].items():
+            if name not in routing_tables:
+                routing_tables[name] = RoutingTable(name)
+            routing_tables[name].routes.extend(routes)
+    return routing_tables
+#---
+
+
+# -------- Validation --------
+#   The sweeps behind meth:RoutingTable.validate.  Both take one IP version's columns (see
+# meth:RoutingTable._validationColumns) and the interface subnets (networks and lengths), and return lists of
+# (row, other) pairs: rows with host bits set (other is None), duplicate rows (other is the first row with the same
+# prefix and key), rows nested in another row's prefix (other is the most specific such row, only for covering
+# prefixes of at least min_length; min_length None skips the check) and rows inside a subnet (other is the subnet).
+
+def _sweep(version, addresses, lengths, key_columns, subnet_addresses, subnet_lengths, min_length):
+    """
+    Plain Python sweep, for when NumPy isn't installed.
+
+    """
+    networks = [address & ipprefix.networkMask(version, length) for address, length in zip(addresses, lengths)]
+    host_bits = [(row, None) for row, (network, address) in enumerate(zip(networks, addresses)) if network != address]
+
+    duplicates = []
+    previous = first = None
+    keys = sorted(zip(networks, lengths, *key_columns + (range(len(networks)),)))
+    for key in keys:
+        current, row = key[:-1], key[-1]
+        if current == previous:
+            duplicates.append((row, first))
+        else:
+            previous, first = current, row
+
+    covering = []
+    if min_length is not None:
+        covering = _covering(version, networks, lengths, networks, lengths, True, min_length)
+    inside = _covering(version, subnet_addresses, subnet_lengths, networks, lengths, False, 0)
+    return host_bits, duplicates, covering, inside
+#---
+
+
+def _covering(version, table_networks, table_lengths, networks, lengths, strict, min_length):
+    """
+    Finds, for every prefix, the most specific table prefix holding it (shorter only, if strict).
+
+    :return: List of (row, table row) pairs.
+    """
+    by_length = {}
+    for table_row, (network, length) in enumerate(zip(table_networks, table_lengths)):
+        by_length.setdefault(length, {}).setdefault(network, table_row)
+
+    found = {}
+    # Shortest first, so the most specific match is the one left
+    for length in sorted(by_length):
+        if length < min_length:
+            continue
+        netmask = ipprefix.networkMask(version, length)
+        table = by_length[length]
+        for row, (network, own_length) in enumerate(zip(networks, lengths)):
+            if own_length > length or (own_length == length and not strict):
+                table_row = table.get(network & netmask)
+                if table_row is not None:
+                    found[row] = table_row
+    return sorted(found.items())
+#---
+
+
+def _splitAddresses(version, addresses):
+    """
+    Converts integer addresses into a tuple of uint64 arrays: one for IPv4, high and low halves for IPv6.
+
+    """
+    if version == ipprefix.IP_V4:
+        return (numpy.array(addresses, dtype = numpy.uint64),)
+    return (numpy.array([address >> 64 for address in addresses], dtype = numpy.uint64),
+            numpy.array([address & 0xffffffffffffffff for address in addresses], dtype = numpy.uint64))
+#---
+
+
+def _masks(version, lengths):
+    """
+    Builds the netmasks for an array of prefix lengths, split like the addresses (see meth:_splitAddresses).
+
+    """
+    lengths = numpy.asarray(lengths, dtype = numpy.int64)
+    if version == ipprefix.IP_V4:
+        return ((numpy.uint64(0xffffffff) << (32 - lengths).astype(numpy.uint64)) & numpy.uint64(0xffffffff),)
+
+    masks = []
+    for part_lengths in (numpy.clip(lengths, 0, 64), numpy.clip(lengths - 64, 0, 64)):
+        shifted = numpy.uint64(0xffffffffffffffff) << (64 - part_lengths).astype(numpy.uint64)
+        # Shifting a 64 bit value by 64 isn't defined
+        masks.append(numpy.where(part_lengths == 0, numpy.uint64(0), shifted))
+    return tuple(masks)
+#---
+
+
+def _sortKeys(parts):
+    """
+    Combines split addresses into one sortable array: the IPv4 array itself, or 16 byte big-endian keys for IPv6.
+
+    """
+    if len(parts) == 1:
+        return parts[0]
+    keys = numpy.empty(len(parts[0]), dtype = [('high', '>u8'), ('low', '>u8')])
+    keys['high'], keys['low'] = parts
+    return keys.view('V16')
+#---
+
+
+def _coveringVectorized(version, table_parts, table_lengths, parts, lengths, strict, min_length):
+    """
+    NumPy version of meth:_covering.
+
+    :return: List of (row, table row) pairs.
+    """
+    found = numpy.full(len(lengths), -1, dtype = numpy.int64)
+    for length in numpy.unique(table_lengths):
+        if length < min_length:
+            continue
+        rows = numpy.nonzero(lengths > length if strict else lengths >= length)[0]
+        if not len(rows):
+            continue
+        netmask = _masks(version, [length])
+        table_rows = numpy.nonzero(table_lengths == length)[0]
+        table_keys = _sortKeys([part[table_rows] & mask for part, mask in zip(table_parts, netmask)])
+        # Stable, so equal prefixes keep their row order and a search lands on the first one
+        order = numpy.argsort(table_keys, kind = 'stable')
+        table_keys = table_keys[order]
+
+        keys = _sortKeys([part[rows] & mask for part, mask in zip(parts, netmask)])
+        positions = numpy.minimum(numpy.searchsorted(table_keys, keys), len(table_keys) - 1)
+        hits = table_keys[positions] == keys
+        found[rows[hits]] = table_rows[order[positions[hits]]]
+
+    rows = numpy.nonzero(found >= 0)[0]
+    return list(zip(rows.tolist(), found[rows].tolist()))
+#---
+
+
+def _sweepVectorized(version, parts, lengths, key_columns, subnet_addresses, subnet_lengths, min_length):
+    """
+    NumPy version of meth:_sweep.
+
+    """
+    networks = tuple(part & mask for part, mask in zip(parts, _masks(version, lengths)))
+    host_bits = numpy.zeros(len(lengths), dtype = bool)
+    for part, network in zip(parts, networks):
+        host_bits |= part != network
+    host_bits = [(row, None) for row in numpy.nonzero(host_bits)[0].tolist()]
+
+    # Sort on (network, length, key, row) and compare each row with the one before it
+    order = numpy.lexsort((numpy.arange(len(lengths)),) + key_columns[::-1] + (lengths,) + networks[::-1])
+    same = numpy.ones(len(order) - 1, dtype = bool)
+    for column in networks + (lengths,) + key_columns:
+        ordered = column[order]
+        same &= ordered[1:] == ordered[:-1]
+    starts = numpy.concatenate(([True], ~same))
+    firsts = order[numpy.maximum.accumulate(numpy.where(starts, numpy.arange(len(order)), 0))]
+    duplicates = list(zip(order[~starts].tolist(), firsts[~starts].tolist()))
+
+    covering = []
+    if min_length is not None:
+        covering = _coveringVectorized(version, networks, lengths, networks, lengths, True, min_length)
+    subnet_parts = _splitAddresses(version, subnet_addresses)
+    inside = _coveringVectorized(version, subnet_parts, numpy.array(subnet_lengths, dtype = numpy.int64), networks,
+                                 lengths, False, 0)
+    return host_bits, duplicates, covering, inside
+#---
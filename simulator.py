@@ -0,0 +1,690 @@
+#
+# $Id$
+#
+# NAME:         simulator.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   An in-memory stand-in for the kernel, as a backend (see class:SimulatedBackend).  It keeps links, addresses, routes
+# (in any number of tables), rules and nexthop objects, and answers both the backend calls and the 'ip' command lines
+# the rest of the library sends, plain, streamed or batched, with the output and error codes 'ip' would give.  Nothing
+# leaves the process, so Interface, Route, RoutingTable and RuleSet can be driven at full scale without root:
+#
+#     simulated = backend.setBackend(simulator.SimulatedBackend())
+#     simulated.addLink('eth0', up = True)
+#
+#   Importing the module registers the backend as 'simulated' (see meth:backend.setBackend).  It models what the
+# library relies on, not the whole of the kernel: there's no local table, gateways aren't checked for reachability and
+# JSON output isn't available.
+#
+
+import collections
+import copy
+import shlex
+import threading
+
+from . import backend
+from . import ipjson
+from . import ipprefix
+from . import ippool
+from .route import Route, RouteError, TABLE_IDS
+from .routerule import RouteRule, RouteRuleError
+
+# Error texts, as 'ip' prints them (meth:ippool.returnValue turns them into return values)
+PERMISSION_TEXT = "RTNETLINK answers: Operation not permitted"
+EXISTS_TEXT = "RTNETLINK answers: File exists"
+NO_ADDRESS_TEXT = "RTNETLINK answers: Cannot assign requested address"
+NO_ROUTE_TEXT = "RTNETLINK answers: No such process"
+NO_RULE_TEXT = "RTNETLINK answers: No such file or directory"
+NO_TABLE_TEXT = "Error: ipv6: FIB table does not exist."
+NO_DEVICE_TEXT = 'Cannot find device "%s"'
+NO_LINK_TEXT = 'Device "%s" does not exist.'
+
+# Objects and actions, in the order 'ip' resolves abbreviations
+OBJECTS = ('link', 'address', 'route', 'rule', 'nexthop')
+LIST_ACTIONS = ('show', 'list', 'lst', 'ls')
+
+TABLE_NAMES = dict((table_id, name) for name, table_id in TABLE_IDS.items())
+DEFAULT_RULES = {ipprefix.IP_V4: ((0, 'local'), (32766, 'main'), (32767, 'default')),
+                 ipprefix.IP_V6: ((0, 'local'), (32766, 'main'))}
+
+# Counters every simulated link reports in meth:SimulatedBackend.getLink
+STATS = ('bytes', 'packets', 'errors', 'dropped', 'over_errors', 'multicast')
+
+
+# Exceptions
+class SimulatorError(Exception):
+    """
+    A command the simulated kernel refused.  The message is the error text 'ip' would print.
+    """
+    return_value = None
+
+    def __init__(self, message, return_value = None):
+        super(SimulatorError, self).__init__(message)
+        self.return_value = return_value if return_value is not None else ippool.returnValue(message)
+
+
+def splitCommand(command):
+    """
+    Splits an 'ip' command line into arguments, as the shell would.  Lines without quotes (most batch lines) skip shlex,
+    which costs more than the simulated command itself.
+
+    """
+    if '"' in command or "'" in command or '\\' in command:
+        return shlex.split(command)
+    return command.split()
+#---
+
+
+# -------- Links --------
+
+class SimulatedLink(object):
+    """
+    A network interface of the simulated kernel.
+    """
+    __slots__ = ('index', 'name', 'kind', 'mtu', 'up', 'mac', 'addresses')
+
+    #   addresses:  List of (IP version, address as an integer, prefix length) tuples, in the order they were added
+
+    def __init__(self, index, name, kind = 'dummy', mtu = 1500, up = False):
+        self.index = index
+        self.name = name
+        self.kind = kind
+        self.mtu = mtu
+        self.up = up
+        self.mac = '02:00:00:%02x:%02x:%02x' %(index >> 16 & 0xff, index >> 8 & 0xff, index & 0xff)
+        self.addresses = []
+    #---
+
+
+    def flags(self):
+        flags = ['LOOPBACK'] if self.kind == 'loopback' else ['BROADCAST', 'MULTICAST', 'NOARP']
+        if self.up:
+            flags += ['UP', 'LOWER_UP']
+        return flags
+    #---
+
+
+    def state(self):
+        if not self.up:
+            return 'DOWN'
+        return 'UNKNOWN' if self.kind in ('loopback', 'dummy') else 'UP'
+    #---
+
+
+    def text(self, addresses = False):
+        """
+        Renders the link the way 'ip link show' (or 'ip address show', with addresses) does.
+
+        """
+        link_type = 'loopback' if self.kind == 'loopback' else 'ether'
+        lines = ["%d: %s: <%s> mtu %d qdisc noqueue state %s mode DEFAULT group default qlen 1000"
+                 %(self.index, self.name, ','.join(self.flags()), self.mtu, self.state()),
+                 "    link/%s %s brd ff:ff:ff:ff:ff:ff" %(link_type, self.mac)]
+        if addresses:
+            for version, address, length in self.addresses:
+                family = 'inet' if version == ipprefix.IP_V4 else 'inet6'
+                label = " %s" %self.name if version == ipprefix.IP_V4 else ''
+                lines += ["    %s %s/%d scope %s%s" %(family, ipprefix.formatPrefix(version, address), length,
+                                                     self.scope(version, address), label),
+                          "       valid_lft forever preferred_lft forever"]
+        return '\n'.join(lines) + '\n'
+    #---
+
+
+    def scope(self, version, address):
+        if self.kind == 'loopback':
+            return 'host'
+        if version == ipprefix.IP_V6 and address >> 118 == 0x3fa:      # fe80::/10
+            return 'link'
+        return 'global'
+    #---
+
+
+    def record(self):
+        """
+        Builds the class:ipjson.LinkRecord of the link.
+
+        """
+        addresses = [ipjson.AddressRecord('inet' if version == ipprefix.IP_V4 else 'inet6',
+                                          ipprefix.formatPrefix(version, address), length,
+                                          scope = self.scope(version, address),
+                                          label = self.name if version == ipprefix.IP_V4 else None)
+                     for version, address, length in self.addresses]
+        stats = dict((direction, dict((counter, 0) for counter in STATS)) for direction in ('rx', 'tx'))
+        return ipjson.LinkRecord(self.index, self.name, self.flags(), self.mtu, self.state(), 'noqueue',
+                                 link_type = 'loopback' if self.kind == 'loopback' else 'ether', address = self.mac,
+                                 broadcast = 'ff:ff:ff:ff:ff:ff', kind = self.kind if self.kind != 'loopback' else None,
+                                 txqlen = 1000, group = 'default', stats = stats, addresses = addresses)
+    #---
+
+
+    def linkDict(self):
+        """
+        Builds the link dictionary of meth:backend.Backend.dumpLinks.
+
+        """
+        link = self.record().linkDict()
+        link['qdisc'] = 'noqueue'
+        return link
+    #---
+#---
+
+
+# -------- SimulatedBackend --------
+
+class SimulatedBackend(backend.Backend):
+    """
+    Backend which keeps the whole network state in memory.  Calls are serialized, the way the kernel's RTNL lock does.
+    """
+    name = 'simulated'
+    privileged = True       # Unprivileged kernels refuse every change with 'Operation not permitted' (return value 2)
+
+
+    def __init__(self, privileged = True, loopback = True):
+        """
+        Constructor
+
+        :param privileged: Allow changes (see self.privileged).
+        :param loopback: Start with 'lo' (127.0.0.1/8 and ::1), as a fresh network namespace has.
+        """
+        self.privileged = privileged
+        self.links = collections.OrderedDict()
+        self.tables = {}                        # Table id -> OrderedDict of meth:Route.key -> Route (without table)
+        self.rules = dict((version, [RouteRule(priority = priority, table = table, family = version)
+                                     for priority, table in rules]) for version, rules in DEFAULT_RULES.items())
+        self.nexthops = collections.OrderedDict()       # Id -> 'ip nexthop' arguments after the id
+        self._v6_tables = set()                 # Table ids with IPv6 routes, which the kernel only creates on demand
+        self._connected = None                  # Cache of meth:_connectedRoutes
+        self._next_index = 1
+        self._lock = threading.RLock()
+
+        if loopback:
+            link = self.addLink('lo', 'loopback', 65536, True)
+            link.addresses += [ipprefix.parsePrefix('127.0.0.1/8'), ipprefix.parsePrefix('::1/128')]
+    #---
+
+
+    def addLink(self, name, kind = 'dummy', mtu = 1500, up = False):
+        """
+        Creates a link (as 'ip link add' does).
+
+        :param kind: Link type, as reported by meth:getLink.
+        :return: The new class:SimulatedLink.
+        :raise SimulatorError: If there already is a link by that name.
+        """
+        with self._lock:
+            if name in self.links:
+                raise SimulatorError(EXISTS_TEXT)
+            link = self.links[name] = SimulatedLink(self._next_index, name, kind, mtu, up)
+            self._next_index += 1
+            return link
+    #---
+
+
+    def removeLink(self, name):
+        """
+        Deletes a link, with its addresses and every route through it (as the kernel does).
+
+        :raise SimulatorError: If there's no such link.
+        """
+        with self._lock:
+            self._link(name)
+            del self.links[name]
+            self._connected = None
+            for table, routes in self.tables.items():
+                for key, route in list(routes.items()):
+                    if route.device == name or any(hop.device == name for hop in route.nexthops):
+                        del routes[key]
+    #---
+
+
+    def _link(self, name):
+        link = self.links.get(name)
+        if link is None:
+            raise SimulatorError(NO_DEVICE_TEXT %name)
+        return link
+    #---
+
+
+    def _checkPrivileged(self):
+        if not self.privileged:
+            raise SimulatorError(PERMISSION_TEXT)
+    #---
+
+
+    # -------- 'ip' command lines --------
+
+    def execute(self, tokens, family = None):
+        """
+        Runs one 'ip' command line against the simulated kernel.
+
+        :param tokens: Argument list, without the leading 'ip'.
+        :param family: IP version to assume when the command doesn't give -4/-6.
+        :return: The output text.
+        :raise SimulatorError: If the command fails.
+        """
+        tokens = list(tokens)
+        while tokens and tokens[0].startswith('-'):
+            option = tokens.pop(0)
+            if option in ('-4', '-6'):
+                family = int(option[1])
+            elif option in ('-j', '-json'):
+                raise SimulatorError("JSON output isn't simulated", backend.RET_ERROR)
+            elif option not in ('-d', '-details', '-s', '-stats', '-force'):
+                raise SimulatorError('Option "%s" is unknown, try "ip -help".' %option, backend.RET_ERROR)
+
+        if not tokens:
+            raise SimulatorError('Usage: ip [ OPTIONS ] OBJECT { COMMAND | help }', backend.RET_ERROR)
+        for command_object in OBJECTS:
+            if command_object.startswith(tokens[0]):
+                break
+        else:
+            raise SimulatorError('Object "%s" is unknown, try "ip help".' %tokens[0], backend.RET_ERROR)
+
+        action = tokens[1] if len(tokens) > 1 else 'show'
+        if action in LIST_ACTIONS:
+            action = 'show'
+        elif action != 'show':
+            self._checkPrivileged()
+
+        with self._lock:
+            try:
+                return getattr(self, '_%sCommand' %command_object)(action, tokens[2:], family)
+            except (IndexError, ValueError):
+                raise SimulatorError('Command line is not complete. Try option "help"', backend.RET_ERROR)
+    #---
+
+
+    def _device(self, arguments):
+        """
+        Picks the device out of 'dev NAME' (or a bare NAME), as 'ip link' and 'ip address' take it.
+
+        """
+        if 'dev' in arguments:
+            return arguments[arguments.index('dev') + 1]
+        return arguments[0] if arguments else None
+    #---
+
+
+    def _linkCommand(self, action, arguments, family):
+        name = self._device(arguments)
+        if action == 'show':
+            if name is not None and name not in self.links:
+                raise SimulatorError(NO_LINK_TEXT %name)
+            return ''.join(link.text() for link in self.links.values() if name in (None, link.name))
+
+        if action == 'add':
+            arguments = arguments[1:] if arguments[0] == 'name' else arguments
+            kind = arguments[arguments.index('type') + 1] if 'type' in arguments else 'dummy'
+            self.addLink(arguments[0], kind)
+        elif action in ('del', 'delete'):
+            self.removeLink(name)
+        elif action == 'set':
+            link = self._link(name)
+            for position, token in enumerate(arguments):
+                if token in ('up', 'down'):
+                    link.up = token == 'up'
+                    self._connected = None
+                elif token == 'mtu':
+                    link.mtu = int(arguments[position + 1])
+        else:
+            raise SimulatorError('Command "%s" is unknown, try "ip link help".' %action, backend.RET_ERROR)
+        return ''
+    #---
+
+
+    def _addressCommand(self, action, arguments, family):
+        name = arguments[arguments.index('dev') + 1] if 'dev' in arguments else None
+        if action == 'show':
+            if name is not None and name not in self.links:
+                raise SimulatorError(NO_LINK_TEXT %name)
+            return ''.join(link.text(True) for link in self.links.values() if name in (None, link.name))
+
+        link = self._link(name)
+        self._connected = None
+        if action == 'flush':
+            link.addresses = [address for address in link.addresses if family not in (None, address[0])]
+            return ''
+
+        try:
+            address = ipprefix.parsePrefix(arguments[0])
+        except (ipprefix.PrefixError, IndexError):
+            raise SimulatorError('Error: any valid prefix is expected rather than "%s".' %' '.join(arguments[:1]),
+                                 backend.RET_ERROR)
+        if action == 'add':
+            if any(address[:2] == known[:2] for known in link.addresses):
+                raise SimulatorError(EXISTS_TEXT)
+            link.addresses.append(address)
+        elif action in ('del', 'delete'):
+            for known in link.addresses:
+                if address[:2] == known[:2]:
+                    link.addresses.remove(known)
+                    break
+            else:
+                raise SimulatorError(NO_ADDRESS_TEXT)
+        else:
+            raise SimulatorError('Command "%s" is unknown, try "ip address help".' %action, backend.RET_ERROR)
+        return ''
+    #---
+
+
+    def _tableId(self, table):
+        table = str(table or 'main')
+        return TABLE_IDS.get(table, table)
+    #---
+
+
+    def _connectedRoutes(self):
+        """
+        Returns the prefix routes the kernel adds to the main table for the addresses of links which are up.
+
+        :return: OrderedDict of meth:Route.key -> Route.
+        """
+        if self._connected is None:
+            self._connected = collections.OrderedDict()
+            for link in self.links.values():
+                if not link.up or link.kind == 'loopback':
+                    continue
+                for version, address, length in link.addresses:
+                    if length == ipprefix.MAX_LENGTH[version]:
+                        continue
+                    network = ipprefix.formatPrefix(version, address & ipprefix.networkMask(version, length), length)
+                    if version == ipprefix.IP_V4:
+                        route = Route("%s dev %s proto kernel scope link src %s"
+                                      %(network, link.name, ipprefix.formatPrefix(version, address)))
+                    else:
+                        route = Route("%s dev %s proto kernel metric 256" %(network, link.name))
+                    self._connected.setdefault(route.key(), route)
+        return self._connected
+    #---
+
+
+    def _routes(self, table_id, version):
+        """
+        Lists a table's routes of one IP version, connected routes first for main.
+
+        """
+        routes = list(self.tables.get(table_id, {}).values())
+        if table_id == TABLE_IDS['main']:
+            routes = list(self._connectedRoutes().values()) + routes
+        return [route for route in routes if route.version() == version]
+    #---
+
+
+    def _routeCommand(self, action, arguments, family):
+        version = family or ipprefix.IP_V4
+        if action in ('show', 'flush'):
+            table = arguments[arguments.index('table') + 1] if 'table' in arguments else 'main'
+            table_ids = sorted(self.tables, key = lambda table_id: (len(table_id), table_id)) \
+                        if table == 'all' else [self._tableId(table)]
+            if table != 'all' and version == ipprefix.IP_V6 and table_ids[0] not in self._v6_tables | {'254', '255'}:
+                raise SimulatorError(NO_TABLE_TEXT, backend.RET_PERMISSION)
+
+            if action == 'flush':
+                routes = self.tables.get(table_ids[0], {})
+                for key in [key for key, route in routes.items() if route.version() == version]:
+                    del routes[key]
+                return ''
+
+            if table == 'all' and TABLE_IDS['main'] not in table_ids:
+                table_ids.append(TABLE_IDS['main'])
+            lines = []
+            for table_id in table_ids:
+                for route in self._routes(table_id, version):
+                    # 'ip' names the table of every route but main's when it lists them all
+                    shown = TABLE_NAMES.get(table_id, table_id) if table == 'all' and table_id != '254' else None
+                    lines.append(route.render(shown) + '\n')
+            return ''.join(lines)
+
+        try:
+            route = Route(' '.join(arguments), family)
+        except RouteError as error:
+            raise SimulatorError("Error: %s" %error, backend.RET_ERROR)
+        for device in [route.device] + [hop.device for hop in route.nexthops]:
+            if device is not None:
+                self._link(device)
+        if route.nhid is not None and route.nhid not in self.nexthops:
+            raise SimulatorError("Error: Nexthop id does not exist.", backend.RET_PERMISSION)
+
+        table_id = self._tableId(route.table)
+        key = route.key()
+        routes = self.tables.setdefault(table_id, collections.OrderedDict())
+        # Stored routes leave the table out, like 'ip route show table X' does
+        route.table = None
+
+        if action in ('add', 'append', 'prepend'):
+            if key in routes or (table_id == TABLE_IDS['main'] and key in self._connectedRoutes()):
+                raise SimulatorError(EXISTS_TEXT)
+            routes[key] = route
+        elif action in ('replace', 'change'):
+            if action == 'change' and key not in routes:
+                raise SimulatorError(NO_ROUTE_TEXT)
+            routes[key] = route
+        elif action in ('del', 'delete'):
+            if key not in routes:
+                # Without a metric, the kernel deletes the first route to the prefix, whatever its metric
+                matches = [stored_key for stored_key in routes if route.metric is None and
+                           stored_key[:4] == key[:4] and stored_key[5:] == key[5:]]
+                if not matches:
+                    raise SimulatorError(NO_ROUTE_TEXT)
+                key = matches[0]
+            del routes[key]
+            return ''
+        else:
+            raise SimulatorError('Command "%s" is unknown, try "ip route help".' %action, backend.RET_ERROR)
+
+        if route.version() == ipprefix.IP_V6:
+            self._v6_tables.add(table_id)
+        return ''
+    #---
+
+
+    def _ruleCommand(self, action, arguments, family):
+        if action == 'show':
+            lines = []
+            for rule in self.rules[family or ipprefix.IP_V4]:
+                # 'ip rule show' gives the priority up front
+                shown = copy.copy(rule)
+                shown.priority = None
+                lines.append("%s:\t%s\n" %(rule.priority, shown))
+            return ''.join(lines)
+
+        try:
+            rule = RouteRule(' '.join(arguments), family = family)
+        except RouteRuleError as error:
+            raise SimulatorError("Error: %s" %error, backend.RET_ERROR)
+        rules = self.rules[rule.version()]
+
+        if action == 'add':
+            if rule.priority is None:
+                # The kernel puts rules without a priority just above the highest priority one after rule 0
+                priorities = [int(known.priority) for known in rules if int(known.priority)]
+                rule.priority = min(priorities) - 1 if priorities else 0
+            rule.priority = int(rule.priority)
+            if any(known.key() == rule.key() and str(known) == str(rule) for known in rules):
+                raise SimulatorError(EXISTS_TEXT)
+            # Rules with the same priority stay in the order they were added
+            position = len([known for known in rules if int(known.priority) <= rule.priority])
+            rules.insert(position, rule)
+        elif action in ('del', 'delete'):
+            for known in rules:
+                if self._ruleMatches(rule, known):
+                    rules.remove(known)
+                    break
+            else:
+                raise SimulatorError(NO_RULE_TEXT, backend.RET_PERMISSION)
+        else:
+            raise SimulatorError('Command "%s" is unknown, try "ip rule help".' %action, backend.RET_ERROR)
+        return ''
+    #---
+
+
+    def _ruleMatches(self, rule, known):
+        """
+        Checks whether a rule given to 'ip rule del' picks a kernel rule: every attribute it sets has to agree.
+
+        """
+        if rule.priority is not None and int(rule.priority) != int(known.priority):
+            return False
+        for wanted, value in zip(rule.selector(), known.selector()):
+            if wanted not in (None, False) and wanted != value:
+                return False
+        if rule.table is not None and self._tableId(rule.table) != self._tableId(known.table):
+            return False
+        return (rule.type or 'unicast') == (known.type or 'unicast') or rule.type is None
+    #---
+
+
+    def _nexthopCommand(self, action, arguments, family):
+        if action == 'show':
+            return ''.join("id %s %s\n" %(nexthop_id, text) for nexthop_id, text in self.nexthops.items())
+        if action == 'flush':
+            self.nexthops.clear()
+            return ''
+        if 'id' not in arguments:
+            raise SimulatorError("Error: Nexthop id is required.", backend.RET_ERROR)
+
+        position = arguments.index('id')
+        nexthop_id = arguments[position + 1]
+        text = ' '.join(arguments[:position] + arguments[position + 2:])
+        if action == 'add':
+            if nexthop_id in self.nexthops:
+                raise SimulatorError(EXISTS_TEXT)
+            self.nexthops[nexthop_id] = text
+        elif action == 'replace':
+            self.nexthops[nexthop_id] = text
+        elif action in ('del', 'delete'):
+            if self.nexthops.pop(nexthop_id, None) is None:
+                raise SimulatorError(NO_RULE_TEXT, backend.RET_PERMISSION)
+        else:
+            raise SimulatorError('Command "%s" is unknown, try "ip nexthop help".' %action, backend.RET_ERROR)
+        return ''
+    #---
+
+
+    def _run(self, tokens, family = None, **data):
+        """
+        meth:execute, as a result dictionary.
+
+        """
+        try:
+            return backend.result(stdout = self.execute(tokens, family), **data)
+        except SimulatorError as error:
+            return backend.result(error.return_value, stderr = "%s\n" %error, **data)
+    #---
+
+
+    def ip(self, arguments):
+        return self._run(splitCommand(arguments))
+    #---
+
+
+    def ipStream(self, arguments):
+        ip_result = self.ip(arguments)
+        for line in ip_result['stdout'].splitlines(True):
+            yield line
+        if ip_result['return_value']:
+            raise backend.BackendError("'ip %s' failed (%d): %s" %(arguments, ip_result['return_value'],
+                                                                   ip_result['stderr'].strip()))
+    #---
+
+
+    def batch(self, commands, family = None):
+        errors = {}
+        stderr = ''
+        with self._lock:
+            for index, command in enumerate(commands):
+                try:
+                    self.execute(splitCommand(command), family)
+                except SimulatorError as error:
+                    errors[index] = str(error)
+                    stderr += "%s\nCommand failed -:%d\n" %(error, index + 1)
+        return backend.result(backend.RET_ERROR if errors else backend.RET_OK, stderr = stderr, errors = errors)
+    #---
+
+
+    # -------- Backend calls --------
+
+    def showLink(self, name):
+        ip_link = self._run(['link', 'show', name])
+        link = self.links.get(name)
+        return backend.result(ip_link['return_value'], ip_link['stdout'], ip_link['stderr'],
+                              state = link.state() if link and not ip_link['return_value'] else None)
+    #---
+
+
+    def setLinkState(self, name, up):
+        return self._run(['link', 'set', name, 'up' if up else 'down'])
+    #---
+
+
+    def getAddresses(self, name):
+        ip_address = self._run(['address', 'show', 'dev', name])
+        addresses = {'v4': [], 'v6': []}
+        if not ip_address['return_value']:
+            addresses = self.links[name].record().addressDict()
+        return backend.result(ip_address['return_value'], ip_address['stdout'], ip_address['stderr'],
+                              addresses = addresses)
+    #---
+
+
+    def addAddress(self, name, address):
+        return self._run(['address', 'add', address, 'dev', name])
+    #---
+
+
+    def delAddress(self, name, address):
+        return self._run(['address', 'del', address, 'dev', name])
+    #---
+
+
+    def getLink(self, name):
+        with self._lock:
+            link = self.links.get(name)
+            if link is None:
+                return backend.result(backend.RET_NO_DEVICE, stderr = "%s\n" %(NO_LINK_TEXT %name), link = None)
+            return backend.result(link = link.record())
+    #---
+
+
+    def dumpLinks(self):
+        with self._lock:
+            return backend.result(links = [link.linkDict() for link in self.links.values()])
+    #---
+
+
+    def _batchResult(self, commands):
+        ip_batch = self.batch(commands)
+        errors = dict((index, (ippool.returnValue(text), text)) for index, text in ip_batch['errors'].items())
+        return backend.result(ip_batch['return_value'], stderr = ip_batch['stderr'], errors = errors)
+    #---
+
+
+    def addressBatch(self, operations):
+        return self._batchResult(["address %s \"%s\" dev \"%s\"" %(action, address, name)
+                                  for action, name, address in operations])
+    #---
+
+
+    def setLinksState(self, names, up):
+        return self._batchResult(["link set \"%s\" %s" %(name, 'up' if up else 'down') for name in names])
+    #---
+#---
+
+
+backend.BACKENDS[SimulatedBackend.name] = SimulatedBackend
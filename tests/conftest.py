@@ -0,0 +1,48 @@
+#
+# $Id$
+#
+# NAME:         conftest.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Shared fixtures.  Tests run against class:simulator.SimulatedBackend, so they need neither root nor a real 'ip'.
+#
+
+import pytest
+
+from .. import backend
+from .. import simulator
+
+
+@pytest.fixture
+def simulated():
+    """
+    Makes a fresh simulated kernel the active backend, with an 'eth0' holding 10.1.0.1/24 and 2001:db8:1::1/64.  The
+    previous backend is put back afterwards.
+
+    """
+    previous = backend._backend
+    simulated = backend.setBackend(simulator.SimulatedBackend())
+    simulated.addLink('eth0', up = True)
+    simulated.ip('address add 10.1.0.1/24 dev eth0')
+    simulated.ip('address add 2001:db8:1::1/64 dev eth0')
+
+    yield simulated
+
+    with backend._backend_lock:
+        backend._backend = previous
+#---
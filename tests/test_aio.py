@@ -0,0 +1,201 @@
+#
+# $Id$
+#
+# NAME:         test_aio.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Tests of the asyncio classes, with a runner which sends 'ip' to the simulated kernel instead of a subprocess.
+#
+
+import asyncio
+
+import pytest
+
+from .. import aio
+from .. import backend
+from .. import routestore
+from ..interface import AddressError, InterfaceBatchError, RequiresEscalationError
+from ..route import Route
+from ..routingtable import RoutingTable
+
+# 'ip route' output for a multipath route: the nexthops go on lines of their own
+MULTIPATH_OUTPUT = ['10.2.0.0/16 proto static\n', '\tnexthop via 10.1.0.253 dev eth0 weight 1\n',
+                    '\tnexthop via 10.1.0.254 dev eth0 weight 1\n', '10.3.0.0/16 dev eth0\n']
+
+
+class SimulatedRunner(aio.AsyncRunner):
+    """
+    Runner which hands 'ip' to the active (simulated) backend.
+    """
+
+    async def _run(self, arguments, stdin = None):
+        simulated = backend.getBackend()
+        if '-batch' in arguments:
+            family = int(arguments[0][1]) if arguments[0] in ('-4', '-6') else None
+            ip_batch = simulated.batch(stdin.splitlines(), family)
+            return ip_batch['return_value'], '', ip_batch['stderr']
+
+        ip_result = simulated.ip(' '.join(arguments))
+        return ip_result['return_value'], ip_result['stdout'], ip_result['stderr']
+    #---
+
+
+    async def stream(self, arguments):
+        for line in backend.getBackend().ipStream(arguments):
+            yield line
+    #---
+#---
+
+
+def run(coroutine):
+    return asyncio.new_event_loop().run_until_complete(coroutine)
+#---
+
+
+@pytest.fixture
+def runner(simulated):
+    return SimulatedRunner()
+#---
+
+
+def test_runnerDefaults():
+    assert aio.AsyncRunner().timeout == aio.AsyncRunner.timeout
+    assert aio.AsyncRunner(timeout = None).timeout is None
+    assert aio.AsyncRunner(timeout = 0).timeout == 0
+    with pytest.raises(aio.AsyncError):
+        aio.AsyncRunner(limit = 0)
+#---
+
+
+def test_diffMatchesBlockingDiff(simulated, runner):
+    RoutingTable('100', routes = [Route('10.2.0.0/16 dev eth0'), Route('10.3.0.0/16 dev eth0'),
+                                  Route('2001:db8::/32 dev eth0')]).apply()
+    routes = [Route('10.2.0.0/16 via 10.1.0.254'), Route('10.4.0.0/16 dev eth0')]
+
+    expected = RoutingTable('100', routes = routes).diff()
+    adds, deletes, replaces = run(aio.AsyncRoutingTable('100', routes = routes, runner = runner).diff())
+
+    assert [str(route) for route in adds] == [str(route) for route in expected[0]]
+    assert sorted(str(route) for route in deletes) == sorted(str(route) for route in expected[1])
+    assert [str(route) for route in replaces] == [str(route) for route in expected[2]]
+#---
+
+
+def test_iterRoutesJoinsMultipath(runner):
+    class MultipathRunner(SimulatedRunner):
+        async def stream(self, arguments):
+            for line in MULTIPATH_OUTPUT:
+                yield line
+
+    async def listRoutes():
+        return [route async for route in aio.AsyncRoutingTable('100', runner = MultipathRunner()).iterRoutes()]
+
+    routes = run(listRoutes())
+    assert [route.network for route in routes] == ['10.2.0.0/16', '10.3.0.0/16']
+    assert [hop.via for hop in routes[0].nexthops] == ['10.1.0.253', '10.1.0.254']
+#---
+
+
+def test_interfaceAddressBatches(simulated, runner):
+    eth0 = aio.AsyncInterface('eth0', runner = runner)
+
+    adds, deletes = run(eth0.replaceAddresses(['10.1.0.1/24', '10.7.0.1/16']))
+    assert (adds, deletes) == (['10.7.0.1/16'], ['2001:db8:1::1/64'])
+    assert eth0.addresses == {'v4': [('10.1.0.1', '24'), ('10.7.0.1', '16')], 'v6': []}
+
+    with pytest.raises(InterfaceBatchError) as error:
+        run(eth0.addAddresses(['10.8.0.1/24', '10.7.0.1/16']))
+    assert [(address, type(failure)) for address, failure in error.value.failures] == [('10.7.0.1/16', AddressError)]
+
+    run(eth0.delAddresses(['10.8.0.1/24']))
+    assert run(eth0.getAddresses())['v4'] == [('10.1.0.1', '24'), ('10.7.0.1', '16')]
+#---
+
+
+def test_interfaceUnprivileged(simulated, runner):
+    eth0 = aio.AsyncInterface('eth0', runner = runner)
+    simulated.privileged = False
+
+    with pytest.raises(RequiresEscalationError):
+        run(eth0.addAddress('10.5.0.1/24'))
+#---
+
+
+def test_parseModes(simulated, runner):
+    simulated.ip('route add 10.2.0.0/16 dev eth0 table 100')
+    simulated.ip('route add 2001:db8::/32 dev eth0 table 100')
+    table = aio.AsyncRoutingTable('100', runner = runner)
+
+    added, removed, unchanged = run(table.parse(incremental = True))
+    assert sorted(route.network for route in added) == ['10.2.0.0/16', '2001:db8::/32']
+
+    simulated.ip('route add 10.3.0.0/16 dev eth0 table 100')
+    added, removed, unchanged = run(table.parse(incremental = True))
+    assert [route.network for route in added] == ['10.3.0.0/16']
+    assert len(unchanged) == 2
+
+    # A full parse drops the snapshot, so the next incremental parse starts over
+    run(table.parse(compact = True))
+    assert len(table.routes) == 3
+    added, removed, unchanged = run(table.parse(incremental = True))
+    assert (len(added), removed, unchanged) == (3, [], [])
+
+    with pytest.raises(aio.RoutingTableError):
+        run(table.parse(compact = True, incremental = True))
+#---
+
+
+def test_compactParseStreams(simulated, runner, monkeypatch):
+    simulated.ip('route add 10.2.0.0/16 dev eth0 table 100')
+    simulated.ip('route add 2001:db8::/32 dev eth0 table 100')
+    simulated.ip('-6 route add default dev eth0 table 100')
+    table = aio.AsyncRoutingTable('100', runner = runner)
+    stored = []
+    append = routestore.RouteStore.append
+
+    def appendOne(store, route):
+        stored.append(len(store))
+        append(store, route)
+    monkeypatch.setattr(routestore.RouteStore, 'append', appendOne)
+    # The full route list is never built
+    monkeypatch.setattr(table, '_liveRoutes', None)
+
+    run(table.parse(compact = True))
+    assert isinstance(table.routes, routestore.RouteStore)
+    assert stored == [0, 1, 2]
+    assert [(route.network, route.version()) for route in table.routes] == [('10.2.0.0/16', 4),
+                                                                          ('2001:db8::/32', 6), ('default', 6)]
+#---
+
+
+def test_swap(simulated, runner):
+    RoutingTable('100', routes = [Route('10.2.0.0/16 dev eth0'), Route('10.3.0.0/16 dev eth0')]).apply()
+    table = aio.AsyncRoutingTable('100', routes = [Route('10.4.0.0/16 dev eth0'), Route('10.5.0.0/16 dev eth9')],
+                                  runner = runner)
+
+    with pytest.raises(aio.BatchError):
+        run(table.apply(atomic = True))
+    assert [route.network for route in RoutingTable('100').iterRoutes()] == ['10.2.0.0/16', '10.3.0.0/16']
+
+    table.routes.pop()
+    run(table.apply(atomic = True))
+    assert [route.network for route in RoutingTable('100').iterRoutes()] == ['10.4.0.0/16']
+
+    with pytest.raises(aio.AsyncError):
+        run(table.swap(scratch = 200))
+#---
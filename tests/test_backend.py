@@ -0,0 +1,91 @@
+#
+# $Id$
+#
+# NAME:         test_backend.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Tests of the backend helpers and of batch error reporting.
+#
+
+import shutil
+
+import pytest
+
+from .. import backend
+from .. import ippool
+from .. import simulator
+
+
+def test_parseBatchErrors():
+    stderr = ("RTNETLINK answers: File exists\nCommand failed -:2\n"
+              "RTNETLINK answers: No such process\nCommand failed -:5\n")
+    assert backend.parseBatchErrors(stderr) == ({2: simulator.EXISTS_TEXT, 5: simulator.NO_ROUTE_TEXT}, None)
+#---
+
+
+def test_parseBatchErrorsAborted():
+    stderr = 'RTNETLINK answers: File exists\nCommand failed -:1\nError: inet prefix is expected rather than "10.x".\n'
+    errors, aborted_text = backend.parseBatchErrors(stderr)
+
+    assert errors == {1: simulator.EXISTS_TEXT}
+    assert aborted_text == 'Error: inet prefix is expected rather than "10.x".'
+    commands = ['route add 10.0.0.0/8 dev eth0', 'route add 10.x dev eth0', 'route add 10.2.0.0/16 dev eth0']
+    assert backend.findAbortedCommand(commands, 1, aborted_text) == 1
+    assert backend.findAbortedCommand(commands, 2, aborted_text) is None
+#---
+
+
+def test_returnValue():
+    assert ippool.returnValue(simulator.PERMISSION_TEXT) == backend.RET_PERMISSION
+    assert ippool.returnValue(simulator.EXISTS_TEXT) == backend.RET_EXISTS
+    assert ippool.returnValue(simulator.NO_DEVICE_TEXT %'eth9') == backend.RET_NO_DEVICE
+    assert ippool.returnValue("Error: something else") == backend.RET_ERROR
+#---
+
+
+def test_batchErrorsByIndex(simulated):
+    ip_batch = simulated.batch(['route add 10.2.0.0/16 dev eth0', 'route add 10.2.0.0/16 dev eth0',
+                                'route add 10.3.0.0/16 dev eth9', 'route add 10.4.0.0/16 dev eth0'])
+
+    assert ip_batch['return_value'] == backend.RET_ERROR
+    assert ip_batch['errors'] == {1: simulator.EXISTS_TEXT, 2: simulator.NO_DEVICE_TEXT %'eth9'}
+    # A failure doesn't stop the commands after it
+    assert 'dev eth0' in simulated.ip('route show 10.4.0.0/16')['stdout']
+#---
+
+
+def test_addressBatchReturnValues(simulated):
+    ip_batch = simulated.addressBatch([('add', 'eth0', '10.1.0.1/24'), ('add', 'eth0', '10.1.0.2/24'),
+                                       ('add', 'eth9', '10.1.0.3/24')])
+
+    assert ip_batch['errors'] == {0: (backend.RET_EXISTS, simulator.EXISTS_TEXT),
+                                  2: (backend.RET_NO_DEVICE, simulator.NO_DEVICE_TEXT %'eth9')}
+#---
+
+
+def test_netlinkStatusMatchesIP():
+    if not hasattr(backend.socket, 'AF_NETLINK') or not shutil.which('ip'):
+        pytest.skip("needs netlink and the 'ip' command")
+    netlink = backend.NetlinkBackend()
+    process = backend.ProcessBackend()
+
+    links = netlink.dumpLinks()['links']
+    assert links
+    for link in links:
+        assert netlink.showLink(link['name'])['stdout'] == process.showLink(link['name'])['stdout']
+#---
@@ -0,0 +1,260 @@
+#
+# $Id$
+#
+# NAME:         test_interface.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Tests of class:interface.Interface against the simulated kernel.
+#
+
+import pytest
+
+from .. import interface
+from ..interface import Interface, InterfaceError, InterfaceRegistry, AddressError, InterfaceBatchError, \
+                        RequiresEscalationError
+from .test_monitor import ReplayMonitor
+
+
+def test_addAndDelAddress(simulated):
+    eth0 = Interface('eth0')
+    eth0.addAddress('10.5.0.1/24')
+    assert ('10.5.0.1', '24') in eth0.addresses['v4']
+
+    with pytest.raises(AddressError):
+        eth0.addAddress('10.5.0.1/24')
+
+    eth0.delAddress('10.5.0.1/24')
+    assert ('10.5.0.1', '24') not in eth0.getAddresses()['v4']
+#---
+
+
+def test_unprivilegedErrorsMatch(simulated):
+    eth0 = Interface('eth0')
+    simulated.privileged = False
+
+    with pytest.raises(RequiresEscalationError):
+        eth0.addAddress('10.5.0.1/24')
+    with pytest.raises(RequiresEscalationError):
+        eth0.delAddress('10.1.0.1/24')
+    with pytest.raises(InterfaceBatchError) as error:
+        eth0.addAddresses(['10.5.0.1/24'])
+    assert isinstance(error.value.failures[0][1], RequiresEscalationError)
+#---
+
+
+def test_addAddressesReportsFailures(simulated):
+    eth0 = Interface('eth0')
+
+    with pytest.raises(InterfaceBatchError) as error:
+        eth0.addAddresses(['10.5.0.1/24', '10.1.0.1/24', '10.6.0.1/24'])
+
+    assert [(address, type(failure)) for address, failure in error.value.failures] == [('10.1.0.1/24', AddressError)]
+    assert ('10.6.0.1', '24') in eth0.addresses['v4']
+#---
+
+
+def test_replaceAddresses(simulated):
+    eth0 = Interface('eth0')
+    adds, deletes = eth0.replaceAddresses(['10.1.0.1/24', '10.7.0.1/16'])
+
+    assert (adds, deletes) == (['10.7.0.1/16'], ['2001:db8:1::1/64'])
+    assert eth0.getAddresses() == {'v4': [('10.1.0.1', '24'), ('10.7.0.1', '16')], 'v6': []}
+#---
+
+
+def test_setLinksState(simulated):
+    simulated.addLink('eth1')
+
+    interface.setLinksState(['eth1'], True)
+    assert Interface('eth1').status(simple = True) == 'UNKNOWN'
+    with pytest.raises(InterfaceBatchError):
+        interface.setLinksState(['eth1', 'eth9'], False)
+    assert Interface('eth1').status(simple = True) == 'DOWN'
+#---
+
+
+def test_registryLoadsEveryLink(simulated):
+    simulated.addLink('eth1')
+    simulated.ip('address add 10.5.0.1/24 dev eth1')
+    registry = InterfaceRegistry()
+
+    names = [link.name for link in simulated.links.values()]
+    assert len(registry) == len(names)
+    assert [eth.name for eth in registry] == sorted(names, key = registry.indexes.get)
+    assert 'eth1' in registry and 'eth9' not in registry
+    assert registry.names[registry.indexes['eth1']] == 'eth1'
+    # Interfaces come with the addresses from the dump
+    assert registry['eth0'].addresses == {'v4': [('10.1.0.1', '24')], 'v6': [('2001:db8:1::1', '64')]}
+    assert registry['eth1'].addresses == {'v4': [('10.5.0.1', '24')], 'v6': []}
+#---
+
+
+def test_registryLookups(simulated):
+    registry = InterfaceRegistry()
+
+    eth0 = registry.get('eth0')
+    assert registry['eth0'] is eth0
+    assert registry.byIndex(registry.indexes['eth0']) is eth0
+    assert registry.byAddress('10.1.0.1') is eth0
+    assert registry.byAddress('2001:db8:1::1/64') is eth0
+    assert registry.byAddress('10.1.0.2') is None
+
+    with pytest.raises(InterfaceError):
+        registry.get('eth9')
+    with pytest.raises(InterfaceError):
+        registry.byIndex(999)
+#---
+
+
+def test_registryDoesNotProbe(simulated):
+    registry = InterfaceRegistry()
+    probes = []
+    simulated.showLink = lambda name: probes.append(name)
+    simulated.getAddresses = lambda name: probes.append(name)
+
+    assert [eth.addresses for eth in registry]
+    assert probes == []
+#---
+
+
+def test_registryRefresh(simulated):
+    simulated.addLink('eth1')
+    registry = InterfaceRegistry(load = False)
+    assert len(registry) == 0
+    registry.refresh()
+    eth0 = registry['eth0']
+
+    simulated.ip('address add 10.6.0.1/24 dev eth0')
+    simulated.removeLink('eth1')
+    # Only the dump is read until the registry is refreshed
+    assert ('10.6.0.1', '24') not in eth0.addresses['v4']
+    assert 'eth1' in registry
+
+    registry.refresh()
+    assert registry['eth0'] is eth0
+    assert ('10.6.0.1', '24') in eth0.addresses['v4']
+    assert registry.byAddress('10.6.0.1') is eth0
+    assert 'eth1' not in registry
+    with pytest.raises(InterfaceError):
+        registry.get('eth1')
+#---
+
+
+def test_registryWatch(simulated):
+    registry = InterfaceRegistry()
+    eth0 = registry['eth0']
+    simulated.ip('address add 10.6.0.1/24 dev eth0')
+    assert ('10.6.0.1', '24') not in eth0.addresses['v4']
+
+    replay = ReplayMonitor(['[ADDR]2: eth1    inet 10.7.0.1/24 scope global eth1',
+                            '[ADDR]2: eth0    inet 10.6.0.1/24 scope global eth0'])
+    registry.watch(replay)
+    replay._dispatch()
+    assert ('10.6.0.1', '24') in eth0.addresses['v4']
+#---
+
+
+class Clock(object):
+    """
+    Stand-in for the time module, moved forward by hand.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+    #---
+
+
+    def time(self):
+        return self.now
+    #---
+#---
+
+
+def test_addressCacheKeepsOwnChanges(simulated):
+    eth0 = Interface('eth0')
+    assert eth0.addresses['v4'] == [('10.1.0.1', '24')]
+
+    # Changes made through the object update the cache, outside changes aren't seen until it's invalidated
+    eth0.addAddress('10.5.0.1/24')
+    simulated.ip('address add 10.6.0.1/24 dev eth0')
+    assert eth0.addresses['v4'] == [('10.1.0.1', '24'), ('10.5.0.1', '24')]
+    eth0.delAddress('10.5.0.1')
+    assert eth0.addresses['v4'] == [('10.1.0.1', '24')]
+
+    eth0.invalidateAddresses()
+    assert eth0.addresses['v4'] == [('10.1.0.1', '24'), ('10.6.0.1', '24')]
+    # Copies are handed out, so callers can't change the cache
+    eth0.addresses['v4'].append(('10.7.0.1', '24'))
+    assert ('10.7.0.1', '24') not in eth0.addresses['v4']
+#---
+
+
+def test_addressCacheExpires(simulated, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(interface, 'time', clock)
+    eth0 = Interface('eth0', config = {'address_ttl': 10})
+    assert eth0.addresses['v4'] == [('10.1.0.1', '24')]
+
+    simulated.ip('address add 10.6.0.1/24 dev eth0')
+    clock.now += 10
+    assert eth0.addresses['v4'] == [('10.1.0.1', '24')]
+    clock.now += 0.5
+    assert eth0.addresses['v4'] == [('10.1.0.1', '24'), ('10.6.0.1', '24')]
+
+    # The read starts the TTL over
+    simulated.ip('address del 10.6.0.1/24 dev eth0')
+    clock.now += 5
+    assert ('10.6.0.1', '24') in eth0.addresses['v4']
+    clock.now += 6
+    assert eth0.addresses['v4'] == [('10.1.0.1', '24')]
+#---
+
+
+def test_addressCacheWithoutTTL(simulated, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(interface, 'time', clock)
+    eth0 = Interface('eth0')
+    eth0.getAddresses()
+
+    simulated.ip('address add 10.6.0.1/24 dev eth0')
+    clock.now += 86400
+    assert ('10.6.0.1', '24') not in eth0.addresses['v4']
+#---
+
+
+def test_addressCacheFollowsMonitor(simulated):
+    eth0 = Interface('eth0')
+    assert eth0.addresses['v4'] == [('10.1.0.1', '24')]
+
+    simulated.ip('address add 10.6.0.1/24 dev eth0')
+    replay = ReplayMonitor(['[ROUTE]10.6.0.0/24 dev eth0 proto kernel scope link src 10.6.0.1',
+                            '[ADDR]3: eth1    inet 10.7.0.1/24 scope global eth1'])
+    eth0.watch(replay)
+    replay._dispatch()
+    # Neither a route event nor another interface's address event touches the cache
+    assert eth0.addresses['v4'] == [('10.1.0.1', '24')]
+
+    replay.lines = ['[ADDR]2: eth0    inet 10.6.0.1/24 scope global eth0']
+    replay._dispatch()
+    assert eth0.addresses['v4'] == [('10.1.0.1', '24'), ('10.6.0.1', '24')]
+
+    simulated.ip('address del 10.6.0.1/24 dev eth0')
+    replay.lines = ['[ADDR]Deleted 2: eth0    inet 10.6.0.1/24 scope global eth0']
+    replay._dispatch()
+    assert eth0.addresses['v4'] == [('10.1.0.1', '24')]
+#---
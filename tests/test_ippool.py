@@ -0,0 +1,94 @@
+#
+# $Id$
+#
+# NAME:         test_ippool.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Tests of the 'ip -batch' coprocess pool, against the system's 'ip' (read-only commands only).
+#
+
+import shutil
+
+import pytest
+
+from .. import backend
+from .. import ippool
+
+needs_ip = pytest.mark.skipif(not shutil.which('ip'), reason = "needs the 'ip' command")
+
+
+@pytest.fixture
+def pool():
+    ip_pool = ippool.IPPool(1)
+    yield ip_pool
+    ip_pool.close()
+#---
+
+
+def test_splitOptions():
+    assert ippool.splitOptions('route show table 100') == ((), 'route show table 100')
+    assert ippool.splitOptions('-6 -j route show') == (('-6', '-j'), 'route show')
+    assert ippool.splitOptions(' -j  -6 route show') == (('-6', '-j'), 'route show')
+    assert ippool.splitOptions('-n blue link show') is None
+#---
+
+
+@needs_ip
+def test_framing(pool):
+    process = backend.ProcessBackend()
+
+    # Output, errors and the output after an error each end up with their own command
+    for round_number in range(2):
+        assert pool.run('link show dev lo') == process.ip('link show dev lo')
+        failed = pool.run('link show dev nosuch0')
+        assert failed['return_value'] and failed['stdout'] == ''
+        assert failed['stderr'] == 'Device "nosuch0" does not exist.\n'
+        assert pool.run('-6 route show table main')['stdout'] == process.ip('-6 route show table main')['stdout']
+#---
+
+
+@needs_ip
+def test_workerRecovers(pool):
+    # Argument errors make 'ip' exit, even with -force
+    failed = pool.run('link set dev lo mtu xyz')
+    assert failed['return_value'] and 'xyz' in failed['stderr']
+    assert pool.run('link show dev lo')['return_value'] == 0
+
+    # So does a worker killed from outside
+    with pool.worker(link_listing = True) as worker:
+        worker.process.kill()
+        worker.process.wait()
+    assert pool.run('link show dev lo')['return_value'] == 0
+#---
+
+
+@needs_ip
+def test_batchRecovers():
+    pool_backend = backend.PoolBackend(1)
+    pool_backend.batch_chunk = 3
+    try:
+        commands = ['link show dev nosuch0', 'link set dev lo mtu xyz', 'link show dev nosuch1',
+                    'link set dev lo mtu abc', 'link show dev nosuch2']
+        errors = pool_backend.batch(commands)['errors']
+    finally:
+        pool_backend.close()
+
+    assert sorted(errors) == [0, 1, 2, 3, 4]
+    assert [index for index, text in sorted(errors.items()) if 'does not exist' in text] == [0, 2, 4]
+    assert 'xyz' in errors[1] and 'abc' in errors[3]
+#---
@@ -0,0 +1,102 @@
+#
+# $Id$
+#
+# NAME:         test_ipprefix.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Tests of the strict prefix parser and its cache.
+#
+
+import pytest
+
+from .. import ipprefix
+from ..route import Route, RouteError
+from ..routegrammar import NODE_SPEC
+
+
+@pytest.fixture
+def cache():
+    ipprefix.cache.clear()
+    yield ipprefix.cache
+    ipprefix.cache.clear()
+#---
+
+
+@pytest.mark.parametrize('prefix, parsed', [
+    ('192.0.2.0/24', (4, 0xc0000200, 24)),
+    ('192.0.2.1/24', (4, 0xc0000201, 24)),
+    ('192.0.2.1', (4, 0xc0000201, 32)),
+    ('0.0.0.0/0', (4, 0, 0)),
+    ('2001:db8::/32', (6, 0x20010db8 << 96, 32)),
+    ('::1', (6, 1, 128)),
+])
+def test_parsePrefix(cache, prefix, parsed):
+    assert ipprefix.parsePrefix(prefix) == parsed
+#---
+
+
+@pytest.mark.parametrize('prefix', ['192.0.2.0/', '192.0.2.0/33', '2001:db8::/129', '192.0.2.0/024', '192.0.2.0/-1',
+                                    '192.0.2.0/ 24', '192.0.2.0/2a', '192.0.2.0/²', '192.0.2.0/٢٤',
+                                    '192.0.2/24', '192.0.2.256', '2001:db8:::/32', '', 'default'])
+def test_malformedPrefix(cache, prefix):
+    with pytest.raises(ipprefix.PrefixError):
+        ipprefix.parsePrefix(prefix)
+    # The failure is cached, and raised again the same way
+    with pytest.raises(ipprefix.PrefixError):
+        ipprefix.parsePrefix(prefix)
+#---
+
+
+def test_malformedLengthIsARouteError(cache):
+    with pytest.raises(RouteError):
+        Route('192.0.2.0/² dev eth0').validate()
+    assert NODE_SPEC.validatePrefix('192.0.2.0/²')
+#---
+
+
+def test_cacheHits(cache):
+    ipprefix.parsePrefix('192.0.2.0/24')
+    ipprefix.parsePrefix('192.0.2.0/24')
+    with pytest.raises(ipprefix.PrefixError):
+        ipprefix.parsePrefix('192.0.2.0/33')
+    with pytest.raises(ipprefix.PrefixError):
+        ipprefix.parsePrefix('192.0.2.0/33')
+
+    assert (cache.hits, cache.misses, len(cache)) == (2, 2, 2)
+#---
+
+
+def test_lruEviction():
+    lru = ipprefix.LRUCache(2)
+    lru.put('a', 1)
+    lru.put('b', 2)
+    assert lru.get('a') == 1        # 'b' is now the least recently used
+    lru.put('c', 3)
+
+    assert (lru.get('a'), lru.get('b'), lru.get('c')) == (1, None, 3)
+    assert len(lru) == 2
+#---
+
+
+def test_formatPrefix():
+    assert ipprefix.formatPrefix(4, 0xc0000200, 24) == '192.0.2.0/24'
+    assert ipprefix.formatPrefix(4, 0xc0000201, 32) == '192.0.2.1'
+    assert ipprefix.formatPrefix(6, 0x20010db8 << 96, 32) == '2001:db8::/32'
+    assert ipprefix.networkMask(4, 24) == 0xffffff00
+    assert ipprefix.networkMask(6, 0) == 0
+#---
@@ -0,0 +1,75 @@
+#
+# $Id$
+#
+# NAME:         test_monitor.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Tests of 'ip monitor' parsing and of event delivery.
+#
+
+import logging
+
+from .. import monitor
+
+
+class ReplayMonitor(monitor.Monitor):
+    """
+    Monitor which replays fixed 'ip monitor' lines instead of running 'ip'.
+    """
+
+    def __init__(self, lines):
+        super(ReplayMonitor, self).__init__()
+        self.lines = lines
+    #---
+
+
+    def __iter__(self):
+        for line in self.lines:
+            event = monitor.parseEvent(line)
+            if event is not None:
+                yield event
+    #---
+#---
+
+
+def test_parseEvent():
+    event = monitor.parseEvent('[ROUTE]Deleted 10.2.0.0/16 dev eth0 table 100')
+    assert (event.kind, event.action, event.data.network) == (monitor.ROUTE_EVENT, monitor.DELETE, '10.2.0.0/16')
+
+    event = monitor.parseEvent('[ADDR]2: eth0    inet 10.1.0.1/24 brd 10.1.0.255 scope global eth0')
+    assert (event.kind, event.action) == (monitor.ADDRESS_EVENT, monitor.ADD)
+    assert monitor.parseEvent('[NEIGH]10.1.0.254 dev eth0 lladdr 02:00:00:00:00:01 REACHABLE') is None
+#---
+
+
+def test_failingCallbackDoesNotStopDispatch(caplog):
+    replay = ReplayMonitor(['[ROUTE]10.2.0.0/16 dev eth0', '[ROUTE]10.3.0.0/16 dev eth0'])
+    seen = []
+
+    def failing(event):
+        raise ValueError("callback bug")
+
+    replay.addCallback(failing)
+    replay.addCallback(lambda event: seen.append(event.data.network))
+    with caplog.at_level(logging.ERROR, logger = monitor.__name__):
+        replay._dispatch()
+
+    assert seen == ['10.2.0.0/16', '10.3.0.0/16']
+    assert len(caplog.records) == 2
+    assert 'callback bug' in caplog.text
+#---
@@ -0,0 +1,173 @@
+#
+# $Id$
+#
+# NAME:         test_nexthop.py  
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Tests of multipath nexthops, routes pointing at nexthop objects, and the nexthop objects themselves.
+#
+
+import pytest
+
+from .. import nexthop
+from .. import routegrammar
+from ..nexthop import NextHop, NexthopObject, NexthopError
+from ..route import Route
+from ..routingtable import RoutingTable
+
+MULTIPATH = '10.3.0.0/16 proto static metric 20 nexthop via 10.1.0.253 dev eth0 weight 1 ' \
+            'nexthop via 10.1.0.252 dev eth1 weight 3 onlink'
+
+
+def roundTrip(text):
+    """
+    Parses a route, renders it and parses the result again.
+
+    :return: Tuple of (first Route, second Route).
+    """
+    route = Route(text)
+    return route, Route(route.render())
+#---
+
+
+def test_multipathRoundTrip():
+    route, again = roundTrip(MULTIPATH)
+
+    assert route.render() == MULTIPATH
+    assert again.render() == MULTIPATH
+    assert again.nexthops == [NextHop('10.1.0.253', 'eth0', 1), NextHop('10.1.0.252', 'eth1', 3)]
+    assert [hop.flags for hop in again.nexthops] == [[], ['onlink']]
+    assert (again.nexthop, again.device) == (None, None)
+    assert again.matches(route) and route.matches(again)
+#---
+
+
+def test_kernelMultipathRoundTrip():
+    # 'ip route show' puts each nexthop on a line of its own, and can add flags of its own
+    route, again = roundTrip('10.3.0.0/16 proto static metric 20 \n\tnexthop via 10.1.0.253 dev eth0 weight 1 \n'
+                             '\tnexthop via 10.1.0.252 dev eth1 weight 3 onlink')
+
+    assert again.render() == MULTIPATH
+    assert again.key() == Route(MULTIPATH).key()
+#---
+
+
+def test_nhidRoundTrip():
+    route, again = roundTrip('10.4.0.0/16 nhid 12 proto static metric 5')
+
+    assert again.render() == '10.4.0.0/16 proto static metric 5 nhid 12'
+    assert (again.nhid, again.nexthops) == ('12', [])
+    assert again.matches(route)
+    assert not again.matches(Route('10.4.0.0/16 nhid 13 proto static metric 5'))
+#---
+
+
+def test_nhidReplacesNexthops():
+    route = Route('10.4.0.0/16 via 10.1.0.254 dev eth0')
+    route.nhid = '12'
+
+    # The kernel refuses a route with both, so the nexthop object wins
+    assert route.render() == '10.4.0.0/16 nhid 12'
+#---
+
+
+def test_matchesIgnoresNexthopOrder():
+    route = Route(MULTIPATH)
+    swapped = Route('10.3.0.0/16 proto static metric 20 nexthop via 10.1.0.252 dev eth1 weight 3 onlink '
+                    'nexthop via 10.1.0.253 dev eth0 weight 1')
+
+    assert route.matches(swapped) and swapped.matches(route)
+    # A missing weight is the same as weight 1, a different one isn't
+    assert route.matches(Route('10.3.0.0/16 proto static metric 20 nexthop via 10.1.0.253 dev eth0 '
+                               'nexthop via 10.1.0.252 dev eth1 weight 3'))
+    assert not route.matches(Route('10.3.0.0/16 proto static metric 20 nexthop via 10.1.0.253 dev eth0 weight 2 '
+                                   'nexthop via 10.1.0.252 dev eth1 weight 3'))
+    assert not route.matches(Route('10.3.0.0/16 proto static metric 20 nexthop via 10.1.0.253 dev eth0 weight 1'))
+#---
+
+
+def test_nextHopKey():
+    assert NextHop('10.1.0.254', 'eth0') == NextHop('10.1.0.254', 'eth0', '1', ['dead'])
+    assert NextHop('10.1.0.254', 'eth0') != NextHop('10.1.0.254', 'eth1')
+    assert len(set([NextHop('10.1.0.254', 'eth0', 1), NextHop('10.1.0.254', 'eth0')])) == 1
+    # State flags from the kernel aren't rendered
+    assert str(NextHop('10.1.0.254', 'eth0', 2, ['onlink', 'linkdown'])) == 'via 10.1.0.254 dev eth0 weight 2 onlink'
+#---
+
+
+@pytest.mark.parametrize(('text', 'rendered'), [
+    ('id 1 via 10.1.0.254 dev eth0 scope link proto static onlink', 'id 1 via 10.1.0.254 dev eth0 onlink proto static'),
+    ('id 4 dev eth0 scope host', 'id 4 dev eth0'),
+    ('id 3 blackhole proto static', 'id 3 blackhole proto static'),
+    ('id 10 group 1,2/3 type mpath proto static', 'id 10 group 1,2/3 type mpath proto static'),
+    ('id 11 group 1/3', 'id 11 group 1/3')])
+def test_nexthopObjectRoundTrip(text, rendered):
+    nexthop_object = NexthopObject(text)
+    again = NexthopObject(str(nexthop_object))
+
+    # 'scope' is only printed by the kernel, 'ip nexthop add' doesn't take it
+    assert str(nexthop_object) == rendered
+    assert str(again) == rendered
+    for attribute in ('id', 'via', 'device', 'group', 'proto', 'type', 'flags'):
+        assert getattr(again, attribute) == getattr(nexthop_object, attribute)
+#---
+
+
+def test_nexthopGrammar():
+    grammar = routegrammar.NEXTHOP('id 10 group 1,2/3 type mpath proto static fdb foo'.split())
+
+    assert (grammar.id, grammar.group, grammar.type, grammar.proto) == ('10', '1,2/3', 'mpath', 'static')
+    assert grammar.FLAGS == ['fdb']
+    assert list(grammar.next_data) == ['foo']
+    with pytest.raises(NexthopError):
+        NexthopObject('via 10.1.0.254 dev eth0')
+    with pytest.raises(NexthopError):
+        NexthopObject(via = '10.1.0.254', gateway = '10.1.0.254')
+#---
+
+
+def test_groups():
+    assert nexthop.parseGroup('1,2/3') == [('1', '2'), ('3', None)]
+    assert nexthop.formatGroup([('1', '2'), (3, None)]) == '1,2/3'
+    assert str(NexthopObject(id = 10, group = [(1, 2), (3, None)])) == 'id 10 group 1,2/3'
+#---
+
+
+def test_nexthopsThroughTheSimulator(simulated):
+    simulated.addLink('eth1', up = True)
+    objects = [NexthopObject(id = 10, group = [('1', '2'), ('2', None)], type = 'mpath'),
+               NexthopObject(id = 1, via = '10.1.0.253', device = 'eth0'),
+               NexthopObject(id = 2, via = '10.1.0.254', device = 'eth0', proto = 'static')]
+    # Groups go in after their members
+    assert nexthop.applyNexthops(objects) == []
+
+    listed = nexthop.listNexthops()
+    assert sorted(listed) == ['1', '10', '2']
+    assert [str(listed[nexthop_id]) for nexthop_id in ('1', '2', '10')] == [str(objects[1]), str(objects[2]),
+                                                                           str(objects[0])]
+
+    table = RoutingTable('100', routes = [Route('10.4.0.0/16 nhid 10'), Route(MULTIPATH)])
+    table.apply()
+    live = RoutingTable('100')
+    live.parse()
+    assert [route.render() for route in live.routes] == [route.render() for route in table.routes]
+    assert table.apply(reconcile = True) == ([], [], [])
+
+    listed['1'].remove()
+    assert sorted(nexthop.listNexthops()) == ['10', '2']
+#---
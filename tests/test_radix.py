@@ -0,0 +1,195 @@
+#
+# $Id$
+#
+# NAME:         test_radix.py 
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Tests of the Patricia trie behind longest prefix match.
+#
+
+import random
+
+from .. import ipprefix
+from ..radix import RadixTree
+
+
+def tree(version, prefixes):
+    """
+    Builds a trie holding each prefix (in CIDR notation) as its own value.
+
+    """
+    radix_tree = RadixTree(version)
+    for prefix in prefixes:
+        version, address, length = ipprefix.parsePrefix(prefix)
+        radix_tree.insert(address, length, prefix)
+    return radix_tree
+#---
+
+
+def lookup(radix_tree, address):
+    match = radix_tree.lookup(ipprefix.parsePrefix(address)[1])
+    return match[2] if match else None
+#---
+
+
+def prefixes(found):
+    return [value for network, length, values in found for value in values]
+#---
+
+
+def test_longestPrefixMatch():
+    radix_tree = tree(4, ['10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24', '10.1.2.3/32', '192.168.0.0/16'])
+
+    assert lookup(radix_tree, '10.1.2.3') == ['10.1.2.3/32']
+    assert lookup(radix_tree, '10.1.2.4') == ['10.1.2.0/24']
+    assert lookup(radix_tree, '10.1.3.1') == ['10.1.0.0/16']
+    assert lookup(radix_tree, '10.2.0.1') == ['10.0.0.0/8']
+    assert lookup(radix_tree, '192.168.255.255') == ['192.168.0.0/16']
+    assert lookup(radix_tree, '11.0.0.1') is None
+#---
+
+
+def test_emptyTree():
+    radix_tree = RadixTree(4)
+
+    assert radix_tree.lookup(0) is None
+    assert radix_tree.covering(0, 0) == []
+    assert radix_tree.coveredBy(0, 0) == []
+    assert list(radix_tree) == []
+#---
+
+
+def test_defaultRoute():
+    radix_tree = tree(4, ['0.0.0.0/0', '10.0.0.0/8'])
+
+    assert lookup(radix_tree, '10.0.0.1') == ['10.0.0.0/8']
+    assert lookup(radix_tree, '172.16.0.1') == ['0.0.0.0/0']
+    assert lookup(radix_tree, '255.255.255.255') == ['0.0.0.0/0']
+
+    v6_tree = tree(6, ['::/0', '2001:db8::/32'])
+    assert lookup(v6_tree, '2001:db8::1') == ['2001:db8::/32']
+    assert lookup(v6_tree, 'fe80::1') == ['::/0']
+#---
+
+
+def test_hostBitsIgnored():
+    radix_tree = RadixTree(4)
+    radix_tree.insert(ipprefix.parsePrefix('10.1.2.3')[1], 16, 'route')
+
+    assert radix_tree.lookup(ipprefix.parsePrefix('10.1.200.1')[1]) == (ipprefix.parsePrefix('10.1.0.0')[1], 16,
+                                                                        ['route'])
+#---
+
+
+def test_valuesShareAPrefix():
+    radix_tree = RadixTree(4)
+    address = ipprefix.parsePrefix('10.0.0.0')[1]
+    radix_tree.insert(address, 8, 'metric 100')
+    radix_tree.insert(address, 8, 'metric 200')
+
+    assert radix_tree.lookup(address + 1)[2] == ['metric 100', 'metric 200']
+    assert radix_tree.remove(address, 8, 'metric 100')
+    assert radix_tree.lookup(address + 1)[2] == ['metric 200']
+#---
+
+
+def test_removeAndReinsert():
+    radix_tree = tree(4, ['10.0.0.0/8', '10.1.0.0/16', '10.2.0.0/16'])
+    address = ipprefix.parsePrefix('10.1.0.0')[1]
+
+    assert radix_tree.remove(address, 16, '10.1.0.0/16')
+    assert lookup(radix_tree, '10.1.0.1') == ['10.0.0.0/8']
+    assert lookup(radix_tree, '10.2.0.1') == ['10.2.0.0/16']
+    # Gone already, or never there
+    assert not radix_tree.remove(address, 16, '10.1.0.0/16')
+    assert not radix_tree.remove(address, 24, '10.1.0.0/24')
+
+    radix_tree.insert(address, 16, '10.1.0.0/16')
+    assert lookup(radix_tree, '10.1.0.1') == ['10.1.0.0/16']
+    assert prefixes(radix_tree) == ['10.0.0.0/8', '10.1.0.0/16', '10.2.0.0/16']
+#---
+
+
+def test_removePrunesBranchNodes():
+    radix_tree = tree(4, ['10.1.0.0/16', '10.2.0.0/16'])
+    # The two prefixes only meet at a node without values
+    assert radix_tree.root.values == [] and radix_tree.root.length < 16
+
+    for prefix in ['10.1.0.0/16', '10.2.0.0/16']:
+        version, address, length = ipprefix.parsePrefix(prefix)
+        assert radix_tree.remove(address, length, prefix)
+
+    assert radix_tree.root is None
+    assert lookup(radix_tree, '10.1.0.1') is None
+#---
+
+
+def test_versionsAreSeparate():
+    v4_tree = tree(4, ['0.0.0.0/0'])
+    v6_tree = tree(6, ['2001:db8::/32'])
+
+    # ::a01:203 is 10.1.2.3 as a 128 bit integer, which only the v4 trie should take
+    assert lookup(v4_tree, '10.1.2.3') == ['0.0.0.0/0']
+    assert lookup(v6_tree, '::a01:203') is None
+    assert lookup(v6_tree, '2001:db8:ffff::1') == ['2001:db8::/32']
+#---
+
+
+def test_coveringAndCoveredBy():
+    radix_tree = tree(4, ['0.0.0.0/0', '10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24', '10.1.3.0/24', '10.2.0.0/16',
+                          '192.168.0.0/16'])
+    version, address, length = ipprefix.parsePrefix('10.1.2.0/24')
+
+    assert prefixes(radix_tree.covering(address, length)) == ['0.0.0.0/0', '10.0.0.0/8', '10.1.0.0/16',
+                                                              '10.1.2.0/24']
+    assert prefixes(radix_tree.covering(address, 28)) == ['0.0.0.0/0', '10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24']
+    assert prefixes(radix_tree.coveredBy(address, 16)) == ['10.1.0.0/16', '10.1.2.0/24', '10.1.3.0/24']
+    assert prefixes(radix_tree.coveredBy(address, 8)) == ['10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24', '10.1.3.0/24',
+                                                          '10.2.0.0/16']
+    assert prefixes(radix_tree.coveredBy(address, 24)) == ['10.1.2.0/24']
+    # A prefix with no routes of its own, between two that have them
+    assert prefixes(radix_tree.coveredBy(address, 12)) == ['10.1.0.0/16', '10.1.2.0/24', '10.1.3.0/24',
+                                                           '10.2.0.0/16']
+    assert radix_tree.coveredBy(address, 28) == []
+#---
+
+
+def test_matchesLinearScan():
+    shuffle = random.Random(7)
+    entries = set()
+    while len(entries) < 300:
+        length = shuffle.randint(0, 32)
+        entries.add((shuffle.getrandbits(32) & ipprefix.networkMask(4, length), length))
+    entries = list(entries)
+
+    radix_tree = RadixTree(4)
+    for address, length in entries:
+        radix_tree.insert(address, length, (address, length))
+    # Take a third out again, so removal gets the same check
+    for address, length in entries[:100]:
+        assert radix_tree.remove(address, length, (address, length))
+    entries = entries[100:]
+
+    for _ in range(2000):
+        address = shuffle.getrandbits(32)
+        matching = [entry for entry in entries if address & ipprefix.networkMask(4, entry[1]) == entry[0]]
+        expected = max(matching, key = lambda entry: entry[1]) if matching else None
+
+        match = radix_tree.lookup(address)
+        assert (match[2][0] if match else None) == expected
+#---
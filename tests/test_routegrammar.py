@@ -0,0 +1,158 @@
+#
+# $Id$
+#
+# NAME:         test_routegrammar.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Tests of the route grammar: parsing, rendering and round trips through the simulated backend.
+#
+
+import threading
+
+import pytest
+
+from .. import routegrammar
+from ..route import Route
+from ..routingtable import RoutingTable
+
+# Values to give keywords in the round trip tests, where a plain number won't do
+VALUES = {'tos': '0x10', 'table': '100', 'proto': 'static', 'scope': 'link', 'via': '10.1.0.254', 'dev': 'eth1',
+          'src': '10.1.0.1', 'congctl': 'cubic', 'features': 'ecn', 'realms': '1/2', 'from': '10.2.0.0/16',
+          'to': '10.3.0.0/16', 'iif': 'eth1', 'iifname': 'eth1', 'oif': 'eth1', 'oifname': 'eth1',
+          'uidrange': '1000-1999', 'ipproto': 'tcp', 'group': '1,2/3', 'type': 'mpath'}
+
+# Every keyword of every grammar node, with what has to come before it for the node to parse
+KEYWORDS = [(node, prefix, keyword)
+            for node, prefix in ((routegrammar.NODE_SPEC, ['10.2.0.0/16']), (routegrammar.NH, []),
+                                 (routegrammar.OPTIONS, []), (routegrammar.INFO_SPEC, []),
+                                 (routegrammar.NEXTHOP, ['id', '1']), (routegrammar.RULE, []))
+            for keyword in node.options if prefix[:1] != [keyword]]
+
+# The keywords a Route keeps (a lone 'weight' is only meaningful in a multipath 'nexthop' clause)
+ROUTE_KEYWORDS = [keyword for keyword in routegrammar.NODE_SPEC.options + routegrammar.NH.options +
+                  routegrammar.INFO_SPEC.options + routegrammar.OPTIONS.options if keyword != 'weight']
+
+
+def test_parseKernelRoute():
+    route = Route('10.2.0.0/16 via 10.1.0.254 dev eth0 proto static metric 100 src 10.1.0.1 mtu 1400 linkdown')
+
+    assert (route.network, route.nexthop, route.device, route.proto, route.metric, route.source) == \
+        ('10.2.0.0/16', '10.1.0.254', 'eth0', 'static', '100', '10.1.0.1')
+    assert route.options == ['mtu', '1400']
+    assert route.unparsed == ['linkdown']
+    assert Route(route.render()).render() == route.render()
+#---
+
+
+@pytest.mark.parametrize('metric', routegrammar.OPTIONS.lockable)
+def test_lockedMetric(metric):
+    route = Route('10.2.0.0/16 dev eth0 %s lock 20 realm 10' %metric)
+
+    assert dict(zip(route.options[::2], route.options[1::2])) == {metric: 'lock 20', 'realm': '10'}
+    assert route.unparsed == []
+    assert "%s lock 20" %metric in route.render()
+    assert Route(route.render()).options == route.options
+    assert Route(route.render()).matches(route)
+    assert not Route('10.2.0.0/16 dev eth0 %s 20' %metric).matches(route)
+#---
+
+
+def test_lockWithoutValue():
+    route = Route('10.2.0.0/16 dev eth0 mtu lock')
+
+    assert route.options == []
+    assert route.unparsed == ['mtu', 'lock']
+#---
+
+
+def test_realm():
+    assert Route('10.2.0.0/16 dev eth0 realm 10').options == ['realm', '10']
+    assert Route('10.2.0.0/16 dev eth0 realms 1/2').options == ['realms', '1/2']
+    assert Route('10.2.0.0/16 dev eth0 realm 10').unparsed == []
+#---
+
+
+@pytest.mark.parametrize(('node', 'prefix', 'keyword'), KEYWORDS,
+                         ids = ["%s-%s" %(node.__name__, keyword) for node, prefix, keyword in KEYWORDS])
+def test_nodeKeyword(node, prefix, keyword):
+    value = VALUES.get(keyword, '20')
+    parsed = node(prefix + [keyword, value, 'leftover'])
+
+    # Nodes only have their slots, and every keyword still has one to go in
+    assert not hasattr(parsed, '__dict__')
+    assert parsed[getattr(node, 'aliases', {}).get(keyword, keyword)] == value
+    assert parsed.raw_data.endswith("%s %s" %(keyword, value))
+    assert tuple(parsed.next_data) == ('leftover',)
+#---
+
+
+@pytest.mark.parametrize('keyword', ROUTE_KEYWORDS)
+def test_routeKeywordRoundTrip(keyword):
+    device = '' if keyword in ('dev', 'nhid') else ' dev eth0'
+    route = Route('10.2.0.0/16%s %s %s' %(device, keyword, VALUES.get(keyword, '20')))
+    again = Route(route.render())
+
+    assert "%s %s" %(keyword, VALUES.get(keyword, '20')) in route.render()
+    assert again.render() == route.render()
+    assert route.unparsed == again.unparsed == []
+    assert again.matches(route) and route.matches(again)
+#---
+
+
+def test_treesAreNotShared():
+    first = routegrammar.ROUTE('10.2.0.0/16 via 10.1.0.254 dev eth0 mtu 1400'.split())
+    second = routegrammar.ROUTE('10.3.0.0/16 via 10.1.0.253 dev eth1 advmss 1360'.split())
+
+    # Parsing the second route mustn't change the first one's nodes
+    assert (first['NH'].via, first['NH'].dev, first['OPTIONS'].mtu) == ('10.1.0.254', 'eth0', '1400')
+    assert (second['NH'].via, second['NH'].dev, second['OPTIONS'].mtu) == ('10.1.0.253', 'eth1', None)
+    assert first['NH'] is not second['NH']
+#---
+
+
+def test_concurrentParsing():
+    routes = ['10.%d.0.0/16 proto static metric %d via 10.1.0.%d dev eth%d mtu %d' %(index, index, index, index,
+                                                                                     1000 + index)
+              for index in range(8)]
+    mixups = []
+    start = threading.Event()
+
+    def parse(text):
+        start.wait()
+        for _ in range(300):
+            route = Route(text)
+            if route.render() != text:
+                mixups.append((text, route.render()))
+
+    threads = [threading.Thread(target = parse, args = (text,)) for text in routes]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+
+    assert mixups == []
+#---
+
+
+def test_lockedMetricReconciles(simulated):
+    RoutingTable('100', routes = [Route('10.2.0.0/16 dev eth0 mtu lock 1400')]).apply()
+
+    table = RoutingTable('100', routes = [Route('10.2.0.0/16 dev eth0 mtu lock 1400')])
+    assert table.apply(reconcile = True) == ([], [], [])
+#---
@@ -0,0 +1,111 @@
+#
+# $Id$
+#
+# NAME:         test_routerule.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Tests of rule parsing, of RuleSet syncing against the simulated backend and of offline evaluation.
+#
+
+import pytest
+
+from ..routerule import Packet, RouteRule, RouteRuleError, RuleSet, RuleBatchError, listRules
+
+
+def liveRules(version = 4):
+    return [str(rule) for rule in listRules(version) if int(rule.priority) not in RuleSet.keep_priorities]
+#---
+
+
+def test_parseAndRender():
+    rule = RouteRule('from 10.0.0.0/8 fwmark 0x1/0xff iif eth0 uidrange 1000-1999 lookup 100 pref 100')
+
+    assert (rule.source, rule.fwmark, rule.iif, rule.uidrange, rule.table, rule.priority) == \
+        ('10.0.0.0/8', '0x1/0xff', 'eth0', '1000-1999', '100', '100')
+    assert RouteRule(str(rule)).matches(rule)
+    assert RouteRule('from 2001:db8::/32 lookup 100 pref 100').version() == 6
+#---
+
+
+def test_diff(simulated):
+    RuleSet([RouteRule('from 10.1.0.0/16 lookup 100 pref 100'), RouteRule('from 10.2.0.0/16 lookup 100 pref 101'),
+             RouteRule('from 10.3.0.0/16 lookup 100 pref 102')]).apply()
+
+    rules = RuleSet([RouteRule('from 10.1.0.0/16 lookup 100 pref 100'),
+                     RouteRule('from 10.2.0.0/16 lookup 200 pref 101'),
+                     RouteRule('from 10.4.0.0/16 lookup 100 pref 103'),
+                     RouteRule('from 2001:db8::/32 lookup 100 pref 100')])
+    adds, deletes, replaces = rules.diff()
+
+    assert [str(rule) for rule in adds] == ['from 10.4.0.0/16 pref 103 table 100',
+                                            'from 2001:db8::/32 pref 100 table 100']
+    assert [str(rule) for rule in deletes] == ['from 10.3.0.0/16 pref 102 table 100']
+    assert [(str(live_rule), str(rule)) for live_rule, rule in replaces] == \
+        [('from 10.2.0.0/16 pref 101 table 100', 'from 10.2.0.0/16 pref 101 table 200')]
+#---
+
+
+def test_reconcile(simulated):
+    RuleSet([RouteRule('from 10.1.0.0/16 lookup 100 pref 100'),
+             RouteRule('from 10.3.0.0/16 lookup 100 pref 102')]).apply()
+
+    rules = RuleSet([RouteRule('from 10.1.0.0/16 lookup 200 pref 100'),
+                     RouteRule('from 10.4.0.0/16 lookup 100 pref 103'),
+                     RouteRule('from 2001:db8::/32 lookup 100 pref 100')])
+    rules.apply(reconcile = True)
+
+    assert liveRules() == ['from 10.1.0.0/16 pref 100 table 200', 'from 10.4.0.0/16 pref 103 table 100']
+    assert liveRules(6) == ['from 2001:db8::/32 pref 100 table 100']
+    # The kernel's own rules stay
+    assert [rule.priority for rule in listRules()] == ['0', '100', '103', '32766', '32767']
+    assert rules.diff() == ([], [], [])
+#---
+
+
+def test_diffNeedsPriority(simulated):
+    with pytest.raises(RouteRuleError) as error:
+        RuleSet([RouteRule('from 10.1.0.0/16 lookup 100')]).diff()
+    assert 'no priority' in str(error.value)
+#---
+
+
+def test_applyReportsFailures(simulated):
+    RouteRule('from 10.1.0.0/16 lookup 100 pref 100').apply()
+
+    rules = RuleSet([RouteRule('from 10.1.0.0/16 lookup 100 pref 100'),
+                     RouteRule('from 10.2.0.0/16 lookup 100 pref 101')])
+    with pytest.raises(RuleBatchError) as error:
+        rules.apply()
+
+    assert [(str(rule), text) for rule, text in error.value.failures] == \
+        [('from 10.1.0.0/16 pref 100 table 100', 'RTNETLINK answers: File exists')]
+    assert liveRules() == ['from 10.1.0.0/16 pref 100 table 100', 'from 10.2.0.0/16 pref 101 table 100']
+#---
+
+
+def test_evaluate():
+    rules = RuleSet([RouteRule('from 10.1.0.0/16 lookup 100 pref 100'),
+                     RouteRule('fwmark 0x1/0xff goto 300 pref 200'),
+                     RouteRule('from all lookup 200 pref 250'),
+                     RouteRule('from 10.0.0.0/8 lookup 300 pref 300')])
+
+    hits = rules.evaluate([Packet('10.1.2.3', '192.0.2.9'), Packet('10.2.0.1', '192.0.2.9', fwmark = 0x101),
+                           Packet('10.2.0.1', '192.0.2.9'), Packet('192.0.2.1', '192.0.2.9', fwmark = 1)])
+
+    assert [rule.table if rule else None for rule in hits] == ['100', '300', '200', None]
+#---
@@ -0,0 +1,188 @@
+#
+# $Id$
+#
+# NAME:         test_routestore.py 
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Tests of the column store for large routing tables.
+#
+
+import pytest
+
+from .. import ipprefix
+from .. import routestore
+from ..route import Route
+from ..routestore import Interner, RouteStore, RouteStoreError
+
+ROUTES = ['10.2.0.0/16 via 10.1.0.254 dev eth0 proto bgp metric 20',
+          '10.2.3.0/24 dev eth1 proto static scope link src 10.1.0.1',
+          'default via 10.1.0.254 dev eth0',
+          'blackhole 10.9.0.0/16 table 100',
+          '10.3.0.0/16 proto static mtu lock 1400 advmss 1360\n'
+          '\tnexthop via 10.1.0.253 dev eth0 weight 1\n\tnexthop via 10.1.0.252 dev eth1 weight 3 onlink',
+          '10.4.0.0/16 nhid 12 proto static',
+          '2001:db8::/32 via fe80::1 dev eth0 proto bgp metric 1024 pref medium',
+          '2001:db8:1::/48 dev eth1 proto static metric 512',
+          'default dev eth0 metric 1024']
+
+
+def storedRoutes():
+    routes = [Route(route) for route in ROUTES]
+    # A device-only default only knows its family from the listing it was read from
+    routes[-1].family = ipprefix.IP_V6
+    return routes
+#---
+
+
+def test_roundTrip():
+    routes = storedRoutes()
+    store = RouteStore(routes)
+
+    assert len(store) == len(routes)
+    assert store.count(ipprefix.IP_V4) == 6 and store.count(ipprefix.IP_V6) == 3
+    # IPv4 rows first, then IPv6, each in the order they went in
+    for stored, route in zip(store, routes):
+        assert str(stored) == str(route)
+        assert stored.key() == route.key()
+        assert stored.version() == route.version()
+    assert [str(route) for route in store[-2:]] == [str(route) for route in routes[-2:]]
+#---
+
+
+def test_popAndRemove():
+    routes = storedRoutes()
+    store = RouteStore(routes)
+
+    assert str(store.pop(0)) == str(routes[0])
+    store.remove(Route(ROUTES[6]))
+    assert [str(route) for route in store] == [str(route) for route in routes[1:6] + routes[7:]]
+
+    with pytest.raises(ValueError):
+        store.remove(Route('10.8.0.0/16 dev eth0'))
+    with pytest.raises(IndexError):
+        store[len(store)]
+#---
+
+
+def test_appendRejects():
+    store = RouteStore()
+
+    route = Route('10.2.0.0/16 dev eth0')
+    route.network = '10.2.0.0/33'
+    with pytest.raises(RouteStoreError):
+        store.append(route)
+    # A metric past the column's range leaves every column the same length
+    with pytest.raises(RouteStoreError):
+        store.append(Route('10.2.0.0/16 dev eth0 metric %d' %(2 ** 64)))
+    assert len(set(len(column) for column in store.columns[ipprefix.IP_V4].values())) == 1
+    assert len(store) == 0
+#---
+
+
+def test_interner():
+    interner = Interner()
+
+    assert interner.intern(None) == 0
+    assert interner.intern('eth0') == 1
+    assert interner.intern('eth1') == 2
+    assert interner.intern('eth0') == 1
+    assert interner.values == [None, 'eth0', 'eth1']
+    assert len(interner) == 3
+#---
+
+
+def test_sharedStrings():
+    store = RouteStore(Route('10.%d.0.0/16 dev eth0 proto bgp' %octet) for octet in range(200))
+
+    # One copy of each string however many routes use it
+    assert store.strings['device'].values == [None, 'eth0']
+    assert store.strings['proto'].values == [None, 'bgp']
+    assert store.strings['extra'].values == [None]
+#---
+
+
+def test_memoryUsage():
+    store = RouteStore()
+    assert store.memoryUsage() == 0
+
+    store.append(Route('10.2.0.0/16 dev eth0'))
+    v4_row = store.memoryUsage()
+    store.append(Route('2001:db8::/32 dev eth0'))
+    v6_row = store.memoryUsage() - v4_row
+
+    # The network takes 4 bytes in IPv4 and 16 in IPv6, the other columns are the same
+    assert v6_row - v4_row == 12
+    assert v4_row == sum(array_column.itemsize for array_column in store.columns[ipprefix.IP_V4].values())
+    store.extend([Route('10.%d.0.0/16 dev eth0' %octet) for octet in range(3, 13)])
+    assert store.memoryUsage() == 11 * v4_row + v6_row
+#---
+
+
+SELECTIONS = [(ipprefix.IP_V4, None, {}),
+              (ipprefix.IP_V4, None, {'device': 'eth0'}),
+              (ipprefix.IP_V4, None, {'proto': 'static'}),
+              (ipprefix.IP_V4, None, {'proto': 'static', 'device': 'eth1'}),
+              (ipprefix.IP_V4, None, {'metric': 20}),
+              (ipprefix.IP_V4, None, {'metric': None}),
+              (ipprefix.IP_V4, None, {'device': 'eth9'}),
+              (ipprefix.IP_V4, '10.2.0.0/16', {}),
+              (ipprefix.IP_V4, '10.0.0.0/8', {'proto': 'static'}),
+              (ipprefix.IP_V4, '0.0.0.0/0', {'length': 0}),
+              (ipprefix.IP_V4, '2001:db8::/32', {}),
+              (ipprefix.IP_V6, None, {}),
+              (ipprefix.IP_V6, None, {'proto': 'bgp'}),
+              (ipprefix.IP_V6, '2001:db8::/32', {}),
+              (ipprefix.IP_V6, '2001:db8:1::/48', {'device': 'eth1'}),
+              (ipprefix.IP_V6, '2001:db8:0:8000::/49', {}),
+              (ipprefix.IP_V6, '::/0', {'length': 0})]
+
+EXPECTED = [[0, 1, 2, 3, 4, 5], [0, 2], [1, 4, 5], [1], [0], [1, 2, 3, 4, 5], [],
+            [0, 1], [1, 4, 5], [2], [],
+            [6, 7, 8], [6], [6, 7], [7], [], [8]]
+
+
+@pytest.mark.parametrize(('selection', 'expected'), list(zip(SELECTIONS, EXPECTED)))
+def test_select(monkeypatch, selection, expected):
+    store = RouteStore(storedRoutes())
+    version, within, criteria = selection
+
+    # The plain loops first, then the NumPy filter when there is one; both must find the same rows
+    with monkeypatch.context() as patch:
+        patch.setattr(routestore, 'numpy', None)
+        assert store.select(version, within, **criteria) == expected
+    if routestore.numpy is not None:
+        assert store.select(version, within, **criteria) == expected
+#---
+
+
+def test_selectUnknownColumn():
+    with pytest.raises(RouteStoreError):
+        RouteStore(storedRoutes()).select(ipprefix.IP_V4, nexthops = 2)
+#---
+
+
+@pytest.mark.skipif(routestore.numpy is None, reason = "needs NumPy")
+def test_columnSharesMemory():
+    store = RouteStore(storedRoutes())
+    lengths = store.column(ipprefix.IP_V4, 'length')
+
+    assert list(lengths) == [16, 24, 0, 16, 16, 16]
+    store.columns[ipprefix.IP_V4]['length'][0] = 17
+    assert lengths[0] == 17
+    assert len(RouteStore().column(ipprefix.IP_V6, 'network_hi')) == 0
+#---
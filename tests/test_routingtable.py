@@ -0,0 +1,456 @@
+#
+# $Id$
+#
+# NAME:         test_routingtable.py
+#
+# AUTHOR:       Nick Whalen <nickw@mindstorm-networks.net>
+# COPYRIGHT:    2012 by Nick Whalen
+# LICENSE:
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+# DESCRIPTION:
+#   Tests of class:routingtable.RoutingTable against the simulated kernel.
+#
+
+import array
+
+import pytest
+
+from .. import ipprefix
+from .. import routerule
+from .. import simulator
+from ..route import Route
+from .. import routingtable
+from ..routingtable import RoutingTable, BatchError
+
+
+def liveRoutes(simulated, table, version = 4):
+    """
+    Lists the routes in a simulated table, as 'ip' prints them.
+
+    """
+    return simulated.ip("-%d route show table %s" %(version, table))['stdout'].splitlines()
+#---
+
+
+def test_applyAndRemove(simulated):
+    table = RoutingTable('100', routes = [Route('10.2.0.0/16 via 10.1.0.254'), Route('2001:db8::/32 dev eth0')])
+    table.apply()
+
+    assert liveRoutes(simulated, 100) == ['10.2.0.0/16 via 10.1.0.254']
+    assert liveRoutes(simulated, 100, 6) == ['2001:db8::/32 dev eth0']
+
+    table.remove()
+    assert liveRoutes(simulated, 100) == []
+#---
+
+
+def test_applyChunks(simulated):
+    table = RoutingTable('100', routes = [Route('10.%d.0.0/16 dev eth0' %octet) for octet in range(2, 12)])
+    table.batch_size = 3
+    table.apply()
+
+    assert len(liveRoutes(simulated, 100)) == 10
+#---
+
+
+def test_applyReportsFailures(simulated):
+    routes = [Route('10.2.0.0/16 dev eth0'), Route('10.3.0.0/16 dev eth9'), Route('10.4.0.0/16 dev eth0')]
+    table = RoutingTable('100', routes = routes)
+
+    with pytest.raises(BatchError) as error:
+        table.apply()
+
+    assert error.value.failures == [(routes[1], simulator.NO_DEVICE_TEXT %'eth9')]
+    # The routes around the failed one still went in
+    assert len(liveRoutes(simulated, 100)) == 2
+#---
+
+
+def test_removeReportsFailures(simulated):
+    routes = [Route('10.2.0.0/16 dev eth0'), Route('10.3.0.0/16 dev eth0')]
+    RoutingTable('100', routes = routes[:1]).apply()
+
+    with pytest.raises(BatchError) as error:
+        RoutingTable('100', routes = routes).remove()
+
+    assert error.value.failures == [(routes[1], simulator.NO_ROUTE_TEXT)]
+    assert liveRoutes(simulated, 100) == []
+#---
+
+
+def test_parseReadsBothVersions(simulated):
+    RoutingTable('100', routes = [Route('10.2.0.0/16 dev eth0'), Route('2001:db8::/32 dev eth0')]).apply()
+
+    table = RoutingTable('100')
+    table.parse()
+    assert sorted(route.network for route in table.routes) == ['10.2.0.0/16', '2001:db8::/32']
+
+    table.parse(compact = True)
+    assert len(table.routes) == 2
+#---
+
+
+def test_reconcile(simulated):
+    RoutingTable('100', routes = [Route('10.2.0.0/16 dev eth0'), Route('10.3.0.0/16 dev eth0'),
+                                  Route('2001:db8::/32 dev eth0')]).apply()
+
+    table = RoutingTable('100', routes = [Route('10.2.0.0/16 via 10.1.0.254'), Route('10.4.0.0/16 dev eth0'),
+                                          Route('2001:db8::/32 dev eth0')])
+    adds, deletes, replaces = table.apply(reconcile = True)
+
+    assert [route.network for route in adds] == ['10.4.0.0/16']
+    assert [route.network for route in deletes] == ['10.3.0.0/16']
+    assert [route.network for route in replaces] == ['10.2.0.0/16']
+    assert liveRoutes(simulated, 100) == ['10.2.0.0/16 via 10.1.0.254', '10.4.0.0/16 dev eth0']
+    # Nothing left to do
+    assert table.apply(reconcile = True) == ([], [], [])
+#---
+
+
+def test_parseThenReconcileKeepsEveryRoute(simulated):
+    RoutingTable('100', routes = [Route('10.1.0.0/16 dev eth0'), Route('2001:db8::/32 dev eth0')]).apply()
+
+    table = RoutingTable('100')
+    table.parse()
+    assert table.apply(reconcile = True) == ([], [], [])
+
+    assert liveRoutes(simulated, 100) == ['10.1.0.0/16 dev eth0']
+    assert liveRoutes(simulated, 100, 6) == ['2001:db8::/32 dev eth0']
+#---
+
+
+def test_deviceOnlyDefaultKeepsItsFamily(simulated):
+    # Nothing in 'default dev eth0' says which family it's in, only the listing it came from
+    simulated.ip('-6 route add default dev eth0 table 100')
+    simulated.ip('route add 10.2.0.0/16 dev eth0 table 100')
+
+    table = RoutingTable('100')
+    table.parse()
+    assert sorted((route.network, route.version()) for route in table.routes) == [('10.2.0.0/16', 4),
+                                                                                 ('default', 6)]
+    assert table.apply(reconcile = True) == ([], [], [])
+    assert liveRoutes(simulated, 100, 6) == ['default dev eth0']
+
+    table.remove()
+    assert liveRoutes(simulated, 100) == []
+    assert liveRoutes(simulated, 100, 6) == []
+
+    # Applying puts it back in the IPv6 table, not the IPv4 one
+    table.apply()
+    assert liveRoutes(simulated, 100) == ['10.2.0.0/16 dev eth0']
+    assert liveRoutes(simulated, 100, 6) == ['default dev eth0']
+#---
+
+
+def test_reconcileKeepsKernelRoutes(simulated):
+    table = RoutingTable('main', routes = [Route('10.2.0.0/16 dev eth0')])
+    table.apply(reconcile = True)
+
+    assert [line for line in liveRoutes(simulated, 'main') if line.startswith('10.1.0.0/24 proto kernel')]
+#---
+
+
+def lookupTable():
+    return RoutingTable('100', routes = [Route('default via 10.1.0.254'), Route('10.0.0.0/8 via 10.1.0.253'),
+                                         Route('10.2.0.0/16 dev eth0 metric 200'), Route('10.2.0.0/16 dev eth1'),
+                                         Route('10.2.3.0/24 dev eth0'), Route('2001:db8::/32 dev eth0'),
+                                         Route('2001:db8:1::/48 dev eth1')])
+#---
+
+
+def test_lookup():
+    table = lookupTable()
+
+    assert table.lookup('10.2.3.4').network == '10.2.3.0/24'
+    # Two routes to 10.2.0.0/16: the kernel picks the lower metric
+    assert str(table.lookup('10.2.4.1')) == '10.2.0.0/16 dev eth1'
+    assert table.lookup('10.9.0.1').network == '10.0.0.0/8'
+    assert table.lookup('192.168.0.1').network == 'default'
+    assert table.lookup('2001:db8:1::1').network == '2001:db8:1::/48'
+    assert table.lookup('2001:db8:2::1').network == '2001:db8::/32'
+    # The IPv4 default doesn't answer for IPv6
+    assert table.lookup('2001:db9::1') is None
+#---
+
+
+def test_lookupMany():
+    table = lookupTable()
+    addresses = ['10.2.3.4', '10.9.0.1', '2001:db8:1::1', '2001:db9::1']
+
+    assert table.lookupMany(addresses) == [table.lookup(address) for address in addresses]
+    integers = [ipprefix.parsePrefix(address)[1] for address in ['10.2.3.4', '192.168.0.1']]
+    assert [route.network for route in table.lookupMany(array.array('L', integers))] == ['10.2.3.0/24', 'default']
+    # Integers are taken as IPv4 unless told otherwise
+    assert table.lookupMany([integers[0]], version = 6) == [None]
+#---
+
+
+def test_lookupFollowsAddAndRemove():
+    table = lookupTable()
+    assert table.lookup('10.2.3.4').network == '10.2.3.0/24'
+
+    more_specific = table.lookup('10.2.3.4')
+    table.removeRoute(more_specific)
+    assert str(table.lookup('10.2.3.4')) == '10.2.0.0/16 dev eth1'
+
+    table.addRoute(more_specific)
+    assert table.lookup('10.2.3.4') is more_specific
+
+    table.routes = [Route('10.2.0.0/16 dev eth0')]
+    table.index(rebuild = True)
+    assert table.lookup('10.9.0.1') is None
+#---
+
+
+def test_covering():
+    table = lookupTable()
+
+    assert [route.network for route in table.covering('10.2.3.0/24')] == ['default', '10.0.0.0/8', '10.2.0.0/16',
+                                                                          '10.2.0.0/16', '10.2.3.0/24']
+    assert [route.network for route in table.covering('10.2.3.128/25')] == ['default', '10.0.0.0/8', '10.2.0.0/16',
+                                                                            '10.2.0.0/16', '10.2.3.0/24']
+    assert [route.network for route in table.covering('2001:db8:1::/64')] == ['2001:db8::/32', '2001:db8:1::/48']
+#---
+
+
+def test_coveredBy():
+    table = lookupTable()
+
+    assert [route.network for route in table.coveredBy('10.0.0.0/8')] == ['10.0.0.0/8', '10.2.0.0/16',
+                                                                          '10.2.0.0/16', '10.2.3.0/24']
+    assert [route.network for route in table.coveredBy('10.2.0.0/16')] == ['10.2.0.0/16', '10.2.0.0/16',
+                                                                           '10.2.3.0/24']
+    assert [route.network for route in table.coveredBy('10.3.0.0/16')] == []
+    assert len(table.coveredBy('0.0.0.0/0')) == 5
+    assert [route.network for route in table.coveredBy('::/0')] == ['2001:db8::/32', '2001:db8:1::/48']
+#---
+
+
+def test_joinEntries():
+    lines = ['10.2.0.0/16 proto static\n', '\tnexthop via 10.1.0.253 dev eth0 weight 1\n',
+             '\tnexthop via 10.1.0.254 dev eth0 weight 1\n', '10.3.0.0/16 dev eth0\n']
+
+    assert list(routingtable._joinEntries(lines)) == [
+        '10.2.0.0/16 proto static nexthop via 10.1.0.253 dev eth0 weight 1 nexthop via 10.1.0.254 dev eth0 weight 1',
+        '10.3.0.0/16 dev eth0']
+#---
+
+
+def test_incrementalParse(simulated):
+    simulated.ip('route add 10.2.0.0/16 dev eth0 table 100')
+    simulated.ip('route add 2001:db8::/32 dev eth0 table 100')
+    table = RoutingTable('100')
+
+    added, removed, unchanged = table.parse(incremental = True)
+    assert sorted(route.network for route in added) == ['10.2.0.0/16', '2001:db8::/32']
+    assert (removed, unchanged) == ([], [])
+
+    simulated.ip('route del 10.2.0.0/16 table 100')
+    simulated.ip('-6 route add 2001:db9::/32 dev eth0 table 100')
+    added, removed, unchanged = table.parse(incremental = True)
+    assert [route.network for route in added] == ['2001:db9::/32']
+    assert [route.network for route in removed] == ['10.2.0.0/16']
+    assert [route.network for route in unchanged] == ['2001:db8::/32']
+    assert sorted(route.network for route in table.routes) == ['2001:db8::/32', '2001:db9::/32']
+#---
+
+
+def test_incrementalParseKeepsIndexInStep(simulated):
+    simulated.ip('route add 10.2.0.0/16 dev eth0 table 100')
+    table = RoutingTable('100')
+    table.parse(incremental = True)
+    assert table.lookup('10.2.3.4').network == '10.2.0.0/16'
+
+    simulated.ip('route add 10.2.3.0/24 dev eth0 table 100')
+    table.parse(incremental = True)
+    assert table.lookup('10.2.3.4').network == '10.2.3.0/24'
+#---
+
+
+def test_incrementalParseRejectsCompact(simulated):
+    with pytest.raises(routingtable.RoutingTableError):
+        RoutingTable('100').parse(compact = True, incremental = True)
+#---
+
+
+def test_swapInPlace(simulated):
+    RoutingTable('100', routes = [Route('10.2.0.0/16 dev eth0'), Route('10.3.0.0/16 dev eth0')]).apply()
+
+    RoutingTable('100', routes = [Route('10.2.0.0/16 via 10.1.0.254'), Route('10.4.0.0/16 dev eth0')]).swap()
+    assert liveRoutes(simulated, 100) == ['10.2.0.0/16 via 10.1.0.254', '10.4.0.0/16 dev eth0']
+#---
+
+
+def test_swapInPlaceRollsBack(simulated):
+    RoutingTable('100', routes = [Route('10.2.0.0/16 dev eth0'), Route('10.3.0.0/16 dev eth0')]).apply()
+    before = liveRoutes(simulated, 100)
+
+    table = RoutingTable('100', routes = [Route('10.2.0.0/16 via 10.1.0.254'), Route('10.4.0.0/16 dev eth0'),
+                                          Route('10.5.0.0/16 dev eth9')])
+    with pytest.raises(BatchError) as error:
+        table.apply(atomic = True)
+
+    assert [route.network for route, text in error.value.failures] == ['10.5.0.0/16']
+    assert 'rolled back' in str(error.value)
+    assert liveRoutes(simulated, 100) == before
+#---
+
+
+def test_swapThroughScratchKeepsTableId(simulated):
+    RoutingTable('100', routes = [Route('10.2.0.0/16 dev eth0'), Route('2001:db8::/32 dev eth0')]).apply()
+    rules = routerule.RuleSet([routerule.RouteRule(priority = 100, source = '10.9.0.0/16', table = '100'),
+                               routerule.RouteRule(priority = 101, source = '10.8.0.0/16', table = '100'),
+                               routerule.RouteRule(priority = 100, source = '2001:db9::/32', table = '100')])
+    rules.apply()
+
+    table = RoutingTable('100', routes = [Route('10.4.0.0/16 dev eth0'), Route('2001:db8:1::/48 dev eth0')])
+    table.swap(scratch = 200)
+
+    assert table.name == '100'
+    assert liveRoutes(simulated, 100) == ['10.4.0.0/16 dev eth0']
+    assert liveRoutes(simulated, 100, 6) == ['2001:db8:1::/48 dev eth0']
+    assert liveRoutes(simulated, 200) == []
+    # The rules look the table up by the same id as before
+    assert rules.diff() == ([], [], [])
+#---
+
+
+def test_swapThroughScratchRollsBackFailedLoad(simulated):
+    RoutingTable('100', routes = [Route('10.2.0.0/16 dev eth0')]).apply()
+    routerule.RouteRule(priority = 100, source = '10.9.0.0/16', table = '100').apply()
+
+    table = RoutingTable('100', routes = [Route('10.4.0.0/16 dev eth0'), Route('10.5.0.0/16 dev eth9')])
+    with pytest.raises(BatchError):
+        table.swap(scratch = 200)
+
+    assert liveRoutes(simulated, 100) == ['10.2.0.0/16 dev eth0']
+    assert liveRoutes(simulated, 200) == []
+    assert [str(rule) for rule in routerule.listRules() if rule.priority == '100'] == \
+        ['from 10.9.0.0/16 pref 100 table 100']
+#---
+
+
+def test_swapThroughScratchWritesOnlyChanges(simulated):
+    RoutingTable('100', routes = [Route('10.2.0.0/16 dev eth0'), Route('10.3.0.0/16 dev eth0')]).apply()
+    routerule.RouteRule(priority = 100, source = '10.9.0.0/16', table = '100').apply()
+    commands = []
+    batch = simulated.batch
+    simulated.batch = lambda lines, family = None: commands.extend(lines) or batch(lines, family)
+
+    RoutingTable('100', routes = [Route('10.2.0.0/16 dev eth0'), Route('10.4.0.0/16 dev eth0')]).swap(scratch = 200)
+
+    # Both routes go into the scratch table, but table 100 only gets the one that changed
+    assert [command for command in commands if command.startswith('route') and 'table 100' in command] == \
+        ['route replace 10.4.0.0/16 table 100 dev eth0', 'route del 10.3.0.0/16 table 100 dev eth0']
+    assert liveRoutes(simulated, 100) == ['10.2.0.0/16 dev eth0', '10.4.0.0/16 dev eth0']
+#---
+
+
+def test_swapThroughScratchRollsBackFailedUpdate(simulated):
+    RoutingTable('100', routes = [Route('10.2.0.0/16 dev eth0'), Route('10.3.0.0/16 dev eth0')]).apply()
+    routerule.RouteRule(priority = 100, source = '10.9.0.0/16', table = '100').apply()
+    batch = simulated.batch
+
+    def failingBatch(commands, family = None):
+        # The scratch table takes the route, table 100 doesn't
+        if 'route replace 10.5.0.0/16 table 100 dev eth0' in commands:
+            commands = [command.replace('dev eth0', 'dev eth9') if command.startswith('route replace 10.5.0.0/16')
+                        else command for command in commands]
+        return batch(commands, family)
+    simulated.batch = failingBatch
+
+    table = RoutingTable('100', routes = [Route('10.2.0.0/16 via 10.1.0.254'), Route('10.5.0.0/16 dev eth0')])
+    with pytest.raises(BatchError) as error:
+        table.swap(scratch = 200)
+
+    assert [route.network for route, text in error.value.failures] == ['10.5.0.0/16']
+    assert 'rolled back' in str(error.value)
+    # Table 100 is back as it was, its rule looks it up again, and the scratch table is empty
+    assert liveRoutes(simulated, 100) == ['10.2.0.0/16 dev eth0', '10.3.0.0/16 dev eth0']
+    assert [str(rule) for rule in routerule.listRules() if rule.priority == '100'] == \
+        ['from 10.9.0.0/16 pref 100 table 100']
+    assert liveRoutes(simulated, 200) == []
+#---
+
+
+def test_swapRejectsBusyScratch(simulated):
+    RoutingTable('200', routes = [Route('10.7.0.0/16 dev eth0')]).apply()
+    routerule.RouteRule(priority = 100, source = '10.9.0.0/16', table = '100').apply()
+
+    with pytest.raises(routingtable.RoutingTableError):
+        RoutingTable('100', routes = [Route('10.4.0.0/16 dev eth0')]).swap(scratch = 200)
+#---
+
+
+@pytest.mark.parametrize('concurrent', [False, True])
+def test_loadTables(simulated, concurrent):
+    RoutingTable('100', routes = [Route('10.2.0.0/16 dev eth0'), Route('2001:db8::/32 dev eth0')]).apply()
+    RoutingTable('200', routes = [Route('10.2.0.0/16 via 10.1.0.254 metric 5'), Route('10.3.0.0/16 dev eth0')]).apply()
+    RoutingTable('300', routes = [Route('2001:db8:2::/48 via 2001:db8:1::fe')]).apply()
+    simulated.ip('-6 route add default dev eth0 table 300')
+
+    tables = routingtable.loadTables(concurrent = concurrent)
+
+    assert sorted(tables) == ['100', '200', '300', 'main']
+    # Each table gets exactly the routes a dump of that table alone gives, of both IP versions
+    for name in tables:
+        table = RoutingTable(name)
+        table.parse()
+        assert sorted(str(route.key(name)) for route in tables[name].routes) == \
+               sorted(str(route.key(name)) for route in table.routes)
+    assert [(route.network, route.version()) for route in tables['300'].routes] == [('2001:db8:2::/48', 6),
+                                                                                   ('default', 6)]
+    assert [route.network for route in tables['200'].routes] == ['10.2.0.0/16', '10.3.0.0/16']
+
+    only = routingtable.loadTables(tables = [100, 'main'], versions = (6,), concurrent = concurrent)
+    assert sorted(only) == ['100', 'main']
+    assert [route.network for route in only['100'].routes] == ['2001:db8::/32']
+#---
+
+
+def test_batchErrorFailures():
+    first = BatchError("first", [(Route('10.2.0.0/16 dev eth0'), 'Error')])
+    second = BatchError("second")
+
+    # Every error has its own list
+    assert second.failures == []
+    second.failures.append('failure')
+    assert BatchError("third").failures == []
+    assert len(first.failures) == 1
+    assert str(first) == 'first'
+#---
+
+
+def test_validate(simulated):
+    table = RoutingTable('100', routes = [Route('10.2.0.0/16 dev eth0'), Route('10.2.1.0/24 dev eth0'),
+                                          Route('10.2.0.0/16 dev eth0'), Route('10.3.0.1/16 dev eth0'),
+                                          Route('10.1.0.128/25 dev eth0'), Route('2001:db8::/32 dev eth0'),
+                                          Route('2001:db8:1::/80 dev eth0'), Route('default via 10.1.0.254')])
+
+    assert table.validate() == [(routingtable.ISSUE_OVERLAP, 1, 0), (routingtable.ISSUE_DUPLICATE, 2, 0),
+                                (routingtable.ISSUE_HOST_BITS, 3, None),
+                                (routingtable.ISSUE_CONNECTED, 4, '10.1.0.1/24'), (routingtable.ISSUE_OVERLAP, 6, 5),
+                                (routingtable.ISSUE_CONNECTED, 6, '2001:db8:1::1/64')]
+#---
+
+
+def test_validateOptions(simulated):
+    table = RoutingTable('100', routes = [Route('10.2.0.0/16 dev eth0'), Route('10.2.1.0/24 dev eth0'),
+                                          Route('10.1.0.0/24 proto kernel scope link dev eth0 src 10.1.0.1'),
+                                          Route('10.1.0.128/25 dev eth0')])
+
+    assert table.validate(overlaps = False) == [routingtable.RouteIssue(routingtable.ISSUE_CONNECTED, 3,
+                                                                        '10.1.0.1/24')]
+    assert [issue.kind for issue in table.validate(connected = [])] == [routingtable.ISSUE_OVERLAP] * 2
+#---